@@ -0,0 +1,358 @@
+"""Load and latency benchmark of the DNS server.
+
+Starts server.py on loopback with a generated zone and sends a mix of
+queries at a fixed rate (open loop): delayed v2 names, v1-rdns
+delegations, NXDOMAIN and REFUSED names. Reports the achieved QPS, reply
+latencies, CPU time of the server processes per query and, for delayed
+replies, how far the observed delay deviates from the requested one.
+
+    python3 bench/load_bench.py --rate 2000 --duration 10 --engine asyncio -- --workers 2
+
+Arguments after -- are passed to server.py. The report is printed as JSON.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'server.py')
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION = struct.Struct('!HH')
+QTYPES = {'A': 1, 'AAAA': 28}
+RCODES = {0: 'NOERROR', 3: 'NXDOMAIN', 5: 'REFUSED'}
+
+DEFAULT_MIX = 'v2delay=70,delegation=15,nxdomain=10,refused=5'
+DEFAULT_DELAYS = '0,50,100,250,500'
+DELEGATION_DELAYS = (0, 50, 100)
+
+
+def bench_zone(basedomain: str) -> str:
+    """Zone in the shape of the zone templates of the dns-setup role."""
+    zone = [
+        '$TTL 3600',
+        f'$ORIGIN v1-rdns.{basedomain}.',
+        f'@ IN SOA ns1.{basedomain}. mail.{basedomain}. 1 3600 900 604800 180',
+        f'@ IN NS ns1.{basedomain}.',
+        'ns1 IN A 127.0.0.1',
+        'ipv6-only IN AAAA ::1',
+    ]
+    for delay in DELEGATION_DELAYS:
+        zone += [
+            f'ns1-id-*.delay-{delay} IN A 127.0.0.{delay % 250 + 2}',
+            f'id-*.dns-delay-{delay} IN NS ns1-id---.delay-{delay}.v1-rdns.{basedomain}.',
+        ]
+    zone += [
+        f'$ORIGIN v1.{basedomain}.',
+        f'@ IN SOA ns1.v1.{basedomain}. mail.{basedomain}. 1 3600 900 604800 180',
+        f'@ IN NS ns1.{basedomain}.',
+        f'$ORIGIN v2.{basedomain}.',
+        f'@ IN SOA ns1.{basedomain}. mail.{basedomain}. 1 3600 900 604800 180',
+        f'@ IN NS ns1.{basedomain}.',
+        'v2delay_a-* IN A 192.0.2.1',
+        'v2delay_a-* IN AAAA 2001:db8::1',
+        'v2delay_aaaa-* IN A 192.0.2.1',
+        'v2delay_aaaa-* IN AAAA 2001:db8::1',
+    ]
+    return '\n'.join(zone) + '\n'
+
+
+class Query(typing.NamedTuple):
+    kind: str
+    question: bytes
+    delay: int  # requested delay of the reply (ms)
+    rcode: int  # expected response code
+
+
+def encode_question(name: str, qtype: str) -> bytes:
+    labels = b''.join(bytes([len(label)]) + label.encode() for label in name.rstrip('.').split('.'))
+    return labels + b'\0' + QUESTION.pack(QTYPES[qtype], 1)
+
+
+def query_mix(basedomain: str, mix: dict[str, int], delays: list[int], count: int, seed: int) -> list[Query]:
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    queries = []
+    for n, kind in enumerate(kinds):
+        if kind == 'v2delay':
+            delay = rng.choice(delays)
+            label = rng.choice(('a', 'aaaa'))
+            qtype = rng.choice(('A', 'AAAA'))
+            # Only the record type named in the label is delayed
+            requested = delay if qtype == label.upper() else 0
+            query = Query(kind, encode_question(f'v2delay_{label}-{n}_{delay}.v2.{basedomain}', qtype), requested, 0)
+        elif kind == 'delegation':
+            delay = rng.choice(DELEGATION_DELAYS)
+            query = Query(kind, encode_question(f'id-{n}.dns-delay-{delay}.v1-rdns.{basedomain}', 'A'), 0, 0)
+        elif kind == 'nxdomain':
+            query = Query(kind, encode_question(f'missing-{n}.v1.{basedomain}', 'A'), 0, 3)
+        elif kind == 'refused':
+            query = Query(kind, encode_question(f'query-{n}.example.org', 'A'), 0, 5)
+        else:
+            raise ValueError(f'Unknown query kind {kind}')
+        queries.append(query)
+    return queries
+
+
+def process_tree_cpu(pid: int) -> float:
+    """CPU seconds (user and system) used by a process and its descendants."""
+    parents = {}
+    times = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        parents[int(entry)] = int(fields[1])
+        times[int(entry)] = int(fields[11]) + int(fields[12])
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, parent in parents.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return sum(times.get(p, 0) for p in tree) / os.sysconf('SC_CLK_TCK')
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 3),
+        'p50': at(0.5),
+        'p99': at(0.99),
+        'p999': at(0.999),
+        'max': round(values[-1], 3),
+    }
+
+
+class LoadGenerator:
+    """Sends queries at a fixed rate over several sockets and matches the replies.
+
+    Replies are matched by socket and DNS id, the ids of a socket are reused
+    once 65536 queries were sent over it.
+    """
+
+    def __init__(self, address: str, port: int, sockets: int):
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        self.target = (address, port)
+        self.sockets = []
+        for _ in range(sockets):
+            s = socket.socket(family, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            s.connect(self.target)
+            s.setblocking(False)
+            self.sockets.append(s)
+        self.sent: dict[int, int] = {}  # query index -> send time (ns)
+        self.replies: dict[int, tuple[int, int]] = {}  # query index -> receive time (ns), rcode
+        self.send_duration = 0.0
+        self._in_flight: dict[tuple[int, int], int] = {}  # socket, DNS id -> query index
+        self._receiving = False
+
+    def probe(self, question: bytes, timeout: float) -> bool:
+        """Whether the server answers a query within the timeout."""
+        s = self.sockets[0]
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            s.send(HEADER.pack(0xffff, 0, 1, 0, 0, 0) + question)
+            if select.select([s], [], [], 0.2)[0]:
+                try:
+                    s.recv(4096)
+                    return True
+                except ConnectionRefusedError:
+                    # Not listening yet
+                    time.sleep(0.2)
+        return False
+
+    def _receive(self):
+        fds = {s.fileno(): n for n, s in enumerate(self.sockets)}
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN)
+        while self._receiving:
+            for fd, _ in poller.poll(100):
+                s = self.sockets[fds[fd]]
+                while True:
+                    try:
+                        packet = s.recv(4096)
+                    except BlockingIOError:
+                        break
+                    now = time.perf_counter_ns()
+                    if len(packet) >= HEADER.size:
+                        id, flags = HEADER.unpack_from(packet)[:2]
+                        index = self._in_flight.pop((fds[fd], id), None)
+                        if index is not None:
+                            self.replies[index] = (now, flags & 0xf)
+
+    def run(self, queries: list[Query], rate: float, linger: float) -> list[int]:
+        """Send all queries, wait `linger` seconds for late replies; returns the send lag (ns) per query."""
+        self._receiving = True
+        receiver = threading.Thread(target=self._receive, daemon=True)
+        receiver.start()
+
+        lags = []
+        interval = 1e9 / rate
+        start = time.perf_counter_ns()
+        for index, query in enumerate(queries):
+            scheduled = start + int(index * interval)
+            now = time.perf_counter_ns()
+            if scheduled > now:
+                time.sleep((scheduled - now) / 1e9)
+            sock = index % len(self.sockets)
+            id = index // len(self.sockets) % 65536
+            packet = HEADER.pack(id, 0, 1, 0, 0, 0) + query.question
+            self._in_flight[(sock, id)] = index
+            now = time.perf_counter_ns()
+            try:
+                self.sockets[sock].send(packet)
+            except BlockingIOError:
+                continue
+            self.sent[index] = now
+            lags.append(now - scheduled)
+        self.send_duration = (time.perf_counter_ns() - start) / 1e9
+
+        time.sleep(linger)
+        self._receiving = False
+        receiver.join()
+        return lags
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    return {kind: int(weight) for kind, weight in (part.split('=') for part in value.split(','))}
+
+
+def report(args, queries: list[Query], generator: LoadGenerator, lags: list[int], cpu: float) -> dict:
+    latencies = collections.defaultdict(list)
+    deviations = collections.defaultdict(list)
+    unexpected = collections.Counter()
+    answered = 0
+    for index, sent in generator.sent.items():
+        reply = generator.replies.get(index)
+        if reply is None:
+            continue
+        answered += 1
+        received, rcode = reply
+        query = queries[index]
+        latency = (received - sent) / 1e6
+        if rcode != query.rcode:
+            unexpected[f'{query.kind}:{RCODES.get(rcode, rcode)}'] += 1
+        if query.delay:
+            deviations[query.delay].append(latency - query.delay)
+        else:
+            latencies[query.kind].append(latency)
+
+    sent = len(generator.sent)
+    elapsed = generator.send_duration
+    return {
+        'config': {
+            'engine': args.engine,
+            'server_args': args.server_args,
+            'rate': args.rate,
+            'duration': args.duration,
+            'mix': parse_mix(args.mix),
+            'delays': [int(delay) for delay in args.delays.split(',')],
+        },
+        'sent': sent,
+        'answered': answered,
+        'lost': sent - answered,
+        'unexpected_rcodes': dict(unexpected),
+        'qps_offered': round(sent / elapsed, 1),
+        'qps_answered': round(answered / elapsed, 1),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_us_per_query': round(cpu / answered * 1e6, 1) if answered else None,
+        'send_lag_ms': percentiles([lag / 1e6 for lag in lags]),
+        # Replies without a requested delay
+        'latency_ms': percentiles([latency for values in latencies.values() for latency in values]),
+        'latency_ms_by_kind': {kind: percentiles(values) for kind, values in sorted(latencies.items())},
+        # Observed minus requested delay of delayed replies
+        'delay_error_ms': percentiles([deviation for values in deviations.values() for deviation in values]),
+        'delay_error_ms_by_delay': {str(delay): percentiles(values) for delay, values in sorted(deviations.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure throughput, latency and delay accuracy of the DNS server')
+    parser.add_argument('--rate', type=float, default=1000, help='queries per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--engine', choices=['pool', 'asyncio'], default='asyncio')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the query kinds (v2delay, delegation, nxdomain, refused)')
+    parser.add_argument('--delays', default=DEFAULT_DELAYS, help='requested delays (ms) of the v2delay names')
+    parser.add_argument('--sockets', type=int, default=8, help='client sockets the queries are spread over')
+    parser.add_argument('--port', type=int, default=15353)
+    parser.add_argument('--basedomain', default='he-test.example.com')
+    parser.add_argument('--python', default=sys.executable, help='interpreter running server.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER, help='further arguments of server.py (after --)')
+    args = parser.parse_args()
+    if args.server_args[:1] == ['--']:
+        args.server_args = args.server_args[1:]
+
+    delays = [int(delay) for delay in args.delays.split(',')]
+    queries = query_mix(args.basedomain, parse_mix(args.mix), delays, int(args.rate * args.duration), args.seed)
+
+    with tempfile.TemporaryDirectory(prefix='dns-bench-') as directory:
+        zonefile = os.path.join(directory, 'bench.zone')
+        with open(zonefile, 'w') as f:
+            f.write(bench_zone(args.basedomain))
+        command = [
+            args.python, SERVER, '--port', str(args.port), '--zonefile', zonefile,
+            '--csv', os.path.join(directory, 'queries.csv'), '--output-dir', os.path.join(directory, 'results'),
+            '--v6delay-prefix', '2001:db8::4e:0/112', '--basedomain', args.basedomain,
+            # All load comes from one address, which the rate limiter would shed
+            '--local-ns-ip', '127.0.0.1', '--engine', args.engine, '--rate-limit', '0', *args.server_args,
+        ]
+        with open(os.path.join(directory, 'server.log'), 'w') as log:
+            server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(SERVER))
+        try:
+            generator = LoadGenerator('127.0.0.1', args.port, args.sockets)
+            if not generator.probe(encode_question(f'probe.v1.{args.basedomain}', 'A'), 30):
+                sys.exit('DNS server did not answer, see its output:\n' + open(log.name).read())
+            # Let late probe replies arrive before the measurement
+            time.sleep(0.5)
+            while select.select([generator.sockets[0]], [], [], 0)[0]:
+                generator.sockets[0].recv(4096)
+
+            cpu = process_tree_cpu(server.pid)
+            lags = generator.run(queries, args.rate, max(delays) / 1000 + 2)
+            cpu = process_tree_cpu(server.pid) - cpu
+        finally:
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+    result = json.dumps(report(args, queries, generator, lags, cpu), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Microbenchmark of the query parsing paths of the DNS server.
+
+Compares the dnslib path (DNSRecord.parse, QTYPE/CLASS lookups, IDNA
+normalisation of the name) with the fast wire-format parser.
+
+    python3 bench/parse_bench.py --iterations 100000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from dnslib import DNSRecord, DNSLabel, EDNS0, QTYPE, CLASS  # noqa: E402
+from wire import parse_query, read_query, qtype_name, qclass_name  # noqa: E402
+
+
+def sample_packets(basedomain: str) -> dict[str, bytes]:
+    packets = {
+        'v2delay_aaaa': DNSRecord.question(f'v2delay_aaaa-123456_250.v2.{basedomain}', 'AAAA'),
+        'v1_delegation': DNSRecord.question(f'id-98765.dns-delay-1000.v1-rdns.{basedomain}', 'A'),
+        'v1_mixed_case': DNSRecord.question(f'Id-98765.DeLaY-50.v1.{basedomain}', 'AAAA'),
+    }
+    edns = DNSRecord.question(f'v2delay_a-123456_250.v2.{basedomain}', 'A')
+    edns.add_ar(EDNS0(udp_len=1232))
+    packets['v2delay_a_edns'] = edns
+    return {name: record.pack() for name, record in packets.items()}
+
+
+def dnslib_path(packet: bytes):
+    request = DNSRecord.parse(packet)
+    question = request.q
+    qname = DNSLabel(question.qname.idna().lower())
+    return request.header.id, qname.idna(), QTYPE[question.qtype], CLASS[question.qclass]
+
+
+def wire_path(packet: bytes):
+    query = read_query(packet)
+    qname = b'.'.join(label.lower() for label in query.labels).decode() + '.'
+    return query.id, qname, qtype_name(query.qtype), qclass_name(query.qclass)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the dnslib and the wire-format query parsing paths')
+    parser.add_argument('--iterations', type=int, default=50_000, help='parses per packet and path')
+    parser.add_argument('--repeat', type=int, default=5, help='best of this many runs is reported')
+    parser.add_argument('--basedomain', default='he-test.example.com')
+    args = parser.parse_args()
+
+    results = {}
+    for name, packet in sample_packets(args.basedomain).items():
+        assert parse_query(packet) is not None, name
+        assert dnslib_path(packet)[1:] == wire_path(packet)[1:], name
+        result = {}
+        for path, func in (('dnslib', dnslib_path), ('wire', wire_path)):
+            best = min(timeit.repeat(lambda: func(packet), number=args.iterations, repeat=args.repeat))
+            result[f'{path}_ns'] = round(best / args.iterations * 1e9)
+        result['speedup'] = round(result['dnslib_ns'] / result['wire_ns'], 1)
+        results[name] = result
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import ipaddress
+import socket
+import typing
+
+
+# Roles of the local addresses: name server (--local-ns-ip), test address (delay table or delay prefix) or other
+NS = 'ns'
+TEST = 'test'
+OTHER = 'other'
+TABLE_SIZE = 65_536
+PEER_CACHE_SIZE = 65_536
+
+V4_MAPPED = bytes(10) + b'\xff\xff'
+
+
+class LocalAddress(typing.NamedTuple):
+    """An address of this server queries are sent to and what it is used for."""
+    # Text form, IPv4-mapped addresses as IPv4 address
+    address: str
+    version: int
+    role: str
+    # Delay of an address of the delay prefix (its last group read as decimal number)
+    delay_ms: typing.Optional[int] = None
+    delay_id: typing.Optional[str] = None
+
+    @property
+    def ns(self) -> bool:
+        return self.role == NS
+
+
+UNKNOWN = LocalAddress('', 0, OTHER)
+
+
+def pack_address(address: str) -> bytes:
+    """Packed form of an IPv4 or IPv6 address (without scope id)."""
+    address = address.partition('%')[0]
+    return socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+
+
+class AddressTable:
+    """Roles of the local addresses by their packed form, as in the IP_PKTINFO/IPV6_PKTINFO of a datagram.
+
+    The name server and test addresses of the deployment are entered when
+    the table is built, any other address when a query is first sent to it
+    (while the table holds less than `size` addresses). IPv4 addresses are
+    found by their 4 bytes and as IPv4-mapped IPv6 address.
+    """
+
+    def __init__(self, v6delay_prefix: ipaddress.IPv6Network, ns_addresses: typing.Iterable[str] = (),
+                 delays: typing.Iterable[tuple[str, str]] = (), size: int = TABLE_SIZE):
+        self.size = size
+        self._network = int(v6delay_prefix.network_address)
+        self._netmask = int(v6delay_prefix.netmask)
+        self._ns = frozenset(self._unmapped(pack_address(address)) for address in ns_addresses)
+        self._delay_ids = {self._unmapped(pack_address(address)): delay_id for delay_id, address in delays}
+        self._table: dict[bytes, LocalAddress] = {}
+        for packed in [*self._ns, *self._delay_ids]:
+            self.local(packed)
+            if len(packed) == 4:
+                self.local(V4_MAPPED + packed)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    @staticmethod
+    def _unmapped(packed: bytes) -> bytes:
+        return packed[12:] if len(packed) == 16 and packed[:12] == V4_MAPPED else packed
+
+    def local(self, packed: typing.Optional[bytes]) -> LocalAddress:
+        """Role of a local address given as 4 or 16 bytes."""
+        local = self._table.get(packed)
+        if local is None:
+            if packed is None:
+                return UNKNOWN
+            local = self._build(packed)
+            if len(self._table) < self.size:
+                self._table[packed] = local
+        return local
+
+    def local_text(self, address: str) -> LocalAddress:
+        """Role of a local address given in text form (e.g. the sockname of a connection)."""
+        return self.local(pack_address(address))
+
+    def _build(self, packed: bytes) -> LocalAddress:
+        packed = self._unmapped(packed)
+        delay_ms = None
+        if len(packed) == 4:
+            address = socket.inet_ntop(socket.AF_INET, packed)
+            version = 4
+        else:
+            address = socket.inet_ntop(socket.AF_INET6, packed)
+            version = 6
+            if int.from_bytes(packed) & self._netmask == self._network:
+                try:
+                    delay_ms = int(packed[14:].hex())
+                except ValueError:
+                    # Not a delay address (e.g. one whose queries are dropped)
+                    pass
+        delay_id = self._delay_ids.get(packed)
+        if packed in self._ns:
+            role = NS
+        elif delay_id is not None or delay_ms is not None:
+            role = TEST
+        else:
+            role = OTHER
+        return LocalAddress(address, version, role, delay_ms, delay_id)
+
+
+_peers: dict[str, str] = {}
+
+
+def peer_address(addr: str) -> str:
+    """Text form of a peer address as recorded, IPv4-mapped addresses as IPv4 address.
+
+    Kept for the last PEER_CACHE_SIZE new peers of the process.
+    """
+    peer = _peers.get(addr)
+    if peer is None:
+        packed = pack_address(addr)
+        peer = socket.inet_ntop(socket.AF_INET, packed[12:]) if packed[:12] == V4_MAPPED else addr
+        if len(_peers) >= PEER_CACHE_SIZE:
+            del _peers[next(iter(_peers))]
+        _peers[addr] = peer
+    return peer
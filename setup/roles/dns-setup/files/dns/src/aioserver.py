@@ -0,0 +1,294 @@
+from addresses import AddressTable, LocalAddress
+from inflight import InFlight
+from metrics import Metrics, DELEGATIONS, LATENESS, MALFORMED, QUERIES, QUERY_DELAY, RCODE_NAMES, RESPONSES, \
+    RETRANSMITS, SEND_ERRORS, STAGE_DURATION
+from profiling import StageSampler, Stages
+from ratelimit import RateLimiter, ACCEPT, ACTION_NAMES, TRUNCATE
+from resolver import Resolver, Query
+from results import QueryInfo, complete_query_data
+from udp import BatchSocket, arrival_time, local_address, reply_ancdata
+from wire import qtype_name, question_key, read_query, truncated_response
+from zonewatch import ZoneWatcher
+
+import dnslib.dns
+
+import asyncio
+import logging
+import signal
+import socket
+import time
+import typing
+
+
+class DNSEngine:
+    """Resolves the queries of any transport on an asyncio event loop.
+
+    Keeps the current resolver (swapped by the zone watcher) and does the
+    logging, metrics and results shared by the listeners; sending the
+    answers is left to them. Queries picked by the `sampler` (--profile)
+    have their stages timed.
+    """
+
+    def __init__(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            resolver: Resolver,
+            log,
+            results,
+            addresses: AddressTable,
+            zonefile: str,
+            load_resolver: typing.Callable[[str], Resolver],
+            metrics: Metrics,
+            sampler: typing.Optional[StageSampler] = None
+    ):
+        self._loop = loop
+        self._resolver = resolver
+        self._log = log
+        self._results = results
+        self.addresses = addresses
+        self._metrics = metrics
+        self._sampler = sampler
+        self.watcher = ZoneWatcher(zonefile, resolver, load_resolver, self._swap_resolver, lambda r: r.zone_size, metrics)
+
+    def start(self):
+        self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+
+    def _swap_resolver(self, resolver: Resolver):
+        # Called from the watcher thread, the loop picks the new resolver up between two callbacks
+        self._loop.call_soon_threadsafe(setattr, self, '_resolver', resolver)
+
+    def question(self, packet: bytes, addr: str, port: int, local: LocalAddress) -> typing.Optional[Query]:
+        """Parse and log a query, None if it is not answered."""
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'Connection from {addr} towards {local.address}')
+        metrics = self._metrics
+        stages = self._sampler.start() if self._sampler else None
+        try:
+            request = read_query(packet)
+        except dnslib.dns.DNSError as e:
+            metrics.inc(MALFORMED)
+            logging.exception(e)
+            return None
+        if request is None:
+            return None
+        if stages:
+            stages.mark('parse')
+        metrics.inc(QUERIES, qtype_name(request.qtype))
+
+        start = time.perf_counter_ns()
+        try:
+            query = self._resolver.question(request, self._log, addr, port, local)
+        except Exception as e:
+            logging.exception(e)
+            return None
+        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'question')
+        metrics.observe(QUERY_DELAY, query.delay / 1000)
+        if stages:
+            stages.mark('question')
+            query.stages = stages
+        return query
+
+    def limited(self, packet: bytes, addr: str, port: int, local: LocalAddress, request_time: float, action: int):
+        """Record a query shed or answered truncated by the rate limiter."""
+        try:
+            query_data = self._resolver.limited(packet, addr, port, local, ACTION_NAMES[action])
+        except Exception as e:
+            logging.exception(e)
+            return
+        if query_data:
+            complete_query_data(query_data, local, request_time)
+            self._results.put(query_data)
+
+    def answer(self, query: Query) -> typing.Optional[tuple[bytes, typing.Optional[QueryInfo]]]:
+        """The answer packet of a query once its delay has passed."""
+        metrics = self._metrics
+        if query.stages:
+            query.stages.restart()
+        start = time.perf_counter_ns()
+        try:
+            answer, query_data = self._resolver.answer_packet(query, self._log)
+        except Exception as e:
+            logging.exception(e)
+            return None
+        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'answer')
+        if query.stages:
+            query.stages.mark('render')
+        metrics.inc(RESPONSES, RCODE_NAMES.get(answer[3] & 0xf))
+        if query_data and query_data.delegation:
+            metrics.inc(DELEGATIONS)
+        return answer, query_data
+
+    def sent(self, query_data: typing.Optional[QueryInfo], local: LocalAddress, request_time: float,
+             intended_send_time: float, send_time: float, stages: typing.Optional[Stages] = None):
+        """Record an answer which was sent."""
+        self._metrics.observe(LATENESS, send_time - intended_send_time)
+        if query_data:
+            complete_query_data(query_data, local, request_time, intended_send_time, send_time)
+            if stages:
+                stages.mark('record')
+            self._results.put(query_data)
+            if stages:
+                stages.mark('results_put')
+
+
+class DNSServer(DNSEngine):
+    """DNS engine running on a single asyncio event loop.
+
+    Questions are resolved in-process and delayed answers are scheduled with
+    `loop.call_at` for the kernel arrival time of the query plus its delay,
+    so pending delays cost a timer instead of a worker. Retransmits of a
+    delayed query are attached to it in the `inflight` table (if any) and
+    answered with it.
+    """
+
+    def __init__(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            sock: socket.socket,
+            resolver: Resolver,
+            log,
+            results,
+            addresses: AddressTable,
+            zonefile: str,
+            load_resolver: typing.Callable[[str], Resolver],
+            metrics: Metrics,
+            limiter: RateLimiter,
+            sampler: typing.Optional[StageSampler] = None,
+            inflight: typing.Optional[InFlight] = None
+    ):
+        super().__init__(loop, resolver, log, results, addresses, zonefile, load_resolver, metrics, sampler)
+        self._sock = sock
+        self._limiter = limiter
+        self._inflight = inflight
+        self._batch = BatchSocket(sock)
+        # Answers waiting to be sent with the next flush:
+        # (packet, ancdata, addr, port, query_data, local, request_time, intended_send_time, stages),
+        # truncated answers of rate limited queries have no intended send time
+        self._outbox = []
+
+    def start(self):
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._on_readable)
+        super().start()
+
+    def stop(self):
+        self._loop.remove_reader(self._sock.fileno())
+        super().stop()
+
+    def _on_readable(self):
+        datagrams = self._batch.recv()
+        if not datagrams:
+            return
+        if self._inflight is not None:
+            self._inflight.expire()
+        for packet, ancdata, addr_info in datagrams:
+            self._handle(packet, ancdata, addr_info[0], addr_info[1])
+
+    def _handle(self, packet: bytes, ancdata, addr: str, port: int):
+        local = self.addresses.local(local_address(ancdata))
+        action = self._limiter.check(packet, addr, local.address)
+        arrival, arrival_monotonic = arrival_time(ancdata)
+        request_time = arrival / 1e9
+        if action != ACCEPT:
+            response = truncated_response(packet) if action == TRUNCATE else None
+            if response:
+                self._send(response, ancdata, addr, port, None, local, 0, None, None)
+            if action in ACTION_NAMES:
+                self.limited(packet, addr, port, local, request_time, action)
+            return
+
+        key = None
+        if self._inflight is not None:
+            question = question_key(packet)
+            if question is not None:
+                key = (addr, port, question)
+                if self._inflight.attach(key, arrival_monotonic, request_time):
+                    self._metrics.inc(RETRANSMITS)
+                    return
+
+        query = self.question(packet, addr, port, local)
+        if query is None:
+            return
+
+        if query.delay > 0:
+            if key is not None:
+                self._inflight.add(key, arrival_monotonic)
+                query.inflight = key
+            # The loop clock is the monotonic clock
+            self._loop.call_at(arrival_monotonic + query.delay / 1000, self._reply, query, ancdata, request_time,
+                               (arrival + query.delay * 1_000_000) / 1e9)
+        else:
+            self._reply(query, ancdata, request_time, request_time)
+
+    def _reply(self, query: Query, ancdata, request_time: float, intended_send_time: float):
+        answered = self.answer(query)
+        retransmits = self._inflight.pop(query.inflight) if query.inflight is not None else None
+        if answered is None:
+            return
+        answer, query_data = answered
+        if retransmits and query_data:
+            query_data.retransmit_times = retransmits
+        self._send(answer, ancdata, query.addr, query.port, query_data, query.local, request_time, intended_send_time,
+                   query.stages)
+
+    def _send(self, answer: bytes, ancdata, addr: str, port: int, query_data: typing.Optional[QueryInfo],
+              local: LocalAddress, request_time: float, intended_send_time: typing.Optional[float],
+              stages: typing.Optional[Stages]):
+        # Answers due in the same loop iteration go out with one system call
+        if not self._outbox:
+            self._loop.call_soon(self._flush)
+        self._outbox.append((answer, reply_ancdata(ancdata), addr, port, query_data, local, request_time,
+                             intended_send_time, stages))
+
+    def _flush(self):
+        metrics = self._metrics
+        outbox, self._outbox = self._outbox, []
+        start = time.perf_counter_ns()
+        errors = self._batch.send([(answer, ancdata, addr, port) for answer, ancdata, addr, port, *_ in outbox])
+        send_time = time.time()
+        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'send')
+        for (_, _, addr, _, query_data, local, request_time, intended_send_time, stages), error in zip(outbox, errors):
+            if error is not None:
+                metrics.inc(SEND_ERRORS)
+                if isinstance(error, BlockingIOError):
+                    logging.warning(f'Send buffer full, dropping answer to {addr}')
+                else:
+                    logging.error(f'Sending answer to {addr} failed: {error}')
+                continue
+            if intended_send_time is not None:
+                if stages:
+                    # The batch the answer went out with, including the wait for its flush
+                    stages.mark('send')
+                self.sent(query_data, local, request_time, intended_send_time, send_time, stages)
+
+
+def serve(
+        sock: socket.socket,
+        resolver: Resolver,
+        log,
+        results,
+        addresses: AddressTable,
+        zonefile: str,
+        load_resolver: typing.Callable[[str], Resolver],
+        metrics: Metrics,
+        limiter: RateLimiter,
+        sampler: typing.Optional[StageSampler] = None,
+        inflight: typing.Optional[InFlight] = None
+):
+    """Serve DNS requests on `sock` until SIGINT or SIGTERM is received."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+
+    server = DNSServer(loop, sock, resolver, log, results, addresses, zonefile, load_resolver, metrics, limiter,
+                       sampler, inflight)
+    server.start()
+    try:
+        loop.run_forever()
+    finally:
+        server.stop()
+        loop.close()
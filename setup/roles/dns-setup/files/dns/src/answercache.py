@@ -0,0 +1,137 @@
+from dnslib import DNSLabel, RR
+from dnslib.label import DNSBuffer
+
+from logger import LogItem, LogType
+from results import QueryInfo
+
+import struct
+import typing
+
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_RA = 0x0080
+FLAG_AD = 0x0020
+RCODE_MASK = 0x000f
+
+# Owner names equal to the question name point to it (offset 12, directly after the header)
+QNAME_POINTER = b'\xc0\x0c'
+
+
+class _NoCompressBuffer(DNSBuffer):
+    """Packs names in full so the packed bytes can be placed at any offset of a packet."""
+
+    def encode_name(self, name):
+        self.encode_name_nocompress(name)
+
+
+def pack_name(name) -> bytes:
+    buffer = _NoCompressBuffer()
+    buffer.encode_name(name)
+    return bytes(buffer.data)
+
+
+def pack_rdata(rr: RR) -> bytes:
+    buffer = _NoCompressBuffer()
+    rr.rdata.pack(buffer)
+    return bytes(buffer.data)
+
+
+class TemplateRecord:
+    """One pre-packed resource record of an answer template."""
+    __slots__ = ('owner', 'fixed', 'rdata', 'rename')
+
+    def __init__(self, rr: RR, owner: typing.Optional[bytes], rename: typing.Optional[tuple[bytes, bytes]] = None):
+        # None means the owner is the question name
+        self.owner = owner
+        self.fixed = struct.pack('!HHI', rr.rtype, rr.rclass, rr.ttl)
+        self.rdata = pack_rdata(rr)
+        # (label prefix, packed remaining labels) of an NS target which gets the session id appended
+        self.rename = rename
+
+
+class AnswerTemplate:
+    """Pre-packed response sections for one query shape.
+
+    Per query only the header, the echoed question, owner names equal to the
+    question name and the session id of renamed NS targets are filled in.
+    """
+    __slots__ = ('aa', 'rcode', 'sections', 'log_items', 'answers', 'delegation')
+
+    def __init__(
+            self,
+            aa: bool,
+            rcode: int,
+            answer: list[TemplateRecord],
+            authority: list[TemplateRecord],
+            additional: list[TemplateRecord],
+            log_items: list[tuple[LogType, typing.Optional[str], int, int, str]],
+            answers: list[tuple[str, str, typing.Optional[str]]],
+            delegation: typing.Optional[bool]
+    ):
+        self.aa = aa
+        self.rcode = rcode
+        self.sections = (answer, authority, additional)
+        # (type, rr_name or None for the question name, rr_class, rr_type, rr_value)
+        self.log_items = log_items
+        # (rtype, rvalue or rvalue prefix, rvalue suffix if the session id goes in between)
+        self.answers = answers
+        # None if the query is not recorded in the query results
+        self.delegation = delegation
+
+    def render(self, query, ns_id: str, log) -> tuple[bytes, typing.Optional[QueryInfo]]:
+        wire = query.wire
+        rr_name = query.query_info.rr_name
+
+        for log_type, name, rr_class, rr_type, rr_value in self.log_items:
+            log.put(LogItem(
+                id=wire.id,
+                type=log_type,
+                peer_addr=query.addr,
+                peer_port=query.port,
+                rr_name=rr_name if name is None else name,
+                rr_class=rr_class,
+                rr_type=rr_type,
+                rr_value=rr_value,
+            ))
+
+        query_info = None
+        if self.delegation is not None:
+            query_info = query.query_info
+            query_info.delegation = self.delegation
+            query_info.answers = [
+                (rr_name, rtype, rvalue if suffix is None else f'{rvalue}{ns_id}{suffix}')
+                for rtype, rvalue, suffix in self.answers
+            ]
+
+        bitmap = (wire.bitmap | FLAG_QR | FLAG_AA) & ~(FLAG_RA | FLAG_AD)
+        if not self.aa:
+            bitmap &= ~FLAG_AA
+        if self.rcode:
+            bitmap = (bitmap & ~RCODE_MASK) | self.rcode
+
+        # Owner names are written in lower case, point to the question only if it matches that
+        if all(label == label.lower() for label in wire.labels):
+            owner = QNAME_POINTER
+        else:
+            owner = pack_name(query.qname)
+
+        answer, authority, additional = self.sections
+        parts = [
+            struct.pack('!HHHHHH', wire.id, bitmap, 1, len(answer), len(authority), len(additional)),
+            wire.question,
+        ]
+        for section in self.sections:
+            for record in section:
+                rdata = record.rdata
+                if record.rename is not None:
+                    prefix, tail = record.rename
+                    label = prefix + ns_id.encode()
+                    if len(label) > 63:
+                        raise ValueError(f'Label component too long: {label!r}')
+                    rdata = bytes((len(label),)) + label + tail
+                parts.append(owner if record.owner is None else record.owner)
+                parts.append(record.fixed)
+                parts.append(struct.pack('!H', len(rdata)))
+                parts.append(rdata)
+        return b''.join(parts), query_info
@@ -0,0 +1,243 @@
+from metrics import Metrics, COLLECTOR_BATCHES, COLLECTOR_RECORDS, COLLECTOR_SPOOL_BYTES
+
+import gzip
+import logging
+import os
+import queue
+import threading
+import time
+import typing
+import uuid
+
+import requests
+
+
+BATCH_BYTES = 256 * 1024
+BATCH_INTERVAL = 1.0
+TIMEOUT = 10
+SPOOL_LIMIT = 1024 * 1024 * 1024
+# Backoff (in seconds) between the attempts while the collector fails
+RETRY_MIN = 1
+RETRY_MAX = 60
+# Batches handed to the sending thread before adding blocks
+QUEUE_BATCHES = 64
+# Responses which will not change on another attempt, their batch is dropped
+REJECTED = (400, 413, 415)
+SPOOL_SUFFIX = '.ndjson.gz'
+_STOP = object()
+
+
+def read_token(path: str) -> str:
+    """Bearer token of the collector from a file (readable by the server only), not the command line."""
+    with open(path) as f:
+        return f.read().strip()
+
+
+class Batch(typing.NamedTuple):
+    id: str
+    records: int
+    # gzip compressed NDJSON
+    data: bytes
+
+
+class Spool:
+    """Batches not yet taken by the collector, one file per batch in the order they were cut.
+
+    Files are named `<sequence>-<batch id>-<records>.ndjson.gz` and written
+    to a temporary file first, so a crash leaves only complete batches.
+    """
+
+    def __init__(self, directory: str, limit: int = SPOOL_LIMIT):
+        self.directory = directory
+        self.limit = limit
+        os.makedirs(directory, exist_ok=True)
+        self._files: list[str] = []
+        self.size = 0
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith(SPOOL_SUFFIX):
+                self._files.append(name)
+                self.size += os.path.getsize(path)
+            elif name.endswith('.tmp'):
+                os.remove(path)
+        self._sequence = int(self._files[-1].split('-', 1)[0]) + 1 if self._files else 0
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def append(self, batch: Batch) -> bool:
+        """Keep a batch, False if the spool is full."""
+        if self.size + len(batch.data) > self.limit:
+            return False
+        name = f'{self._sequence:012d}-{batch.id}-{batch.records}{SPOOL_SUFFIX}'
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(batch.data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        self._sequence += 1
+        self._files.append(name)
+        self.size += len(batch.data)
+        return True
+
+    def first(self) -> Batch:
+        name = self._files[0]
+        _, id, records = name[:-len(SPOOL_SUFFIX)].split('-')
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return Batch(id, int(records), f.read())
+
+    def pop(self):
+        path = os.path.join(self.directory, self._files.pop(0))
+        self.size -= os.path.getsize(path)
+        os.remove(path)
+
+
+class CollectorClient:
+    """Streams the query records of this server to the `/dns-queries` endpoint of a results-upload service.
+
+    Records are batched until `batch_bytes` are pending or `batch_interval`
+    passed and every batch is sent gzip compressed as one POST over a kept
+    alive connection. The collector drops batches (by their id) it wrote
+    before, so a batch is sent again whenever its response got lost. While
+    the collector cannot be reached, batches are spooled to `spool_dir` and
+    sent from there in order (before any newer batch) once it is back.
+    """
+
+    def __init__(self, url: str, spool_dir: str, token: typing.Optional[str] = None, batch_bytes: int = BATCH_BYTES,
+                 batch_interval: float = BATCH_INTERVAL, timeout: float = TIMEOUT, spool_limit: int = SPOOL_LIMIT,
+                 metrics: typing.Optional[Metrics] = None):
+        self.url = url
+        self.spool_dir = spool_dir
+        self.token = token
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self.timeout = timeout
+        self.spool_limit = spool_limit
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._pending: list[bytes] = []
+        self._pending_size = 0
+        self._batches: queue.Queue = queue.Queue(QUEUE_BATCHES)
+        self._thread: typing.Optional[threading.Thread] = None
+        self._session: typing.Optional[requests.Session] = None
+        self._spool: typing.Optional[Spool] = None
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        self._last_cut = 0.0
+
+    def start(self):
+        """Start sending from this process (the one adding the records)."""
+        self._spool = Spool(self.spool_dir, self.spool_limit)
+        if len(self._spool):
+            logging.info(f'Sending {len(self._spool)} spooled batches to the collector {self.url}')
+        self._session = requests.Session()
+        self._session.headers['Content-Type'] = 'application/x-ndjson'
+        self._session.headers['Content-Encoding'] = 'gzip'
+        if self.token:
+            self._session.headers['Authorization'] = f'Bearer {self.token}'
+        self._last_cut = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='collector', daemon=True)
+        self._thread.start()
+
+    def add(self, line: bytes):
+        """Queue a record (one JSON line including its newline)."""
+        with self._lock:
+            self._pending.append(line)
+            self._pending_size += len(line)
+            batch = self._cut() if self._pending_size >= self.batch_bytes else None
+        if batch:
+            self._batches.put(batch)
+
+    def close(self):
+        """Send (or spool) the pending records and stop."""
+        with self._lock:
+            batch = self._cut()
+        if batch:
+            self._batches.put(batch)
+        self._batches.put(_STOP)
+        self._thread.join()
+        self._session.close()
+
+    def _cut(self) -> typing.Optional[Batch]:
+        self._last_cut = time.monotonic()
+        if not self._pending:
+            return None
+        batch = Batch(uuid.uuid4().hex, len(self._pending), gzip.compress(b''.join(self._pending), compresslevel=5))
+        self._pending = []
+        self._pending_size = 0
+        return batch
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            timeout = self._last_cut + self.batch_interval - now
+            if len(self._spool):
+                timeout = min(timeout, self._retry_at - now)
+            try:
+                batch = self._batches.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                batch = None
+                if time.monotonic() >= self._last_cut + self.batch_interval:
+                    with self._lock:
+                        batch = self._cut()
+            if batch is _STOP:
+                break
+            if batch is not None:
+                self._handle(batch)
+            self._replay()
+
+    def _handle(self, batch: Batch):
+        # Newer batches wait behind the spooled ones
+        if not len(self._spool) and time.monotonic() >= self._retry_at:
+            status = self._send(batch)
+            if status is not None:
+                self._count('sent' if status == 200 else 'rejected', batch, status)
+                return
+        if self._spool.append(batch):
+            self._count('spooled', batch)
+        else:
+            logging.error(f'Collector spool {self.spool_dir} is full, dropping {batch.records} query records')
+            self._count('dropped', batch)
+
+    def _replay(self):
+        while len(self._spool) and time.monotonic() >= self._retry_at:
+            batch = self._spool.first()
+            status = self._send(batch)
+            if status is None:
+                break
+            self._spool.pop()
+            self._count('replayed' if status == 200 else 'rejected', batch, status)
+            if not len(self._spool):
+                logging.info(f'Sent all spooled batches to the collector {self.url}')
+
+    def _send(self, batch: Batch) -> typing.Optional[int]:
+        """Status of the response to the batch, None if it has to be sent again."""
+        try:
+            response = self._session.post(self.url, data=batch.data, headers={'X-Batch-Id': batch.id},
+                                          timeout=self.timeout)
+            status = response.status_code
+        except requests.RequestException as e:
+            self._fail(f'Sending query records to the collector {self.url} failed: {e}')
+            return None
+        if status == 200 or status in REJECTED:
+            self._retry_delay = 0.0
+            self._retry_at = 0.0
+            return status
+        self._fail(f'The collector {self.url} answered query records with status {status}')
+        return None
+
+    def _fail(self, message: str):
+        if not self._retry_delay:
+            logging.warning(f'{message}, spooling them to {self.spool_dir}')
+        self._retry_delay = min(max(self._retry_delay * 2, RETRY_MIN), RETRY_MAX)
+        self._retry_at = time.monotonic() + self._retry_delay
+
+    def _count(self, result: str, batch: Batch, status: typing.Optional[int] = None):
+        if result == 'rejected':
+            logging.error(f'The collector {self.url} rejected {batch.records} query records (status {status})')
+        if self._metrics:
+            self._metrics.inc(COLLECTOR_BATCHES, result)
+            if result in ('sent', 'replayed'):
+                self._metrics.inc(COLLECTOR_RECORDS, amount=batch.records)
+            self._metrics.set(COLLECTOR_SPOOL_BYTES, self._spool.size)
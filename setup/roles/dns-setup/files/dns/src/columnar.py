@@ -0,0 +1,77 @@
+from logger import LogItem, LogType
+
+import time
+import typing
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+BATCH_ROWS = 65536
+FLUSH_INTERVAL = 60.0
+
+
+def available() -> bool:
+    return pa is not None
+
+
+class ArrowLogWriter:
+    """Writes log items as a zstd compressed Arrow IPC stream (requires pyarrow).
+
+    The type column is dictionary encoded, rr_class and rr_type hold the
+    numeric DNS codes. Rows are written in record batches once `BATCH_ROWS`
+    are pending or `FLUSH_INTERVAL` seconds passed; a stream cut off by a
+    crash is readable up to its last batch.
+
+        pyarrow.ipc.open_stream(path).read_pandas()
+    """
+
+    def __init__(self, path: str, compression: str = 'zstd'):
+        if pa is None:
+            raise RuntimeError('pyarrow is required for the Arrow query log')
+        self._types = pa.array([member.name for member in LogType])
+        self._schema = pa.schema([
+            ('id', pa.uint16()),
+            ('type', pa.dictionary(pa.int8(), pa.string())),
+            ('peer_addr', pa.string()),
+            ('peer_port', pa.uint16()),
+            ('rr_name', pa.string()),
+            ('rr_class', pa.uint16()),
+            ('rr_type', pa.uint16()),
+            ('rr_value', pa.string()),
+            ('timestamp', pa.timestamp('ns', tz='UTC')),
+        ])
+        self._sink = pa.OSFile(path, 'wb')
+        self._writer = pa.ipc.new_stream(self._sink, self._schema,
+                                         options=pa.ipc.IpcWriteOptions(compression=compression))
+        self._columns: list[list] = [[] for _ in LogItem.FIELDS]
+        self._last_flush = time.monotonic()
+
+    def write(self, items: typing.Iterable[LogItem]):
+        columns = self._columns
+        for item in items:
+            for column, name in zip(columns, LogItem.FIELDS):
+                column.append(getattr(item, name))
+        if len(columns[0]) >= BATCH_ROWS or time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._columns[0]:
+            return
+        arrays = []
+        for column, field in zip(self._columns, self._schema):
+            if field.name == 'type':
+                indices = pa.array([log_type - 1 for log_type in column], pa.int8())
+                arrays.append(pa.DictionaryArray.from_arrays(indices, self._types))
+            else:
+                arrays.append(pa.array(column, field.type))
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+        self._columns = [[] for _ in LogItem.FIELDS]
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        self._sink.close()
@@ -0,0 +1,76 @@
+import collections
+import threading
+import time
+import typing
+
+
+# Seconds a query stays in the table at most, longer than the longest delay of an answer
+TTL = 30.0
+
+# (peer address, peer port, ID and question of the query)
+Key = tuple[str, int, bytes]
+
+
+class Pending:
+    """A query whose answer was not sent yet and the retransmits which arrived meanwhile."""
+    __slots__ = ('arrival', 'retransmits')
+
+    def __init__(self, arrival: float):
+        self.arrival = arrival
+        # Realtime arrival of every retransmit (seconds)
+        self.retransmits: list[float] = []
+
+
+class InFlight:
+    """Queries waiting for their (delayed) answer by peer, port, ID and question.
+
+    A retransmit of such a query is attached to it instead of being
+    answered again: the answer of the first copy answers all of them.
+    Entries are removed when the answer is sent and expire after `ttl`
+    seconds, so a query whose answer was lost is answered anew.
+    Safe to use from several threads (the pool completes tasks in one).
+    """
+
+    def __init__(self, ttl: float = TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # In order of arrival (monotonic clock)
+        self._pending: collections.OrderedDict[Key, Pending] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def attach(self, key: Key, arrival_monotonic: float, arrival: float) -> bool:
+        """Record a query as retransmit of the pending one with the same key, False if there is none."""
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                return False
+            if arrival_monotonic - pending.arrival >= self.ttl:
+                del self._pending[key]
+                return False
+            pending.retransmits.append(arrival)
+            return True
+
+    def add(self, key: Key, arrival_monotonic: float):
+        """Enter a query whose answer is pending."""
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = Pending(arrival_monotonic)
+
+    def pop(self, key: Key) -> list[float]:
+        """Remove a query once its answer was sent, returns the arrivals of its retransmits."""
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        return pending.retransmits if pending else []
+
+    def expire(self, now: typing.Optional[float] = None):
+        """Remove the queries which arrived more than `ttl` seconds ago."""
+        deadline = (time.monotonic() if now is None else now) - self.ttl
+        pending = self._pending
+        with self._lock:
+            while pending:
+                key, first = next(iter(pending.items()))
+                if first.arrival > deadline:
+                    break
+                del pending[key]
@@ -1,38 +1,339 @@
-from csv import DictWriter
-from dataclasses import dataclass, fields, field, asdict
-from multiprocessing import Queue
+import csv
+from multiprocessing import Lock, shared_memory
 
+from wire import qclass_name, qtype_name
+
+import enum
+import logging
+import os
+import struct
 import time
+import typing
+
+
+FLUSH_INTERVAL = 1.0
+POLL_INTERVAL = 0.05
+
+# Interned strings per producer before its table is reset
+INTERN_LIMIT = 4096
 
 
 def current_time() -> int:
     return time.time_ns()
 
 
-@dataclass
+class LogType(enum.IntEnum):
+    QUESTION = 1
+    ANSWER = 2
+    AUTHORITY = 3
+
+
 class LogItem:
-    id: int = 0
-    type: str = ''
-    peer_addr: str = ''
-    peer_port: str = ''
-    rr_name: str = ''
-    rr_class: str = ''
-    rr_type: str = ''
-    rr_value: str = ''
-    timestamp: int = field(default_factory=current_time)
-
-
-def log_to_file(csv_file: str, q: Queue):
-    with open(csv_file, "w", newline="") as file:
-        fieldnames = [field.name for field in fields(LogItem)]
-
-        writer = DictWriter(file, fieldnames=fieldnames, dialect="unix")
-        writer.writeheader()
-        file.flush()
-
-        while True:
-            item: LogItem = q.get()
-            if item is None:
-                break
-            writer.writerow(asdict(item))
+    """One logged question or answer record.
+
+    The type is a LogType and rr_class/rr_type are the numeric DNS codes, the
+    names are only looked up when the item is written out.
+    """
+    __slots__ = ('id', 'type', 'peer_addr', 'peer_port', 'rr_name', 'rr_class', 'rr_type', 'rr_value', 'timestamp')
+
+    FIELDS = __slots__
+
+    def __init__(
+            self,
+            id: int = 0,
+            type: LogType = LogType.QUESTION,
+            peer_addr: str = '',
+            peer_port: int = 0,
+            rr_name: str = '',
+            rr_class: int = 1,
+            rr_type: int = 1,
+            rr_value: str = '',
+            timestamp: typing.Optional[int] = None
+    ):
+        self.id = id
+        self.type = type
+        self.peer_addr = peer_addr
+        self.peer_port = peer_port
+        self.rr_name = rr_name
+        self.rr_class = rr_class
+        self.rr_type = rr_type
+        self.rr_value = rr_value
+        self.timestamp = current_time() if timestamp is None else timestamp
+
+    def __repr__(self):
+        return f'LogItem({", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS)})'
+
+    def row(self) -> tuple:
+        """Values in FIELDS order as written to the csv file."""
+        return (self.id, LogType(self.type).name, self.peer_addr, self.peer_port, self.rr_name,
+                qclass_name(self.rr_class), qtype_name(self.rr_type), self.rr_value, self.timestamp)
+
+
+# Ring layout: global header, then per slot a header and its data
+RING_HEADER = struct.Struct('<QQQQ')  # closed, slot count, slot size, items of processes without a slot
+SLOT_HEADER = struct.Struct('<QQQQ')  # head (producer), tail (consumer), dropped (producer), owner pid
+POSITION = struct.Struct('<Q')
+
+# Records: payload length and kind, followed by the payload
+RECORD_HEADER = struct.Struct('<HB')
+KIND_PAD = 0
+KIND_ITEM = 1
+KIND_STRING = 2
+KIND_RESET = 3
+# id, type, peer_port, rr_class, rr_type, string ids of peer_addr, rr_name and rr_value, timestamp
+ITEM = struct.Struct('<IBHHH3Iq')
+STRING_ID = struct.Struct('<I')
+
+_rings: dict[str, 'LogRing'] = {}
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _attach(name: str) -> 'LogRing':
+    ring = _rings.get(name)
+    if ring is None:
+        raise RuntimeError(f'Log ring {name} is not inherited by this process')
+    return ring
+
+
+class LogRing:
+    """Shared memory ring buffers carrying log items to `log_to_file`.
+
+    Every producing process claims a slot of its own, so a slot has exactly
+    one writer and one reader and moves its head and tail without locks (the
+    lock is only taken once per process to claim the slot). Items are packed
+    into fixed-width records; their strings are interned per slot and sent
+    once as separate records. If a slot is full the item is dropped and
+    counted.
+
+    Processes must be forked after the ring is created. Pickling the ring
+    (e.g. as a pool task argument) refers to the inherited instance.
+    """
+
+    def __init__(self, slots: int, slot_size: int):
+        self._shm = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + slots * (SLOT_HEADER.size + slot_size))
+        self.name = self._shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        RING_HEADER.pack_into(self._shm.buf, 0, 0, slots, slot_size, 0)
+        self._claim_lock = Lock()
+        # Producer state of this process
+        self._pid = None
+        self._slot = None
+        self._strings: dict[str, int] = {}
+        _rings[self.name] = self
+
+    def __reduce__(self):
+        return _attach, (self.name,)
+
+    def _offset(self, slot: int) -> int:
+        return RING_HEADER.size + slot * (SLOT_HEADER.size + self.slot_size)
+
+    def _claim(self):
+        self._pid = os.getpid()
+        self._slot = None
+        self._strings = {}
+        buf = self._shm.buf
+        with self._claim_lock:
+            for slot in range(self.slots):
+                offset = self._offset(slot)
+                owner = SLOT_HEADER.unpack_from(buf, offset)[3]
+                if owner == 0 or not process_alive(owner):
+                    head = SLOT_HEADER.unpack_from(buf, offset)[0]
+                    POSITION.pack_into(buf, offset + 24, self._pid)
+                    # Start with a reset so the reader drops the strings of a previous owner
+                    self._slot = slot
+                    self._write([(KIND_RESET, b'')], head)
+                    return
+        logging.warning(f'No free log ring slot for process {self._pid}, its log items are dropped')
+
+    def put(self, item: LogItem):
+        if self._pid != os.getpid():
+            self._claim()
+        if self._slot is None:
+            with self._claim_lock:
+                POSITION.pack_into(self._shm.buf, 24, POSITION.unpack_from(self._shm.buf, 24)[0] + 1)
+            return
+
+        records = []
+        strings = self._strings
+        if len(strings) + 3 > INTERN_LIMIT:
+            strings.clear()
+            records.append((KIND_RESET, b''))
+        ids = []
+        new = []
+        for value in (item.peer_addr, item.rr_name, item.rr_value):
+            value = str(value)
+            string_id = strings.get(value)
+            if string_id is None:
+                string_id = len(strings)
+                strings[value] = string_id
+                new.append(value)
+                records.append((KIND_STRING, STRING_ID.pack(string_id) + value.encode()))
+            ids.append(string_id)
+        records.append((KIND_ITEM, ITEM.pack(item.id, item.type, item.peer_port, item.rr_class, item.rr_type, *ids, item.timestamp)))
+
+        head = POSITION.unpack_from(self._shm.buf, self._offset(self._slot))[0]
+        if not self._write(records, head):
+            # The strings never reached the reader
+            for value in new:
+                del strings[value]
+            dropped_offset = self._offset(self._slot) + 16
+            POSITION.pack_into(self._shm.buf, dropped_offset, POSITION.unpack_from(self._shm.buf, dropped_offset)[0] + 1)
+
+    def _write(self, records: list[tuple[int, bytes]], head: int) -> bool:
+        buf = self._shm.buf
+        offset = self._offset(self._slot)
+        data = offset + SLOT_HEADER.size
+        size = self.slot_size
+        tail = POSITION.unpack_from(buf, offset + 8)[0]
+
+        # Records do not wrap around, the space left at the end of the slot is skipped
+        end = head
+        for _, payload in records:
+            length = RECORD_HEADER.size + len(payload)
+            if end % size + length > size:
+                end += size - end % size
+            end += length
+        if end - tail > size:
+            return False
+
+        position = head
+        for kind, payload in records:
+            length = RECORD_HEADER.size + len(payload)
+            index = position % size
+            if index + length > size:
+                if size - index >= RECORD_HEADER.size:
+                    RECORD_HEADER.pack_into(buf, data + index, 0, KIND_PAD)
+                position += size - index
+                index = 0
+            RECORD_HEADER.pack_into(buf, data + index, len(payload), kind)
+            buf[data + index + RECORD_HEADER.size:data + index + length] = payload
+            position += length
+        # Publish the records only once they are complete
+        POSITION.pack_into(buf, offset, position)
+        return True
+
+    def close(self):
+        """Tell the reader that no more items follow."""
+        POSITION.pack_into(self._shm.buf, 0, 1)
+
+    def closed(self) -> bool:
+        return POSITION.unpack_from(self._shm.buf, 0)[0] != 0
+
+    def pending(self) -> int:
+        """Bytes written to the slots and not yet read."""
+        buf = self._shm.buf
+        return sum(head - tail for head, tail, *_ in (SLOT_HEADER.unpack_from(buf, self._offset(slot)) for slot in range(self.slots)))
+
+    def dropped(self) -> int:
+        """Items dropped because a slot was full or no slot was free."""
+        buf = self._shm.buf
+        return POSITION.unpack_from(buf, 24)[0] + sum(SLOT_HEADER.unpack_from(buf, self._offset(slot))[2] for slot in range(self.slots))
+
+    def unlink(self):
+        _rings.pop(self.name, None)
+        self._shm.close()
+        self._shm.unlink()
+
+
+class LogReader:
+    """Drains all slots of a `LogRing` and restores the log items."""
+
+    def __init__(self, ring: LogRing):
+        self._ring = ring
+        self._strings: list[list[str]] = [[] for _ in range(ring.slots)]
+
+    def drain(self) -> list[LogItem]:
+        """Items written since the last call."""
+        ring = self._ring
+        buf = ring._shm.buf
+        size = ring.slot_size
+        items = []
+        for slot in range(ring.slots):
+            offset = ring._offset(slot)
+            head, tail = SLOT_HEADER.unpack_from(buf, offset)[:2]
+            if head == tail:
+                continue
+            data = offset + SLOT_HEADER.size
+            strings = self._strings[slot]
+            while tail < head:
+                index = tail % size
+                if size - index < RECORD_HEADER.size:
+                    tail += size - index
+                    continue
+                length, kind = RECORD_HEADER.unpack_from(buf, data + index)
+                if kind == KIND_PAD:
+                    tail += size - index
+                    continue
+                payload = data + index + RECORD_HEADER.size
+                if kind == KIND_ITEM:
+                    id, type, peer_port, rr_class, rr_type, peer_addr, rr_name, rr_value, timestamp = ITEM.unpack_from(buf, payload)
+                    items.append(LogItem(id, type, strings[peer_addr], peer_port, strings[rr_name], rr_class, rr_type,
+                                         strings[rr_value], timestamp))
+                elif kind == KIND_STRING:
+                    string_id = STRING_ID.unpack_from(buf, payload)[0]
+                    value = bytes(buf[payload + STRING_ID.size:payload + length]).decode()
+                    if string_id == len(strings):
+                        strings.append(value)
+                    else:
+                        strings[string_id] = value
+                elif kind == KIND_RESET:
+                    strings.clear()
+                tail += RECORD_HEADER.size + length
+            POSITION.pack_into(buf, offset + 8, tail)
+        return items
+
+
+def log_to_file(csv_file: str, ring: LogRing, arrow_file: typing.Optional[str] = None,
+                flush_interval: float = FLUSH_INTERVAL, metrics=None):
+    # Imported here as these modules import this one
+    from metrics import STAGE_DURATION
+
+    reader = LogReader(ring)
+    arrow = None
+    if arrow_file:
+        from columnar import ArrowLogWriter
+        arrow = ArrowLogWriter(arrow_file)
+
+    try:
+        with open(csv_file, "w", newline="") as file:
+            writer = csv.writer(file, dialect="unix")
+            writer.writerow(LogItem.FIELDS)
             file.flush()
+
+            last_flush = time.monotonic()
+            reported = 0
+            while True:
+                closed = ring.closed()
+                items = reader.drain()
+                if items:
+                    start = time.perf_counter_ns()
+                    writer.writerows(item.row() for item in items)
+                    if arrow:
+                        arrow.write(items)
+                    if metrics:
+                        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'log_write')
+                now = time.monotonic()
+                if now - last_flush >= flush_interval:
+                    file.flush()
+                    last_flush = now
+                    dropped = ring.dropped()
+                    if dropped > reported:
+                        logging.warning(f'Log ring overflow: {dropped - reported} log items dropped ({dropped} in total)')
+                        reported = dropped
+                if closed:
+                    break
+                if not items:
+                    time.sleep(POLL_INTERVAL)
+    finally:
+        if arrow:
+            arrow.close()
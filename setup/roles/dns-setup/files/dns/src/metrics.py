@@ -0,0 +1,284 @@
+from multiprocessing import Lock, shared_memory
+
+from logger import process_alive
+
+import bisect
+import http.server
+import logging
+import os
+import socket
+import typing
+
+
+class Counter:
+    """Metric summed over all processes, optionally split by the values of one label.
+
+    Values which are not listed are counted under the last one (e.g. 'other').
+    """
+    kind = 'counter'
+    scale = 1
+
+    def __init__(self, name: str, help: str, label: typing.Optional[str] = None, values: typing.Sequence = ()):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = tuple(values) or (None,)
+        self._positions = {value: n for n, value in enumerate(self.values)}
+        self.offset = 0
+
+    @property
+    def width(self) -> int:
+        return 1
+
+    @property
+    def size(self) -> int:
+        return len(self.values) * self.width
+
+    def index(self, value=None) -> int:
+        return self.offset + self._positions.get(value, len(self.values) - 1) * self.width
+
+    def labels(self, value, extra: str = '') -> str:
+        pairs = [f'{self.label}="{value}"'] if self.label else []
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Gauge(Counter):
+    """Last value set by any process (the maximum over the processes is exported)."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, label: typing.Optional[str] = None, values: typing.Sequence = (),
+                 scale: float = 1):
+        super().__init__(name, help, label, values)
+        self.scale = scale
+
+
+class Histogram(Counter):
+    """Observations counted in buckets by upper bound, plus their count and sum (kept in nanounits)."""
+    kind = 'histogram'
+    scale = 1e-9
+
+    def __init__(self, name: str, help: str, buckets: typing.Sequence[float], label: typing.Optional[str] = None,
+                 values: typing.Sequence = ()):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, label, values)
+
+    @property
+    def width(self) -> int:
+        # Buckets, +Inf bucket, sum
+        return len(self.buckets) + 2
+
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1)
+LATENESS_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+DELAY_BUCKETS = (0, 0.01, 0.025, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10)
+QTYPES = ('A', 'AAAA', 'NS', 'SOA', 'MX', 'TXT', 'HTTPS', 'SVCB', 'CNAME', 'PTR', 'SRV', 'ANY', 'other')
+RCODES = ('NOERROR', 'NXDOMAIN', 'REFUSED', 'other')
+RCODE_NAMES = {0: 'NOERROR', 3: 'NXDOMAIN', 5: 'REFUSED'}
+STAGES = ('question', 'answer', 'send', 'log_write', 'results_write')
+PROFILE_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.01, 0.1)
+# Stages of a sampled query (--profile): parsing the packet, the question (incl. logging it), matching the zone,
+# rendering the answer (incl. logging it), sending it, completing its record and queueing it for the results writer
+PROFILE_STAGES = ('parse', 'question', 'match', 'render', 'send', 'record', 'results_put')
+
+QUERIES = Counter('dns_queries_total', 'Queries received by query type', 'qtype', QTYPES)
+RESPONSES = Counter('dns_responses_total', 'Responses sent by response code', 'rcode', RCODES)
+DELEGATIONS = Counter('dns_delegations_total', 'Responses delegating to a delayed name server')
+MALFORMED = Counter('dns_malformed_queries_total', 'Datagrams which could not be parsed')
+DROPPED = Counter('dns_dropped_queries_total', 'Queries dropped without an answer')
+RATE_LIMITED = Counter('dns_rate_limited_queries_total', 'Queries over the rate limit of their source prefix', 'action',
+                       ('dropped', 'truncated'))
+RATE_LIMITED_DELAYED = Counter('dns_rate_limited_delayed_queries_total',
+                               'Delayed queries over the delayed budget of their source prefix', 'action',
+                               ('dropped', 'truncated'))
+RATE_LIMIT_PREFIXES = Gauge('dns_rate_limit_prefixes', 'Source prefixes tracked by the rate limiter (largest table of a process)')
+SEND_ERRORS = Counter('dns_send_errors_total', 'Answers which could not be sent')
+QUERY_DELAY = Histogram('dns_query_delay_seconds', 'Delay requested for the answer of a query', DELAY_BUCKETS)
+LATENESS = Histogram('dns_answer_lateness_seconds', 'Time an answer was sent after it was due', LATENESS_BUCKETS)
+STAGE_DURATION = Histogram('dns_stage_duration_seconds', 'Duration of the processing stages', LATENCY_BUCKETS,
+                           'stage', STAGES)
+POOL_SUBMITTED = Counter('dns_pool_tasks_submitted_total', 'Queries handed to the worker pool')
+POOL_COMPLETED = Counter('dns_pool_tasks_completed_total', 'Queries finished by the worker pool')
+ZONE_RELOADS = Counter('dns_zone_reloads_total', 'Zone reloads (of every serving process)')
+ZONE_RELOAD_FAILURES = Counter('dns_zone_reload_failures_total', 'Zone reloads which failed')
+ZONE_RELOAD_DURATION = Gauge('dns_zone_reload_duration_seconds', 'Duration of the last zone reload', scale=1e-9)
+ZONE_RECORDS = Gauge('dns_zone_records', 'Records of the loaded zone')
+ZONE_BYTES = Gauge('dns_zone_bytes', 'Size of the loaded zone file')
+TCP_CONNECTIONS = Counter('dns_tcp_connections_total', 'TCP connections accepted')
+TCP_OPEN_CONNECTIONS = Gauge('dns_tcp_open_connections', 'Open TCP connections')
+TCP_CLOSED = Counter('dns_tcp_connections_closed_total', 'TCP connections closed by the server', 'reason',
+                     ('idle', 'limit'))
+PROFILE_SAMPLES = Counter('dns_profile_samples_total', 'Queries whose stages were timed (--profile)')
+PROFILE_STAGE_DURATION = Histogram('dns_profile_stage_seconds', 'Duration of the stages of sampled queries (--profile)',
+                                   PROFILE_BUCKETS, 'stage', PROFILE_STAGES)
+RETRANSMITS = Counter('dns_retransmits_coalesced_total', 'Retransmitted queries answered with their pending first copy')
+COLLECTOR_BATCHES = Counter('dns_collector_batches_total', 'Batches of query records for the collector by what became of '
+                            'them', 'result', ('sent', 'spooled', 'replayed', 'rejected', 'dropped'))
+COLLECTOR_RECORDS = Counter('dns_collector_records_total', 'Query records taken by the collector')
+COLLECTOR_SPOOL_BYTES = Gauge('dns_collector_spool_bytes', 'Batches spooled while the collector could not be reached')
+
+DNS_METRICS = [
+    QUERIES, RESPONSES, DELEGATIONS, MALFORMED, DROPPED, SEND_ERRORS, QUERY_DELAY, LATENESS, STAGE_DURATION,
+    POOL_SUBMITTED, POOL_COMPLETED, ZONE_RELOADS, ZONE_RELOAD_FAILURES, ZONE_RELOAD_DURATION, ZONE_RECORDS, ZONE_BYTES,
+    TCP_CONNECTIONS, TCP_OPEN_CONNECTIONS, TCP_CLOSED, RATE_LIMITED, RATE_LIMITED_DELAYED, RATE_LIMIT_PREFIXES,
+    PROFILE_SAMPLES, PROFILE_STAGE_DURATION, RETRANSMITS, COLLECTOR_BATCHES, COLLECTOR_RECORDS, COLLECTOR_SPOOL_BYTES,
+]
+
+SLOT_HEADER = 8  # owner pid
+
+_tables: dict[str, 'Metrics'] = {}
+
+
+def _attach(name: str) -> 'Metrics':
+    table = _tables.get(name)
+    if table is None:
+        raise RuntimeError(f'Metrics {name} are not inherited by this process')
+    return table
+
+
+class Metrics:
+    """Counters, gauges and histograms updated by all server processes.
+
+    Like the `LogRing`, every process claims a slot of its own in shared
+    memory (taking the lock once) and updates its values there without
+    locking; the exporter adds up the slots. The slot of a process which
+    exited is taken over with its values, so counters never decrease.
+
+    Processes must be forked after the table is created. Pickling refers to
+    the inherited instance.
+    """
+
+    def __init__(self, metrics: list[Counter], slots: int):
+        self.metrics = metrics
+        offset = 0
+        for metric in metrics:
+            metric.offset = offset
+            offset += metric.size
+        self.slot_size = SLOT_HEADER + offset * 8
+        self.slots = slots
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * self.slot_size)
+        self.name = self._shm.name
+        self._claim_lock = Lock()
+        self._pid = None
+        self._values = None
+        _tables[self.name] = self
+
+    def __reduce__(self):
+        return _attach, (self.name,)
+
+    def _slot(self, slot: int) -> memoryview:
+        return self._shm.buf[slot * self.slot_size + SLOT_HEADER:(slot + 1) * self.slot_size].cast('Q')
+
+    def _claim(self):
+        self._pid = os.getpid()
+        buf = self._shm.buf
+        with self._claim_lock:
+            for slot in range(self.slots):
+                owner = int.from_bytes(buf[slot * self.slot_size:slot * self.slot_size + SLOT_HEADER], 'little')
+                if owner == 0 or not process_alive(owner):
+                    buf[slot * self.slot_size:slot * self.slot_size + SLOT_HEADER] = self._pid.to_bytes(SLOT_HEADER, 'little')
+                    self._values = self._slot(slot)
+                    return
+        logging.warning(f'No free metrics slot for process {self._pid}, its metrics are not exported')
+        self._values = memoryview(bytearray(self.slot_size - SLOT_HEADER)).cast('Q')
+
+    def values(self) -> memoryview:
+        """The values of this process."""
+        if self._pid != os.getpid():
+            self._claim()
+        return self._values
+
+    def inc(self, metric: Counter, value=None, amount: int = 1):
+        self.values()[metric.index(value)] += amount
+
+    def set(self, metric: Gauge, number: float, value=None):
+        self.values()[metric.index(value)] = max(int(number / metric.scale), 0)
+
+    def observe(self, metric: Histogram, number: float, value=None):
+        """Count an observation (in seconds or another base unit, negative ones count as 0)."""
+        values = self.values()
+        index = metric.index(value)
+        number = max(number, 0)
+        values[index + bisect.bisect_left(metric.buckets, number)] += 1
+        values[index + len(metric.buckets) + 1] += int(number * 1e9)
+
+    def totals(self) -> list[int]:
+        """Values summed over all slots (gauges: their maximum)."""
+        slots = [self._slot(slot).tolist() for slot in range(self.slots)]
+        totals = [sum(column) for column in zip(*slots)]
+        for metric in self.metrics:
+            if metric.kind == 'gauge':
+                for n in range(metric.offset, metric.offset + metric.size):
+                    totals[n] = max(values[n] for values in slots)
+        return totals
+
+    def total(self, metric: Counter, value=None) -> int:
+        return self.totals()[metric.index(value)]
+
+    def render(self, extra: typing.Iterable[tuple[str, str, str, float]] = ()) -> str:
+        """The metrics in the Prometheus text format, followed by (name, help, type, value) of `extra`."""
+        totals = self.totals()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for value in metric.values:
+                index = metric.index(value)
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{metric.labels(value)} {_number(totals[index] * metric.scale)}')
+                    continue
+                count = 0
+                for n, bound in enumerate(metric.buckets + (float('inf'),)):
+                    count += totals[index + n]
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{_number(bound)}"'
+                    lines.append(f'{metric.name}_bucket{metric.labels(value, le)} {count}')
+                lines.append(f'{metric.name}_sum{metric.labels(value)} {_number(totals[index + len(metric.buckets) + 1] * metric.scale)}')
+                lines.append(f'{metric.name}_count{metric.labels(value)} {count}')
+        for name, help, kind, number in extra:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {_number(number)}']
+        return '\n'.join(lines) + '\n'
+
+    def unlink(self):
+        _tables.pop(self.name, None)
+        self._values = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _number(number: float) -> str:
+    return str(int(number)) if float(number).is_integer() else repr(round(float(number), 9))
+
+
+def serve_metrics(address: str, port: int, metrics: Metrics,
+                  collect: typing.Callable[[], typing.Iterable[tuple[str, str, str, float]]] = lambda: ()):
+    """Serve the metrics in the Prometheus text format on http://address:port/metrics.
+
+    `collect` adds values read at scrape time, as (name, help, type, value).
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render(collect()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(http.server.ThreadingHTTPServer):
+        address_family = socket.AF_INET6 if ':' in address else socket.AF_INET
+
+    with Server((address, port), Handler) as server:
+        logging.info(f'Serving metrics on {address} port {port}')
+        try:
+            server.serve_forever()
+        except SystemExit:
+            pass
@@ -0,0 +1,154 @@
+from metrics import Metrics, PROFILE_SAMPLES, PROFILE_STAGE_DURATION
+
+import cProfile
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import typing
+
+
+SAMPLE_RATE = 0.01
+STACK_INTERVAL = 0.01
+STACK_FORMATS = ('folded', 'cprofile', 'none')
+PROFILE_DIR = '/tmp/dns-profile'
+
+
+class Stages:
+    """Clock of one sampled query, every mark observes the time since the previous one."""
+    __slots__ = ('_metrics', '_last')
+
+    def __init__(self, metrics: Metrics):
+        self._metrics = metrics
+        self._last = time.perf_counter_ns()
+
+    def mark(self, stage: str):
+        now = time.perf_counter_ns()
+        self._metrics.observe(PROFILE_STAGE_DURATION, (now - self._last) / 1e9, stage)
+        self._last = now
+
+    def restart(self):
+        """Leave the time since the last mark out (e.g. the delay of the answer)."""
+        self._last = time.perf_counter_ns()
+
+
+class StageSampler:
+    """Picks every n-th query of a process (n = 1 / rate) to have its stages timed."""
+
+    def __init__(self, metrics: Metrics, rate: float = SAMPLE_RATE):
+        self._metrics = metrics
+        self._every = max(round(1 / rate), 1) if rate > 0 else 0
+        self._count = 0
+
+    def start(self) -> typing.Optional[Stages]:
+        if not self._every:
+            return None
+        self._count += 1
+        if self._count < self._every:
+            return None
+        self._count = 0
+        self._metrics.inc(PROFILE_SAMPLES)
+        return Stages(self._metrics)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackProfiler:
+    """Stack profile of the main thread of a process, written to `directory` on SIGUSR1.
+
+    'folded' samples the stack every `interval` seconds from a thread and
+    writes collapsed stacks (one `root;...;leaf count` line per stack, as
+    read by flamegraph.pl or speedscope), 'cprofile' traces every call and
+    writes a pstats file. Every write starts a new profile. The signal is
+    passed on to the child processes, so one signal to the server profiles
+    all its workers; processes which do not profile have to ignore it.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, format: str = 'folded', interval: float = STACK_INTERVAL):
+        self.directory = directory
+        self.format = format
+        self.interval = interval
+        self._thread_id = None
+        self._stacks: dict[str, int] = {}
+        self._profile: typing.Optional[cProfile.Profile] = None
+        self._started = 0.0
+
+    def start(self):
+        """Start profiling the calling (main) thread of this process."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread_id = threading.get_ident()
+        # A forked process starts with a profile of its own
+        self._stacks = {}
+        self._started = time.time()
+        if self.format == 'folded':
+            threading.Thread(target=self._sample, name='stack-sampler', daemon=True).start()
+        elif self.format == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        signal.signal(signal.SIGUSR1, self._signal)
+
+    def _sample(self):
+        thread_id = self._thread_id
+        while True:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                stacks = self._stacks
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+    def _signal(self, signum, frame):
+        forward(signum)
+        try:
+            self.dump()
+        except OSError as e:
+            logging.error(f'Writing the profile of process {os.getpid()} failed: {e}')
+
+    def dump(self) -> typing.Optional[str]:
+        """Write the profile since the last dump, returns its path."""
+        name = os.path.join(self.directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}')
+        if self.format == 'folded':
+            stacks, self._stacks = self._stacks, {}
+            path = f'{name}.folded'
+            with open(path, 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in stacks.items())
+        elif self.format == 'cprofile':
+            self._profile.disable()
+            path = f'{name}.prof'
+            self._profile.dump_stats(path)
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            return None
+        logging.info(f'Wrote the profile of the last {time.time() - self._started:.0f}s to {path}')
+        self._started = time.time()
+        return path
+
+
+def forward(signum: int):
+    """Pass a signal on to the child processes of this one."""
+    for child in multiprocessing.active_children():
+        try:
+            os.kill(child.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def ignore_profile_signal():
+    """Let SIGUSR1 neither stop this process nor the processes forked from it."""
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+
+def forward_profile_signal():
+    """Pass SIGUSR1 on to the child processes, for a process which does not profile itself."""
+    signal.signal(signal.SIGUSR1, lambda signum, frame: forward(signum))
@@ -0,0 +1,109 @@
+from metrics import Metrics, DROPPED, RATE_LIMIT_PREFIXES, RATE_LIMITED, RATE_LIMITED_DELAYED
+from wire import delayed_query
+
+import collections
+import socket
+import time
+import typing
+
+
+# Queries per second and burst of a source prefix, and of its queries with a delay label. Off by default
+# (RATE 0): a prefix of a public resolver carries many clients, and a shed query changes the answer timing
+# the tests measure
+RATE = 0.0
+BURST = 1000.0
+DELAYED_RATE = 200.0
+DELAYED_BURST = 500.0
+# Every SLIP-th query over the limit is answered truncated (0: drop all)
+SLIP = 2
+TABLE_SIZE = 65_536
+
+ACCEPT = 0
+TRUNCATE = 1
+DROP = 2
+# Sent to one of the dropped local addresses, not rate limited
+BLOCK = 3
+# How a rate limited query is recorded in its query_info
+ACTION_NAMES = {TRUNCATE: 'truncated', DROP: 'dropped'}
+
+V4_MAPPED = bytes(10) + b'\xff\xff'
+
+
+def source_prefix(addr: str) -> bytes:
+    """Key of the /24 (IPv4) or /56 (IPv6) an address belongs to."""
+    packed = socket.inet_pton(socket.AF_INET6, addr.partition('%')[0])
+    if packed[:12] == V4_MAPPED:
+        return packed[12:15]
+    return packed[:7]
+
+
+class RateLimiter:
+    """Token buckets per source prefix, checked before a query is resolved.
+
+    Every prefix has a bucket for all its queries and one for those with a
+    delay label, which hold workers or timers for the length of their delay.
+    Queries over a limit are dropped, except every `slip`-th one which gets
+    an empty truncated answer so that a real resolver retries over TCP.
+    The table keeps the `size` most recently seen prefixes. Queries sent to
+    one of the `drop_local_addresses` are always dropped (BLOCK).
+
+    Every serving process has a table of its own: with N SO_REUSEPORT
+    workers a prefix may send up to N times the limits.
+    """
+
+    def __init__(self, rate: float = RATE, burst: float = BURST, delayed_rate: float = DELAYED_RATE,
+                 delayed_burst: float = DELAYED_BURST, slip: int = SLIP, size: int = TABLE_SIZE,
+                 drop_local_addresses: typing.Iterable[str] = (), metrics: typing.Optional[Metrics] = None):
+        self.rate = rate
+        self.burst = burst
+        self.delayed_rate = delayed_rate
+        self.delayed_burst = delayed_burst
+        self.slip = slip
+        self.size = size
+        self.drop_local_addresses = frozenset(drop_local_addresses)
+        self._metrics = metrics
+        # Prefix: [tokens, delayed tokens, last update, queries over the limit]
+        self._buckets: collections.OrderedDict[bytes, list] = collections.OrderedDict()
+
+    def check(self, packet: bytes, addr: str, local_addr: str, now: typing.Optional[float] = None) -> int:
+        """ACCEPT, TRUNCATE, DROP or BLOCK a query from `addr` to `local_addr`."""
+        metrics = self._metrics
+        if local_addr in self.drop_local_addresses:
+            if metrics:
+                metrics.inc(DROPPED)
+            return BLOCK
+        if self.rate <= 0:
+            return ACCEPT
+
+        now = time.monotonic() if now is None else now
+        buckets = self._buckets
+        prefix = source_prefix(addr)
+        bucket = buckets.get(prefix)
+        if bucket is None:
+            bucket = buckets[prefix] = [self.burst, self.delayed_burst, now, 0]
+            if len(buckets) > self.size:
+                buckets.popitem(last=False)
+            elif metrics:
+                metrics.set(RATE_LIMIT_PREFIXES, len(buckets))
+        else:
+            buckets.move_to_end(prefix)
+            elapsed = now - bucket[2]
+            bucket[0] = min(self.burst, bucket[0] + elapsed * self.rate)
+            bucket[1] = min(self.delayed_burst, bucket[1] + elapsed * self.delayed_rate)
+            bucket[2] = now
+
+        delayed = delayed_query(packet)
+        if bucket[0] >= 1 and (not delayed or bucket[1] >= 1):
+            bucket[0] -= 1
+            if delayed:
+                bucket[1] -= 1
+            return ACCEPT
+
+        bucket[3] += 1
+        action = TRUNCATE if self.slip and bucket[3] % self.slip == 0 else DROP
+        if metrics:
+            counter = RATE_LIMITED_DELAYED if delayed and bucket[0] >= 1 else RATE_LIMITED
+            metrics.inc(counter, 'truncated' if action == TRUNCATE else 'dropped')
+            if action == DROP:
+                metrics.inc(DROPPED)
+        return action
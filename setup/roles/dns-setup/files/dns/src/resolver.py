@@ -1,41 +1,85 @@
 from multiprocessing import Queue
 from argparse import Namespace
-from dnslib import DNSRecord, DNSQuestion, DNSLabel, RR, QTYPE, CLASS, RCODE, TXT
-
-from logger import LogItem
-
-import collections
-import ipaddress
-import logging
+from dnslib import DNSRecord, DNSLabel, RR, QTYPE, RCODE, TXT
+from dnslib.dns import DNSError
+
+from addresses import LocalAddress, peer_address
+from logger import LogItem, LogType
+from results import QueryInfo
+from zoneindex import ZoneIndex
+from synthzone import SyntheticIndex
+from answercache import AnswerTemplate, TemplateRecord, pack_name
+from wire import WireQuery, from_record, qtype_name, qclass_name, read_query
+from profiling import Stages
+from dataclasses import dataclass, field
+
+import fnmatch
 import random
+import re
 import typing
-import time
+
+
+@dataclass
+class Query:
+    """State of a lookup between the question and the answer phase."""
+    wire: WireQuery
+    addr: str
+    port: int
+    local: LocalAddress
+    qname: DNSLabel
+    qclass: str
+    qtype: str
+    first_label: str
+    query_info: QueryInfo
+    delay: int = 0
+    # Clock of a query sampled for profiling
+    stages: typing.Optional[Stages] = None
+    # Key of a delayed query in the table of pending queries (see InFlight)
+    inflight: typing.Optional[tuple] = None
+
+
+@dataclass
+class Match:
+    """Records answering a question and how they are placed in the response."""
+    records: list[RR] = field(default_factory=list)
+    delegation: bool = False
+    sendglue: bool = False
+    new_ns_id: str = 'missing'
+    soa: typing.Optional[RR] = None
+    rcode: int = RCODE.NOERROR
+
+
+# Printable ASCII labels which are no IDNA A-labels
+PLAIN_LABEL = re.compile(rb'(?![xX][nN]--)[!-\-/-~]+').fullmatch
 
 
 class Resolver:
 
-    def __init__(self, zone: str, basedomain: str, args: Namespace):
-        """Initialize DNS resolver."""
+    def __init__(self, zone: str, basedomain: str, args: Namespace,
+                 delays: typing.Optional[list[tuple[str, str]]] = None):
+        """Initialize DNS resolver, computing the records of the `delays` table (delay_id, address) if given."""
         self._delay_ipv6 = 0 if args.delay_ipv6 is None else int(args.delay_ipv6)
         self._delay_ipv4 = 0 if args.delay_ipv4 is None else int(args.delay_ipv4)
         self._basedomain = basedomain
+        self._delays = delays
 
-        self._local_ns_ips = args.local_ns_ip
+        self._delegated = re.compile('|'.join([
+            fnmatch.translate(f'*.dns-delay-*.v1-rdns.{basedomain}.'.lower()),
+            fnmatch.translate(f'*.v6ns-only.v1-rdns.{basedomain}.'.lower()),
+        ])).match
 
         self.update_zone(zone)
 
     def update_zone(self, zone: str):
         self._zone = RR.fromZone(zone)
-        # Categorize RRs according to their QTYPE
-        self._rr = collections.defaultdict(list)
-        for rr in self._zone:
-            rtype = QTYPE[rr.rtype]
-            self._rr[rtype].append(rr)
+        self._index = ZoneIndex(self._zone)
+        if self._delays is not None:
+            self._index = SyntheticIndex(self._index, self._delays, self._basedomain)
+        self._answers: dict[tuple, AnswerTemplate] = {}
 
-        # Collect all existing domains and their corresponding SOA record
-        domains: set[DNSLabel] = set([rr.rname for rr in self._zone])
-        self._domains = [(domain, self.find_record(domain, self.SOA)) for domain in domains]
-        # logging.info(f'domains available {self._domains}')
+    @property
+    def zone_size(self) -> int:
+        return len(self._zone)
 
     @property
     def SOA(self) -> list[RR]:
@@ -43,204 +87,189 @@ class Resolver:
 
     def get_records(self, rclass: str, rtype: str) -> list[RR]:
         if rclass == 'IN':
-            try:
-                return self._rr[rtype]
-            except:
-                pass
+            return self._index.records(rtype)
         return []
 
-    def find_record(self, name: DNSLabel, rrs: list[RR]) -> typing.Optional[RR]:
-        matches = list(filter(lambda record: name.idna().endswith(record.rname.idna()), rrs))
-        if len(matches) > 0:
-            # Do we have exact matches?
-            exact = list(filter(lambda record: name == record.rname, matches))
-            if len(exact) > 0:
-                return exact[0]
-            return matches[0]
-        return None
-
-    def _correct_rr(self, rr: RR, qname: DNSLabel) -> RR:
-        return RR(
-            qname,
-            rr.rtype,
-            rr.rclass,
-            rr.ttl,
-            rr.rdata
-        )
-
-    def resolve(
+    def find_records(self, rclass: str, rtype: str, name: DNSLabel) -> list[RR]:
+        """Records of the class and type whose owner matches the name (literally or as glob)."""
+        if rclass == 'IN':
+            return self._index.lookup(name, rtype)
+        return []
+
+    def find_record(self, name: DNSLabel, rtype: str) -> typing.Optional[RR]:
+        """Record of the type owned by the name or by its closest enclosing name (e.g. the SOA)."""
+        return self._index.enclosing(name, rtype)
+
+    def question(
             self,
-            request: DNSRecord,
+            request: typing.Union[WireQuery, DNSRecord],
             log: Queue,
             addr: str,
             port: int,
-            local_addr: str
-    ) -> DNSRecord:
-        """Resolve the DNS request to a DNS response."""
-        reply = request.reply()
-        reply.header.set_ra(False)
-        reply.header.set_ad(False)
-        question: DNSQuestion = request.q
-        local_addr = local_addr if ipaddress.ip_address(local_addr).ipv4_mapped is None else str(ipaddress.ip_address(local_addr).ipv4_mapped)
-
-        orig_qname: DNSLabel = question.qname
-        qname = DNSLabel(orig_qname.idna().lower())
-        qclass: str = CLASS[question.qclass]
-        qtype: str = QTYPE[question.qtype]
+            local: LocalAddress
+    ) -> Query:
+        """Log the question and determine how long its answer has to be delayed (in ms)."""
+        if isinstance(request, DNSRecord):
+            request = from_record(request.pack(), request)
+
+        qname, first_label, query_info = self._record(request, addr, port, local)
+        qclass, qtype = query_info.rr_class, query_info.rr_type
 
         log.put(LogItem(
-            id=request.header.id,
-            type="QUESTION",
+            id=request.id,
+            type=LogType.QUESTION,
             peer_addr=addr,
-            peer_port=str(port),
-            rr_name=qname.idna(),
-            rr_class=qclass,
-            rr_type=qtype,
+            peer_port=port,
+            rr_name=query_info.rr_name,
+            rr_class=request.qclass,
+            rr_type=request.qtype,
         ))
 
-        query_info = {
-            'ns_ip': local_addr,
-            'remote_ip': addr if ipaddress.ip_address(addr).ipv4_mapped is None else str(ipaddress.ip_address(addr).ipv4_mapped),
-            'remote_port': port,
-            'dns_query_id': request.header.id,
-            'rr_name': qname.idna(),
-            'rr_class': qclass,
-            'rr_type': qtype,
-            'answers': []
-        }
-
         delay_ipv6 = self._delay_ipv6
         delay_ipv4 = self._delay_ipv4
+        if query_info.label_delay:
+            if first_label.startswith('v2delay_a-'):
+                delay_ipv4 = query_info.delay_ms
+            else:
+                delay_ipv6 = query_info.delay_ms
+
+        query = Query(request, addr, port, local, qname, qclass, qtype, first_label, query_info)
+        if qtype == 'AAAA' and delay_ipv6 > 0:
+            query.delay = delay_ipv6
+        if qtype == 'A' and delay_ipv4 > 0:
+            query.delay = delay_ipv4
+        return query
+
+    def limited(self, packet: bytes, addr: str, port: int, local: LocalAddress,
+                action: str) -> typing.Optional[QueryInfo]:
+        """Record of a query the rate limiter did not let through (`action` is dropped or truncated)."""
+        try:
+            request = read_query(packet)
+        except DNSError:
+            return None
+        if request is None:
+            return None
+        _, _, query_info = self._record(request, addr, port, local)
+        query_info.rate_limited = action
+        return query_info
+
+    @staticmethod
+    def _record(request: WireQuery, addr: str, port: int, local: LocalAddress) -> tuple[DNSLabel, str, QueryInfo]:
+        """Name, first label and record of a query, with the session id and delay of its name."""
+        labels = request.labels
+        if all(PLAIN_LABEL(label) for label in labels):
+            # Nothing to decode, IDNA would only lower the case
+            qname = DNSLabel(tuple(label.lower() for label in labels))
+            rr_name = b'.'.join(qname.label).decode() + '.'
+        else:
+            qname = DNSLabel(DNSLabel(labels).idna().lower())
+            rr_name = qname.idna()
+
+        query_info = QueryInfo(local.address, peer_address(addr), port, request.id, rr_name,
+                               qclass_name(request.qclass), qtype_name(request.qtype))
 
         first_label = qname.label[0].decode()
         delay_label = None
-        delay_v4 = False
         if first_label.startswith('v2delay_a-'):
             delay_label = first_label[10:]
-            delay_v4 = True
         if first_label.startswith('v2delay_aaaa-'):
             delay_label = first_label[13:]
 
         if delay_label:
             query_id, delay = delay_label.split('_')
-            query_info['id'] = query_id
-            if delay_v4:
-                delay_ipv4 = int(delay)
-            else:
-                delay_ipv6 = int(delay)
-            query_info['delay_ms'] = int(delay)
+            query_info.id = query_id
+            query_info.set_label_delay(int(delay))
 
         if first_label.startswith('id-'):
-            query_info['id'] = first_label.split('-')[1]
-
-        qname = DNSLabel(qname.label)
+            query_info.id = first_label.split('-')[1]
+        return qname, first_label, query_info
 
-        if qtype == 'AAAA' and delay_ipv6 > 0:
-            time.sleep(delay_ipv6 / 1000)
-        if qtype == 'A' and delay_ipv4 > 0:
-            time.sleep(delay_ipv4 / 1000)
+    def _match(self, query: Query) -> Match:
+        """Find the records answering a question and the shape of the response."""
+        qname = query.qname
+        qtype = query.qtype
+        match = Match()
 
-        delegation = False
-        sendglue = False
-        new_ns_id = 'missing'
         # Do not "skip" delayed NS record delegation. Only provide dns delay info from he addresses
-        if (qname.matchGlob(f'*.dns-delay-*.v1-rdns.{self._basedomain}.') or qname.matchGlob(f'*.v6ns-only.v1-rdns.{self._basedomain}.')) and (local_addr in self._local_ns_ips):
-            id_label = first_label
+        if self._delegated(query.query_info.rr_name) and query.local.ns:
+            id_label = query.first_label
             if not id_label.startswith('id-'):
-                reply.header.rcode = RCODE.REFUSED
-                return reply, None
+                match.rcode = RCODE.REFUSED
+                return match
             # qname = DNSLabel(qname.label[1:])
             qtype = 'NS'
-            delegation = True
+            match.delegation = True
             # new_ns_id = random.randint(0, 1_000_000)
-            new_ns_id = id_label.split('-')[1]
-            if new_ns_id.startswith('wg'):
-                sendglue = True
-            reply.header.set_aa(False)
-
-        query_info['delegation'] = delegation
-
-        # Search for matching RRs
-        for rr in self.get_records(qclass, qtype):
-            if qname == rr.rname or qname.matchGlob(rr.rname):
-                crr = self._correct_rr(rr, qname)
-
-                log.put(LogItem(
-                    id=request.header.id,
-                    type="ANSWER" if not delegation else "AUTHORITY",
-                    peer_addr=addr,
-                    peer_port=str(port),
-                    rr_name=crr.rname.idna(),
-                    rr_class=CLASS[crr.rclass],
-                    rr_type=QTYPE[crr.rtype],
-                    rr_value=crr.rdata,
-                ))
-
-                if delegation:
-                    first_label = crr.rdata.get_label().label[0].decode()
-                    if first_label == 'ns1-id---' or first_label == 'ns2-id---':
-                        crr.rdata.set_label([f'{first_label[:7]}{new_ns_id}'.encode(), *crr.rdata.get_label().label[1:]])
-                    logging.info(crr.rdata)
-                    reply.add_auth(crr)
-                else:
-                    reply.add_answer(crr)
-
-                query_info['answers'].append({'rname': crr.rname.idna(), 'rtype': QTYPE[crr.rtype], 'rvalue': str(crr.rdata)})
-
-                # skip these to better track resolvers
-                if sendglue:
-                    # Search for glue records
-                    for other_rr in (self.get_records('IN', 'A') + self.get_records('IN', 'AAAA')):
-                        if rr.rdata.get_label() == other_rr.rname or rr.rdata.get_label().matchGlob(other_rr.rname):
-                            reply.add_ar(other_rr)
-
-        # No RRs found?
-        if not reply.rr and not reply.auth:
-            match = False
-            query_info = None
-            for name, rr in self._domains:
-                if name == qname:
-                    log.put(LogItem(
-                        id=request.header.id,
-                        type="AUTHORITY",
-                        peer_addr=addr,
-                        peer_port=str(port),
-                        rr_name=rr.rname.idna(),
-                        rr_class=CLASS[rr.rclass],
-                        rr_type=QTYPE[rr.rtype],
-                        rr_value=rr.rdata,
-                    ))
-                    reply.add_auth(rr)
-                    match = True
-                    break
+            match.new_ns_id = id_label.split('-')[1]
+            if match.new_ns_id.startswith('wg'):
+                match.sendglue = True
 
+        match.records = self.find_records(query.qclass, qtype, qname)
+        if not match.records:
             # Did any records for the queried domain exist?
-            if not match:
-                # Is the queried domain part of our zone?
-                if self.find_record(qname, self.SOA):
-                    # log.put(LogItem(
-                    #     id=request.header.id,
-                    #     type="NXDOMAIN",
-                    #     peer_addr=addr,
-                    #     peer_port=str(port),
-                    #     rr_name=qname.idna(),
-                    #     rr_class=qclass,
-                    #     rr_type=qtype,
-                    # ))
-                    reply.add_auth(self.find_record(qname, self.SOA))
-                    reply.header.rcode = RCODE.NXDOMAIN
-                    query_info = None
-                else:
-                    # log.put(LogItem(
-                    #     id=request.header.id,
-                    #     type="REFUSED",
-                    #     peer_addr=addr,
-                    #     peer_port=str(port),
-                    #     rr_name=qname.idna(),
-                    #     rr_class=qclass,
-                    #     rr_type=qtype,
-                    # ))
-                    reply.header.rcode = RCODE.REFUSED
-                    query_info = None
-
-        return reply, query_info
+            if self._index.has_name(qname):
+                match.soa = self.find_record(qname, 'SOA')
+            # Is the queried domain part of our zone?
+            if match.soa is None:
+                match.soa = self.find_record(qname, 'SOA')
+                match.rcode = RCODE.NXDOMAIN if match.soa else RCODE.REFUSED
+        return match
+
+    def _glue(self, name: DNSLabel) -> list[RR]:
+        return self.find_records('IN', 'A', name) + self.find_records('IN', 'AAAA', name)
+
+    def answer_packet(self, query: Query, log: Queue) -> tuple[bytes, typing.Optional[QueryInfo]]:
+        """Wire format of the response for a question once its delay has passed.
+
+        Responses are rendered from pre-packed templates which are cached per
+        query shape (matched records, delegation and glue) until the zone changes.
+        """
+        match = self._match(query)
+        if query.stages:
+            query.stages.mark('match')
+        if match.records:
+            key = ('records', match.delegation, match.sendglue, *map(id, match.records))
+        else:
+            key = ('soa', match.delegation, match.rcode, id(match.soa))
+        template = self._answers.get(key)
+        if template is None:
+            template = self._answers[key] = self._template(query, match)
+        return template.render(query, match.new_ns_id, log)
+
+    def _template(self, query: Query, match: Match) -> AnswerTemplate:
+        aa = not match.delegation
+        if match.rcode == RCODE.REFUSED:
+            return AnswerTemplate(aa, RCODE.REFUSED, [], [], [], [], [], None)
+        if not match.records:
+            rr = match.soa
+            log_items = []
+            if match.rcode != RCODE.NXDOMAIN:
+                log_items.append((LogType.AUTHORITY, rr.rname.idna(), rr.rclass, rr.rtype, str(rr.rdata)))
+            return AnswerTemplate(aa, match.rcode, [], [TemplateRecord(rr, pack_name(rr.rname))], [], log_items, [], None)
+
+        records = []
+        glue = []
+        log_items = []
+        answers = []
+        for rr in match.records:
+            log_type = LogType.ANSWER if not match.delegation else LogType.AUTHORITY
+            log_items.append((log_type, None, rr.rclass, rr.rtype, str(rr.rdata)))
+            rename = None
+            rvalue = (str(rr.rdata), None)
+            if match.delegation:
+                label = rr.rdata.get_label()
+                first_label = label.label[0].decode()
+                if first_label == 'ns1-id---' or first_label == 'ns2-id---':
+                    tail = DNSLabel(label.label[1:])
+                    rename = (first_label[:7].encode(), pack_name(tail))
+                    rvalue = (first_label[:7], f'.{tail}')
+                    # Glue is looked up for the renamed target, any session id matches the same records
+                    label = DNSLabel([f'{first_label[:7]}{match.new_ns_id}'.encode(), *label.label[1:]])
+                if match.sendglue:
+                    glue.extend(TemplateRecord(other_rr, pack_name(other_rr.rname)) for other_rr in self._glue(label))
+            records.append(TemplateRecord(rr, None, rename))
+            answers.append((QTYPE[rr.rtype], *rvalue))
+
+        if match.delegation:
+            return AnswerTemplate(aa, 0, [], records, glue, log_items, answers, True)
+        return AnswerTemplate(aa, 0, records, [], [], log_items, answers, False)
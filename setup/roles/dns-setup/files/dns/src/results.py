@@ -0,0 +1,223 @@
+from addresses import LocalAddress
+from collector import CollectorClient
+from metrics import Metrics, STAGE_DURATION
+
+import datetime
+import json
+import logging
+import os
+import queue
+import time
+import typing
+
+
+DNSDATA_FILE = '{date}-dns-results.jsonl'
+
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 1.0
+
+
+class QueryInfo:
+    """Record of one answered query, written as a line of the daily results file."""
+    __slots__ = ('ns_ip', 'remote_ip', 'remote_port', 'dns_query_id', 'rr_name', 'rr_class', 'rr_type', 'answers',
+                 'id', 'label_delay', 'delegation', 'request_time', 'delay_ms', 'request_arrival_time',
+                 'intended_send_time', 'send_time', 'transport', 'retransmit_times', 'rate_limited')
+
+    def __init__(self, ns_ip: str, remote_ip: str, remote_port: int, dns_query_id: int, rr_name: str, rr_class: str,
+                 rr_type: str):
+        self.ns_ip = ns_ip
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.dns_query_id = dns_query_id
+        self.rr_name = rr_name
+        self.rr_class = rr_class
+        self.rr_type = rr_type
+        # (rname, rtype, rvalue)
+        self.answers: list[tuple[str, str, str]] = []
+        self.id: typing.Optional[str] = None
+        # Whether delay_ms was taken from the query name (it then precedes the delegation flag)
+        self.label_delay = False
+        self.delegation: typing.Optional[bool] = None
+        self.request_time: typing.Optional[float] = None
+        self.delay_ms: typing.Optional[int] = None
+        self.request_arrival_time: typing.Optional[float] = None
+        # When the answer was due (arrival plus injected delay) and when it was sent
+        self.intended_send_time: typing.Optional[float] = None
+        self.send_time: typing.Optional[float] = None
+        # Set for queries which did not arrive over UDP
+        self.transport: typing.Optional[str] = None
+        # Arrival of the retransmits answered together with this query
+        self.retransmit_times: list[float] = []
+        # Set for queries the rate limiter dropped or answered truncated instead of answering them
+        self.rate_limited: typing.Optional[str] = None
+
+    def set_label_delay(self, delay_ms: int):
+        self.label_delay = True
+        self.delay_ms = delay_ms
+
+    def to_dict(self) -> dict:
+        """The record with the keys in the order of the results file."""
+        data = {
+            'ns_ip': self.ns_ip,
+            'remote_ip': self.remote_ip,
+            'remote_port': self.remote_port,
+            'dns_query_id': self.dns_query_id,
+            'rr_name': self.rr_name,
+            'rr_class': self.rr_class,
+            'rr_type': self.rr_type,
+            'answers': [{'rname': rname, 'rtype': rtype, 'rvalue': rvalue} for rname, rtype, rvalue in self.answers],
+        }
+        if self.id is not None:
+            data['id'] = self.id
+        if self.label_delay:
+            data['delay_ms'] = self.delay_ms
+        if self.delegation is not None:
+            data['delegation'] = self.delegation
+        if self.request_time is not None:
+            data['request_time'] = self.request_time
+        if self.delay_ms is not None:
+            data['delay_ms'] = self.delay_ms
+        if self.request_arrival_time is not None:
+            data['request_arrival_time'] = self.request_arrival_time
+        if self.intended_send_time is not None:
+            data['intended_send_time'] = self.intended_send_time
+        if self.send_time is not None:
+            data['send_time'] = self.send_time
+        if self.transport is not None:
+            data['transport'] = self.transport
+        if self.retransmit_times:
+            data['retransmits'] = len(self.retransmit_times)
+            data['retransmit_times'] = self.retransmit_times
+        if self.rate_limited is not None:
+            data['rate_limited'] = self.rate_limited
+        return data
+
+
+def complete_query_data(
+        query_data: QueryInfo,
+        local: LocalAddress,
+        request_time: float,
+        intended_send_time: typing.Optional[float] = None,
+        send_time: typing.Optional[float] = None
+) -> QueryInfo:
+    """Add the request timing and the delay of the contacted address to a query record.
+
+    Times are UNIX timestamps, `request_time` is the arrival of the query.
+    """
+    query_data.request_time = request_time
+    query_data.intended_send_time = intended_send_time
+    query_data.send_time = send_time
+    if local.delay_ms is not None:
+        query_data.delay_ms = local.delay_ms
+        query_data.request_arrival_time = query_data.request_time
+        query_data.request_time = query_data.request_time - query_data.delay_ms / 1000
+    elif query_data.delay_ms is None:
+        query_data.delay_ms = 0
+    return query_data
+
+
+class ResultWriter:
+    """Appends query records to the daily `YYYY/MM/<date>-dns-results.jsonl` file.
+
+    The file of the current day stays open and is replaced at midnight.
+    Lines are buffered and written with a single append once `flush_bytes`
+    are pending or `flush` is called, so only complete lines reach the file.
+    Lines that could not be written stay pending for the next flush.
+    Every line is also handed to the `collector` (if any).
+    """
+
+    def __init__(self, output_dir: str, flush_bytes: int = FLUSH_BYTES, metrics: typing.Optional[Metrics] = None,
+                 collector: typing.Optional[CollectorClient] = None):
+        self.output_dir = output_dir
+        self.flush_bytes = flush_bytes
+        self._metrics = metrics
+        self._collector = collector
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._rollover = 0.0
+        self._pending: list[bytes] = []
+        self._pending_size = 0
+        # Pending size that triggers a flush, raised after a failed one so it is not retried for every line
+        self._flush_at = flush_bytes
+
+    def _open(self, now: float):
+        date = datetime.datetime.fromtimestamp(now)
+        month_dir = os.path.join(self.output_dir, date.strftime('%Y/%m'))
+        os.makedirs(month_dir, exist_ok=True)
+        # Unbuffered append: every flush is one write() of whole lines
+        self._file = open(os.path.join(month_dir, DNSDATA_FILE.format(date=date.strftime('%Y-%m-%d'))), 'ab', buffering=0)
+        next_day = date.date() + datetime.timedelta(days=1)
+        self._rollover = datetime.datetime.combine(next_day, datetime.time()).timestamp()
+
+    def write(self, data: QueryInfo):
+        now = time.time()
+        if now >= self._rollover:
+            self.flush()
+            self.close()
+        if self._file is None:
+            self._open(now)
+        line = (json.dumps(data.to_dict()) + '\n').encode()
+        self._pending.append(line)
+        self._pending_size += len(line)
+        if self._collector:
+            self._collector.add(line)
+        if self._pending_size >= self._flush_at:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        start = time.perf_counter_ns()
+        data = memoryview(b''.join(self._pending))
+        written = 0
+        try:
+            # An unbuffered write may be short (e.g. interrupted by a signal)
+            while written < len(data):
+                written += self._file.write(data[written:])
+        except OSError as e:
+            logging.error(f'Could not write the query records to {self._file.name}, keeping '
+                          f'{len(data) - written} bytes for the next flush: {e}')
+            self._pending = [bytes(data[written:])]
+            self._pending_size = len(data) - written
+            self._flush_at = self._pending_size + self.flush_bytes
+            return
+        if self._metrics:
+            self._metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'results_write')
+        self._pending = []
+        self._pending_size = 0
+        self._flush_at = self.flush_bytes
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def write_results(output_dir: str, q, flush_interval: float = FLUSH_INTERVAL, metrics: typing.Optional[Metrics] = None,
+                  collector: typing.Optional[CollectorClient] = None):
+    """Write the query records put on `q` until None is received."""
+    writer = ResultWriter(output_dir, metrics=metrics, collector=collector)
+    if collector:
+        collector.start()
+    deadline = None
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                data = q.get(timeout=timeout)
+            except queue.Empty:
+                writer.flush()
+                deadline = None
+                continue
+            if data is None:
+                break
+            writer.write(data)
+            if deadline is None:
+                deadline = time.monotonic() + flush_interval
+            elif time.monotonic() >= deadline:
+                writer.flush()
+                deadline = None
+    finally:
+        writer.close()
+        if collector:
+            collector.close()
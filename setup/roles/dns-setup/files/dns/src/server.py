@@ -1,26 +1,55 @@
-from multiprocessing import Queue, Pool, Process, Manager
+from multiprocessing import Queue, Pool, Process
+from addresses import AddressTable, LocalAddress
+from inflight import InFlight, Key
 from resolver import Resolver
-from dnslib import DNSRecord
-from logger import log_to_file
+from synthzone import load_delay_table
+from wire import delayed_query, qtype_name, question_key, read_query, truncated_response
+from logger import LogRing, log_to_file
+from metrics import Metrics, serve_metrics, DELEGATIONS, DNS_METRICS, LATENESS, MALFORMED, POOL_COMPLETED, \
+    POOL_SUBMITTED, QUERIES, QUERY_DELAY, RCODE_NAMES, RESPONSES, RETRANSMITS, SEND_ERRORS, STAGE_DURATION
+from profiling import StackProfiler, StageSampler, forward_profile_signal, ignore_profile_signal
+from ratelimit import RateLimiter, ACCEPT, ACTION_NAMES, TRUNCATE
+from collector import CollectorClient
+from results import QueryInfo, complete_query_data, write_results
+from udp import BatchSocket, arrival_time, create_socket, local_address, reply_ancdata
+from zonewatch import ZoneWatcher
+
+import aioserver
+import collector
+import columnar
+import profiling
+import ratelimit
+import tcpserver
 
 import dnslib.dns
+import inflight
 
-import datetime
-import json
+import functools
 import os
+import pickle
+import shutil
+import tempfile
 import textwrap
 import signal
 import socket
 import sys
+import time
 import argparse
 import logging
 import multiprocessing
-import requests
 import ipaddress
+import typing
 
 
-DNSDATA_FILE = '{date}-dns-results.jsonl'
-OUTPUT_DIR = None
+POOL_PROCESSES = 150
+
+# Resolver of a pool worker process and the zone generation it belongs to
+_pool_resolver: typing.Optional[Resolver] = None
+_pool_generation = 0
+# Picks the queries of a pool worker whose stages are timed (--profile)
+_pool_sampler: typing.Optional[StageSampler] = None
+# Results queue of the pool workers, inherited at fork instead of pickled with every task
+_pool_results: typing.Optional[Queue] = None
 
 # https://stackoverflow.com/q/49417041
 class Killer:
@@ -46,80 +75,384 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument("--zonefile", help="path to the DNS zonefile")
     parser.add_argument("--local-ns-ip", nargs="+", help="IP address only used for DNS (not related to HE tests)")
     parser.add_argument("--csv", help="location where to store the csv file containing metadata for all queries")
+    parser.add_argument("--arrow", help="also store the query metadata as Arrow IPC stream at this location (requires pyarrow)")
     parser.add_argument("--output-dir", help="host where to report v2 requests")
     parser.add_argument("--delay-ipv6", help="amount of time (ms) to delay a reply to an AAAA query")
     parser.add_argument("--delay-ipv4", help="amount of time (ms) to delay a reply to an A query")
     parser.add_argument("--v6delay-prefix", help="The prefix where tc delays are configured")
     parser.add_argument("--basedomain", help="The the basedomain where all zones are below")
+    parser.add_argument("--delay-table", help="csv file with the delay_id and address of every delay address, whose "
+                                              "records are then computed instead of read from the zone file")
+    parser.add_argument("--engine", choices=["pool", "asyncio"], default="pool",
+                        help="serve from a pool of worker processes or from a single asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes, each with its own SO_REUSEPORT socket")
+    parser.add_argument("--log-buffer-mb", type=int, default=16,
+                        help="shared memory for query log items not yet written to the csv file")
+    parser.add_argument("--no-tcp", action='store_true', help="do not answer DNS queries over TCP")
+    parser.add_argument("--tcp-idle-timeout", type=float, default=tcpserver.IDLE_TIMEOUT,
+                        help="seconds after which TCP connections without pending queries are closed")
+    parser.add_argument("--tcp-max-connections", type=int, default=tcpserver.MAX_CONNECTIONS,
+                        help="open TCP connections before idle ones are closed for new ones")
+    parser.add_argument("--rate-limit", type=float, default=ratelimit.RATE,
+                        help="queries per second of a source /24 (IPv4) or /56 (IPv6) over UDP, 0 (default) disables the "
+                             "limit. Every --workers process limits on its own, so a prefix may send --workers times "
+                             "as many")
+    parser.add_argument("--rate-limit-burst", type=float, default=ratelimit.BURST,
+                        help="queries a source prefix may send at once")
+    parser.add_argument("--rate-limit-delayed", type=float, default=ratelimit.DELAYED_RATE,
+                        help="queries per second of a source prefix with a delay label")
+    parser.add_argument("--rate-limit-delayed-burst", type=float, default=ratelimit.DELAYED_BURST,
+                        help="queries with a delay label a source prefix may send at once")
+    parser.add_argument("--rate-limit-slip", type=int, default=ratelimit.SLIP,
+                        help="answer every n-th query over the limit with a truncated response, 0 drops all")
+    parser.add_argument("--rate-limit-table-size", type=int, default=ratelimit.TABLE_SIZE,
+                        help="source prefixes tracked per process")
+    parser.add_argument("--no-coalesce", action='store_true',
+                        help="answer every retransmit of a pending query instead of attaching it to the pending answer")
+    parser.add_argument("--retransmit-ttl", type=float, default=inflight.TTL,
+                        help="seconds a query stays pending at most, later retransmits are answered anew")
+    parser.add_argument("--drop-local-address", nargs="*", default=['2001:4ca0:108:42:0:25:4e:ffff'],
+                        help="local addresses whose queries are never answered")
+    parser.add_argument("--collector-url",
+                        help="also send the query records to this /dns-queries endpoint of a results-upload service")
+    parser.add_argument("--collector-token-file", help="file with the bearer token of the collector")
+    parser.add_argument("--collector-spool-dir",
+                        help="where batches wait while the collector is unavailable (default: collector-spool in --output-dir)")
+    parser.add_argument("--collector-batch-bytes", type=int, default=collector.BATCH_BYTES,
+                        help="query record bytes sent to the collector at once")
+    parser.add_argument("--collector-batch-interval", type=float, default=collector.BATCH_INTERVAL,
+                        help="seconds after which pending query records are sent to the collector")
+    parser.add_argument("--collector-spool-mb", type=int, default=collector.SPOOL_LIMIT // 1024 // 1024,
+                        help="spooled batches kept at most, newer ones are dropped")
+    parser.add_argument("--verbose", action='store_true', help="debug logs, including a line for every received query")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this TCP port")
+    parser.add_argument("--metrics-address", default="127.0.0.1", help="address the metrics endpoint listens on")
+    parser.add_argument("--profile", action='store_true',
+                        help="time the processing stages of sampled queries (exported as metrics) and write a stack "
+                             "profile of every server process to --profile-dir on SIGUSR1")
+    parser.add_argument("--profile-sample-rate", type=float, default=profiling.SAMPLE_RATE,
+                        help="share of the queries whose stages are timed")
+    parser.add_argument("--profile-stacks", choices=profiling.STACK_FORMATS, default='folded',
+                        help="stack samples in the collapsed format of flamegraphs, cProfile statistics or none")
+    parser.add_argument("--profile-interval", type=float, default=profiling.STACK_INTERVAL,
+                        help="seconds between two stack samples of a process")
+    parser.add_argument("--profile-dir", default=profiling.PROFILE_DIR, help="directory the stack profiles are written to")
     return parser
 
 
+def rate_limiter(args: argparse.Namespace, metrics: Metrics, rate: typing.Optional[float] = None) -> RateLimiter:
+    rate = args.rate_limit if rate is None else rate
+    return RateLimiter(rate, args.rate_limit_burst, args.rate_limit_delayed, args.rate_limit_delayed_burst,
+                       args.rate_limit_slip, args.rate_limit_table_size, args.drop_local_address, metrics)
+
+
+def stack_profiler(args: argparse.Namespace) -> typing.Optional[StackProfiler]:
+    return StackProfiler(args.profile_dir, args.profile_stacks, args.profile_interval) if args.profile else None
+
+
+def stage_sampler(args: argparse.Namespace, metrics: Metrics) -> typing.Optional[StageSampler]:
+    return StageSampler(metrics, args.profile_sample_rate) if args.profile else None
+
+
+def init_pool_worker(resolver: Resolver, results: Queue, profiler: typing.Optional[StackProfiler] = None,
+                     sampler: typing.Optional[StageSampler] = None):
+    global _pool_resolver, _pool_results, _pool_sampler
+    _pool_resolver = resolver
+    _pool_results = results
+    _pool_sampler = sampler
+    # The pool is stopped by its owner, workers should not run the Killer handler (it can leave the task queue locked)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if profiler:
+        profiler.start()
+
+
+def pool_resolver(generation: int, snapshot: typing.Optional[str]) -> Resolver:
+    """The resolver for the zone generation of a task, loaded from its snapshot once per worker."""
+    global _pool_resolver, _pool_generation
+    if generation != _pool_generation:
+        with open(snapshot, 'rb') as f:
+            _pool_resolver = pickle.load(f)
+        _pool_generation = generation
+    return _pool_resolver
+
+
+class ResolverSnapshots:
+    """Hands reloaded resolvers to the pool workers.
+
+    A new resolver is pickled once to a file of its generation; tasks carry
+    the current generation and its file, and each worker loads the file when
+    it first sees a newer generation.
+    """
+
+    def __init__(self):
+        self._directory = tempfile.mkdtemp(prefix='dns-zone-')
+        self.current: tuple[int, typing.Optional[str]] = (0, None)
+
+    def publish(self, resolver: Resolver):
+        generation = self.current[0] + 1
+        path = os.path.join(self._directory, f'{generation}.pickle')
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(resolver, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(f'{path}.tmp', path)
+        previous = self.current
+        # Single assignment, the receive loop sees either the old or the new generation
+        self.current = (generation, path)
+        # Workers may still be loading the previous generation
+        stale = os.path.join(self._directory, f'{previous[0] - 1}.pickle')
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    def cleanup(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
 def handle_request(
         s: socket.socket,
-        resolver: Resolver,
-        queue: Queue,
+        generation: int,
+        snapshot: typing.Optional[str],
+        queue: LogRing,
+        defer: bool,
+        metrics: Metrics,
         packet: bytes,
         addr: str,
         port: int,
-        local_addr: str,
+        local: LocalAddress,
         ancdata,
-        cur_date: datetime.datetime,
-        v6delay_prefix: ipaddress.IPv6Network
-):
+        arrival: int,
+        arrival_monotonic: float
+) -> typing.Optional[QueryInfo]:
+    """Answer a query in a pool worker, its record is returned to the owner instead of queued with `defer`."""
+    try:
+        stages = _pool_sampler.start() if _pool_sampler else None
+        try:
+            question = read_query(packet)
+        except dnslib.dns.DNSError as e:
+            metrics.inc(MALFORMED)
+            logging.exception(e)
+            return
+
+        if question is None:
+            return
+        if stages:
+            stages.mark('parse')
+        metrics.inc(QUERIES, qtype_name(question.qtype))
+        resolver = pool_resolver(generation, snapshot)
+        start = time.perf_counter_ns()
+        query = resolver.question(question, queue, addr, port, local)
+        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'question')
+        metrics.observe(QUERY_DELAY, query.delay / 1000)
+        if stages:
+            stages.mark('question')
+            query.stages = stages
+        if query.delay > 0:
+            # The deadline counts from the arrival, not from when this worker got the task
+            wait = arrival_monotonic + query.delay / 1000 - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if stages:
+                stages.restart()
+        start = time.perf_counter_ns()
+        answer, query_data = resolver.answer_packet(query, queue)
+        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'answer')
+        if stages:
+            stages.mark('render')
+        metrics.inc(RESPONSES, RCODE_NAMES.get(answer[3] & 0xf))
+        if query_data and query_data.delegation:
+            metrics.inc(DELEGATIONS)
+
+        start = time.perf_counter_ns()
+        try:
+            s.sendmsg([answer], reply_ancdata(ancdata), 0, (addr, port))
+        except OSError as e:
+            metrics.inc(SEND_ERRORS)
+            logging.error(f'Sending answer to {addr} failed: {e}')
+            return
+        send_time = time.time()
+        metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'send')
+        if stages:
+            stages.mark('send')
+        intended_send_time = (arrival + query.delay * 1_000_000) / 1e9
+        metrics.observe(LATENESS, send_time - intended_send_time)
+        if query_data:
+            complete_query_data(query_data, local, arrival / 1e9, intended_send_time, send_time)
+            if stages:
+                stages.mark('record')
+            if defer:
+                return query_data
+            _pool_results.put(query_data)
+            if stages:
+                stages.mark('results_put')
+    finally:
+        metrics.inc(POOL_COMPLETED)
+
+
+def load_zone(zonefile: str) -> str:
+    with open(zonefile, 'r') as f:
+        return ''.join(line for line in f if not line.startswith('#'))
+
+
+def load_resolver(args: argparse.Namespace, zonefile: str) -> Resolver:
+    # The delay table is read again with every zone reload
+    delays = load_delay_table(args.delay_table) if args.delay_table else None
+    return Resolver(textwrap.dedent(load_zone(zonefile)), args.basedomain, args, delays)
+
+
+def record_limited(resolver: Resolver, results, packet: bytes, addr: str, port: int, local: LocalAddress,
+                   request_time: float, action: int):
+    """Record a query shed or answered truncated by the rate limiter (in the serving process)."""
     try:
-        question = DNSRecord.parse(packet)
-    except dnslib.dns.DNSError as e:
+        query_data = resolver.limited(packet, addr, port, local, ACTION_NAMES[action])
+    except Exception as e:
         logging.exception(e)
         return
-
-    if question.header.get_qr() != 0:
-        return
-    answer, query_data = resolver.resolve(question, queue, addr, port, local_addr)
-    s.sendmsg([answer.pack()], ancdata, 0, (addr, port))
     if query_data:
-        query_data['request_time'] = cur_date.timestamp()
-        local_ip = ipaddress.ip_address(local_addr)
-        if local_ip.version == 6 and local_ip in v6delay_prefix:
-            query_data['delay_ms'] = int(local_ip.exploded.split(':')[-1])
-            query_data['request_arrival_time'] = query_data['request_time']
-            query_data['request_time'] = query_data['request_time'] - query_data['delay_ms'] / 1000
-        elif 'delay_ms' not in query_data:
-            query_data['delay_ms'] = 0
+        complete_query_data(query_data, local, request_time)
+        results.put(query_data)
 
-        write_data(query_data)
-    return
 
+def finish_request(inflight: InFlight, key: Key, results: Queue, query_data: typing.Optional[QueryInfo]):
+    """Record a query answered by a pool worker along with the retransmits which arrived meanwhile."""
+    retransmits = inflight.pop(key)
+    if query_data:
+        query_data.retransmit_times = retransmits
+        results.put(query_data)
 
-def write_data(data):
-    date = datetime.datetime.now()
-    date_str = date.strftime('%Y-%m-%d')
-    month_dir = date.strftime('%Y/%m')
-    data_filepath = os.path.join(OUTPUT_DIR, month_dir, DNSDATA_FILE.format(date=date_str))
-    os.makedirs(os.path.join(OUTPUT_DIR, month_dir), exist_ok=True)
 
-    with open(data_filepath, 'a') as f:
-        json.dump(data, f)
-        f.write('\n')
+def serve_pool(
+        s: socket.socket,
+        resolver: Resolver,
+        queue,
+        results,
+        killer: Killer,
+        addresses: AddressTable,
+        zonefile: str,
+        load: typing.Callable[[str], Resolver],
+        metrics: Metrics,
+        limiter: RateLimiter,
+        profiler: typing.Optional[StackProfiler] = None,
+        sampler: typing.Optional[StageSampler] = None,
+        inflight: typing.Optional[InFlight] = None
+):
+    batch = BatchSocket(s)
+    snapshots = ResolverSnapshots()
+    watcher = ZoneWatcher(zonefile, resolver, load, snapshots.publish, lambda r: r.zone_size, metrics)
+
+    with Pool(processes=POOL_PROCESSES, initializer=init_pool_worker, initargs=(resolver, results, profiler, sampler)) as pool:
+        # Started after the workers are forked so none of them inherits a lock held by the thread
+        watcher.start()
+        if profiler:
+            profiler.start()
+        while not killer.kill:
+            try:
+                datagrams = batch.recv(wait=True)
+                if not datagrams:
+                    continue
+                generation, snapshot = snapshots.current
+                if inflight is not None:
+                    inflight.expire()
+                truncated = []
+                for packet, ancdata, addr_info in datagrams:
+                    local = addresses.local(local_address(ancdata))
+                    arrival, arrival_monotonic = arrival_time(ancdata)
+                    addr = addr_info[0]
+                    port = addr_info[1]
+                    if logging.getLogger().isEnabledFor(logging.DEBUG):
+                        logging.debug(f'Connection from {addr} towards {local.address}')
+                    action = limiter.check(packet, addr, local.address)
+                    if action != ACCEPT:
+                        response = truncated_response(packet) if action == TRUNCATE else None
+                        if response:
+                            truncated.append((response, reply_ancdata(ancdata), addr, port))
+                        if action in ACTION_NAMES:
+                            record_limited(resolver, results, packet, addr, port, local, arrival / 1e9, action)
+                        continue
+                    # The delay is only known to the worker, so queries with a delay label are pending until a worker
+                    # answered them (a retransmit of an answered query is only swallowed if the parent lags behind)
+                    question = question_key(packet) if inflight is not None and delayed_query(packet) else None
+                    if question is None:
+                        pool.apply_async(handle_request, (s, generation, snapshot, queue, False, metrics, packet, addr, port, local, ancdata, arrival, arrival_monotonic))
+                    else:
+                        key = (addr, port, question)
+                        if inflight.attach(key, arrival_monotonic, arrival / 1e9):
+                            metrics.inc(RETRANSMITS)
+                            continue
+                        inflight.add(key, arrival_monotonic)
+                        finish = functools.partial(finish_request, inflight, key, results)
+                        pool.apply_async(handle_request, (s, generation, snapshot, queue, True, metrics, packet, addr, port, local, ancdata, arrival, arrival_monotonic),
+                                         callback=finish, error_callback=lambda e, key=key: inflight.pop(key))
+                    # handle_request(s, generation, snapshot, queue, False, metrics, packet, addr, port, local, ancdata, arrival, arrival_monotonic)
+                    metrics.inc(POOL_SUBMITTED)
+                if truncated:
+                    for error in batch.send(truncated):
+                        if error is not None:
+                            metrics.inc(SEND_ERRORS)
+            except SystemExit:
+                pass
+
+        logging.info('Stopping DNS server')
+    watcher.stop()
+    snapshots.cleanup()
+
+
+def serve_worker(
+        args: argparse.Namespace,
+        resolver: Resolver,
+        queue,
+        results,
+        killer: Killer,
+        addresses: AddressTable,
+        load: typing.Callable[[str], Resolver],
+        metrics: Metrics
+):
+    """Serve DNS requests with the configured engine on a socket of this process."""
+    bind_address = '::'
+    bind_port = 53 if not args.port else int(args.port)
 
+    limiter = rate_limiter(args, metrics)
+    profiler = stack_profiler(args)
+    sampler = stage_sampler(args, metrics)
+    # Pending queries of this process, retransmits arrive at the same socket (the kernel hashes the peer)
+    inflight = InFlight(args.retransmit_ttl) if not args.no_coalesce else None
+    with create_socket(bind_address, bind_port, reuse_port=args.workers > 1) as s:
+        if args.engine == 'asyncio':
+            if profiler:
+                profiler.start()
+            aioserver.serve(s, resolver, queue, results, addresses, args.zonefile, load, metrics, limiter, sampler,
+                            inflight)
+            logging.info('Stopping DNS server')
+        else:
+            serve_pool(s, resolver, queue, results, killer, addresses, args.zonefile, load, metrics, limiter,
+                       profiler, sampler, inflight)
+
+
+def serve_tcp(
+        args: argparse.Namespace,
+        resolver: Resolver,
+        queue,
+        results,
+        addresses: AddressTable,
+        load: typing.Callable[[str], Resolver],
+        metrics: Metrics
+):
+    """Serve DNS over TCP in a process of its own, next to the UDP engine."""
+    bind_port = 53 if not args.port else int(args.port)
 
-def load_zone(zonefile):
-    zone = ''
-    try:
-        with open(zonefile, 'r') as f:
-            for line in f:
-                if line.startswith('#'):
-                    continue
-                zone += line
-    except:
-        logging.error('No DNS zone file found!')
-        sys.exit(1)
-    return zone
+    with tcpserver.create_listener('::', bind_port) as s:
+        # Only the dropped local addresses apply to TCP
+        limiter = rate_limiter(args, metrics, rate=0)
+        profiler = stack_profiler(args)
+        if profiler:
+            profiler.start()
+        tcpserver.serve(s, resolver, queue, results, addresses, args.zonefile, load, metrics, limiter,
+                        args.tcp_idle_timeout, args.tcp_max_connections, stage_sampler(args, metrics))
 
 
 def main() -> None:
     parser = init_argparse()
     args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
 
     multiprocessing.log_to_stderr(level=logging.INFO)
@@ -127,73 +460,113 @@ def main() -> None:
     if not args.csv:
         logging.error("No log file location specified!")
         sys.exit(1)
-
-    global OUTPUT_DIR
-    OUTPUT_DIR = args.output_dir
-
-    bind_address = '::'
-    bind_port = 53 if not args.port else int(args.port)
+    if args.arrow and not columnar.available():
+        logging.error("Writing the Arrow query log requires pyarrow!")
+        sys.exit(1)
+    if args.profile and not 0 < args.profile_sample_rate <= 1:
+        logging.error("The profile sample rate has to be between 0 and 1!")
+        sys.exit(1)
+    if args.profile:
+        # Processes forked from here on which do not answer queries keep ignoring the profile signal
+        ignore_profile_signal()
 
     # Allow graceful termination
     killer = Killer()
 
     # Load zone file
-    zone = load_zone(args.zonefile)
-    zone_time = os.path.getmtime(args.zonefile)
-    last_zone_check = datetime.datetime.now()
-
-    resolver = Resolver(textwrap.dedent(zone), args.basedomain, args)
+    load = functools.partial(load_resolver, args)
+    try:
+        resolver = load(args.zonefile)
+    except OSError:
+        logging.error('No DNS zone file found!')
+        sys.exit(1)
 
-    v6delay_prefix = ipaddress.ip_network(args.v6delay_prefix)
+    # Roles of the local addresses, the delay table names the test addresses
+    delays = load_delay_table(args.delay_table) if args.delay_table else ()
+    addresses = AddressTable(ipaddress.ip_network(args.v6delay_prefix), args.local_ns_ip or (), delays)
 
     # Listen for incoming connections
-    logging.info(f'Starting DNS server (listening on {bind_address} port {bind_port})')
+    logging.info(f'Starting DNS server (listening on :: port {args.port or 53}, {args.engine} engine, {args.workers} workers'
+                 f'{"" if args.no_tcp else ", TCP"})')
     logging.info(f'local ns ips {args.local_ns_ip}')
-    with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as s:
-        s.bind((bind_address, bind_port))
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_PKTINFO, 1)
-        s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
-
-        with Manager() as manager:
-            queue = manager.Queue()
-            p = Process(target=log_to_file, args=(args.csv, queue))
-            p.start()
-
-            with Pool(processes=150) as pool:
-                while not killer.kill:
-                    try:
-                        packet, ancdata, _, addr_info = s.recvmsg(4096, 4096)
-                        cur_date = datetime.datetime.now()
-                        if (cur_date - last_zone_check).seconds >= 5:
-                            last_zone_check = cur_date
-                            if os.path.getmtime(args.zonefile) > zone_time:
-                                logging.info(f'Reloading zone due to zone updates')
-                                zone = load_zone(args.zonefile)
-                                resolver.update_zone(zone)
-                                zone_time = os.path.getmtime(args.zonefile)
-                        dst_addr = None
-                        # logging.info(f'{ancdata}')
-                        for cmsg_level, cmsg_type, cmsg_data in ancdata:
-                            if cmsg_level == socket.IPPROTO_IPV6 and cmsg_type == socket.IPV6_PKTINFO:
-                                dst_addr = socket.inet_ntop(socket.AF_INET6, cmsg_data[:16])
-                                break
-                            if cmsg_level == socket.IPPROTO_IP and cmsg_type == socket.IP_PKTINFO:
-                                dst_addr = socket.inet_ntop(socket.AF_INET, cmsg_data[4:8])
-                                break
-                        addr = addr_info[0]
-                        port = addr_info[1]
-                        logging.info(f'Connection from {addr} towards {dst_addr}')
-                        if dst_addr == '2001:4ca0:108:42:0:25:4e:ffff':
-                            continue
-                        pool.apply_async(handle_request, (s, resolver, queue, packet, addr, port, dst_addr, ancdata, cur_date, v6delay_prefix))
-                        # handle_request(s, resolver, queue, packet, addr, port, dst_addr, ancdata, cur_date, v6delay_prefix)
-                    except SystemExit:
-                        pass
-
-                logging.info('Stopping DNS server')
+    if args.profile:
+        logging.info(f'Profiling {args.profile_sample_rate:.2%} of the queries, kill -USR1 {os.getpid()} writes the '
+                     f'stack profiles ({args.profile_stacks}) to {args.profile_dir}')
+    # Every process answering queries (including the TCP server) writes its log items to a slot of its own
+    slots = args.workers * (POOL_PROCESSES if args.engine == 'pool' else 1) + (0 if args.no_tcp else 1)
+    queue = LogRing(slots, args.log_buffer_mb * 1024 * 1024 // slots)
+    # Further slots for the pool owners, the log and the results writer
+    metrics = Metrics(DNS_METRICS, slots + args.workers + 2)
+    results = Queue()
+    p = Process(target=log_to_file, args=(args.csv, queue, args.arrow), kwargs={'metrics': metrics})
+    p.start()
+    collector_client = None
+    if args.collector_url:
+        spool_dir = args.collector_spool_dir or os.path.join(args.output_dir, 'collector-spool')
+        token = collector.read_token(args.collector_token_file) if args.collector_token_file else None
+        collector_client = CollectorClient(args.collector_url, spool_dir, token, args.collector_batch_bytes,
+                                           args.collector_batch_interval, spool_limit=args.collector_spool_mb * 1024 * 1024,
+                                           metrics=metrics)
+        logging.info(f'Sending the query records to the collector {args.collector_url}')
+    results_writer = Process(target=write_results, args=(args.output_dir, results),
+                             kwargs={'metrics': metrics, 'collector': collector_client})
+    results_writer.start()
+
+    def collect():
+        values = [
+            ('dns_log_ring_pending_bytes', 'Query log data not yet written to the csv file', 'gauge', queue.pending()),
+            ('dns_log_items_dropped_total', 'Query log items dropped as the log ring was full', 'counter', queue.dropped()),
+            ('dns_results_queue_depth', 'Query records waiting for the results writer', 'gauge', results.qsize()),
+        ]
+        if args.engine == 'pool':
+            backlog = metrics.total(POOL_SUBMITTED) - metrics.total(POOL_COMPLETED)
+            values.append(('dns_pool_backlog', 'Queries waiting for or handled by a pool worker', 'gauge', backlog))
+        return values
+
+    exporter = None
+    if args.metrics_port:
+        exporter = Process(target=serve_metrics, args=(args.metrics_address, args.metrics_port, metrics, collect))
+        exporter.start()
+
+    tcp = None
+    if not args.no_tcp:
+        tcp = Process(target=serve_tcp, args=(args, resolver, queue, results, addresses, load, metrics))
+        tcp.start()
 
-            p.close()
-            p.join()
+    try:
+        if args.workers > 1:
+            if args.profile:
+                forward_profile_signal()
+            workers = [
+                Process(target=serve_worker, args=(args, resolver, queue, results, killer, addresses, load, metrics))
+                for _ in range(args.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            try:
+                while not killer.kill and all(worker.is_alive() for worker in workers):
+                    time.sleep(1)
+            except SystemExit:
+                pass
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+        else:
+            serve_worker(args, resolver, queue, results, killer, addresses, load, metrics)
+    finally:
+        if tcp:
+            tcp.terminate()
+            tcp.join()
+        if exporter:
+            exporter.terminate()
+            exporter.join()
+        queue.close()
+        results.put(None)
+        p.join()
+        results_writer.join()
+        queue.unlink()
+        metrics.unlink()
 
     del resolver
 
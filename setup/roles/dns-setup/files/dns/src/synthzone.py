@@ -0,0 +1,139 @@
+from dnslib import DNSLabel, RR
+
+from zoneindex import ZoneIndex
+
+import collections
+import csv
+import ipaddress
+import typing
+
+
+# TTL of the computed records, as set for the delay records of the zone templates
+TTL = 300
+HTTPS_RDATA = '1 . alpn=h3,h2'
+
+
+def load_delay_table(path: str) -> list[tuple[str, str]]:
+    """(delay_id, address) rows of a csv file with (at least) these columns."""
+    rows = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            delay_id = (row.get('delay_id') or '').strip()
+            if not delay_id:
+                continue
+            address = row['address'].strip()
+            # Fail on a broken table instead of serving it
+            ipaddress.ip_address(address)
+            rows.append((delay_id, address))
+    return rows
+
+
+class SyntheticIndex:
+    """Zone lookup computing the records of the delay addresses from the delay table.
+
+    Replaces the records the zone templates expand per row of `headdresses`,
+    so the zone file only needs the static records (SOA, NS, ACME, ...):
+
+    - `id-*.delay-<id>.v1` and `ns1-id-*`/`ns2-id-*.delay-<id>.v1-rdns`: A/AAAA of the delay id
+    - `id-*.delay-<id>.v3-quic`: AAAA and HTTPS of the IPv6 addresses of the delay id
+    - `id-*.dns-delay-<id>.v1-rdns`: the NS delegation to `ns1-id---`/`ns2-id---.delay-<id>.v1-rdns`
+      (renamed with the session id by the resolver), the IPv4/IPv6-only addresses and a SOA
+
+    Records are built on first use and kept per delay id, owner pattern and
+    type, so answer templates cache them like zone records. Records of the
+    zone file (the static `index`) take precedence.
+    """
+
+    def __init__(self, index: ZoneIndex, delays: list[tuple[str, str]], basedomain: str):
+        self._index = index
+        self._basedomain = basedomain.strip('.').lower()
+        self._base = tuple(label.encode() for label in self._basedomain.split('.'))
+        # delay id -> (IPv4 addresses, IPv6 addresses) in table order
+        self._addresses: dict[bytes, tuple[list[str], list[str]]] = collections.defaultdict(lambda: ([], []))
+        for delay_id, address in delays:
+            self._addresses[delay_id.lower().encode()][1 if ':' in address else 0].append(address)
+        self._addresses = dict(self._addresses)
+        self._records: dict[tuple[str, bytes, str], list[RR]] = {}
+
+    def records(self, rtype: str) -> list[RR]:
+        """All static records of a QTYPE in zone order."""
+        return self._index.records(rtype)
+
+    def has_name(self, name: DNSLabel) -> bool:
+        return self._index.has_name(name)
+
+    def enclosing(self, name: DNSLabel, rtype: str) -> typing.Optional[RR]:
+        return self._index.enclosing(name, rtype)
+
+    def lookup(self, name: DNSLabel, rtype: str) -> list[RR]:
+        """Records of the zone file, the computed ones if the zone file has none (of the type) for the name."""
+        return self._index.lookup(name, rtype) or self._compute(tuple(label.lower() for label in name.label), rtype)
+
+    def _compute(self, labels: tuple[bytes, ...], rtype: str) -> list[RR]:
+        base = len(self._base)
+        if len(labels) < base + 3 or labels[-base:] != self._base:
+            return []
+        zone, delay_label = labels[-base - 1], labels[-base - 2]
+        # Owner globs match across labels, like those of the zone file
+        prefix = b'.'.join(labels[:-base - 2])
+
+        if delay_label.startswith(b'delay-'):
+            delay_id = delay_label[6:]
+            if zone == b'v1' and prefix.startswith(b'id-'):
+                kind = 'v1'
+            elif zone == b'v3-quic' and prefix.startswith(b'id-'):
+                kind = 'v3-quic'
+            elif zone == b'v1-rdns' and prefix.startswith((b'ns1-id-', b'ns2-id-')):
+                kind = prefix[:3].decode()
+            else:
+                return []
+        elif delay_label.startswith(b'dns-delay-') and zone == b'v1-rdns' and prefix.startswith(b'id-'):
+            delay_id = delay_label[10:]
+            kind = 'dns-delay'
+        else:
+            return []
+        if delay_id not in self._addresses:
+            return []
+
+        key = (kind, delay_id, rtype)
+        records = self._records.get(key)
+        if records is None:
+            records = self._build(kind, delay_id.decode(), rtype)
+            # Types without records are not kept, the queries choose them
+            if records:
+                self._records[key] = records
+        return records
+
+    def _build(self, kind: str, delay_id: str, rtype: str) -> list[RR]:
+        ipv4, ipv6 = self._addresses[delay_id.encode()]
+        base = self._basedomain
+        if kind == 'v1':
+            owner = f'id-*.delay-{delay_id}.v1.{base}.'
+            rdatas = {'A': ipv4, 'AAAA': ipv6}.get(rtype, [])
+        elif kind == 'v3-quic':
+            owner = f'id-*.delay-{delay_id}.v3-quic.{base}.'
+            rdatas = {'AAAA': ipv6, 'HTTPS': [HTTPS_RDATA] * len(ipv6)}.get(rtype, [])
+        elif kind in ('ns1', 'ns2'):
+            owner = f'{kind}-id-*.delay-{delay_id}.v1-rdns.{base}.'
+            rdatas = {'A': ipv4, 'AAAA': ipv6}.get(rtype, [])
+        else:
+            owner = f'id-*.dns-delay-{delay_id}.v1-rdns.{base}.'
+            rdatas = self._dns_delay(delay_id, rtype)
+        return [RR.fromZone(f'{owner} {TTL} IN {rtype} {rdata}')[0] for rdata in rdatas]
+
+    def _dns_delay(self, delay_id: str, rtype: str) -> list[str]:
+        base = self._basedomain
+        if rtype == 'NS':
+            return [f'{ns}-id---.delay-{delay_id}.v1-rdns.{base}.' for ns in ('ns1', 'ns2')]
+        if rtype in ('A', 'AAAA'):
+            # The version-only addresses of the v1-rdns zone
+            only = 'ipv4-only' if rtype == 'A' else 'ipv6-only'
+            return [str(rr.rdata) for rr in self._index.lookup(DNSLabel(f'{only}.v1-rdns.{base}.'), rtype)]
+        if rtype == 'SOA':
+            apex = self._index.lookup(DNSLabel(f'v1-rdns.{base}.'), 'SOA')
+            if not apex:
+                return []
+            # The SOA of the v1-rdns zone, naming the delayed name server
+            _, *rest = str(apex[0].rdata).split()
+            return [' '.join([f'ns1-id---.delay-{delay_id}.v1-rdns.{base}.', *rest])]
+        return []
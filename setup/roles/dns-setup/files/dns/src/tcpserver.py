@@ -0,0 +1,259 @@
+from addresses import AddressTable, UNKNOWN
+from aioserver import DNSEngine
+from metrics import Metrics, SEND_ERRORS, STAGE_DURATION, TCP_CLOSED, TCP_CONNECTIONS, TCP_OPEN_CONNECTIONS
+from profiling import StageSampler
+from ratelimit import RateLimiter, ACCEPT
+from resolver import Resolver, Query
+
+import asyncio
+import logging
+import signal
+import socket
+import struct
+import time
+import typing
+
+
+IDLE_TIMEOUT = 10.0
+MAX_CONNECTIONS = 10_000
+# Queries of a connection waiting for their answer before reading from it is paused
+MAX_PENDING = 128
+SWEEP_INTERVAL = 1.0
+
+LENGTH = struct.Struct('!H')
+
+
+def create_listener(bind_address: str, bind_port: int) -> socket.socket:
+    """Create the dual stack TCP socket."""
+    s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((bind_address, bind_port))
+    s.listen(socket.SOMAXCONN)
+    return s
+
+
+class DNSConnection(asyncio.Protocol):
+    """A TCP connection carrying length-prefixed queries (RFC 7766).
+
+    Queries may be pipelined and every answer is written as soon as it is
+    due, regardless of the queries before it on the connection. A client
+    closing its side still gets the answers it waits for.
+    """
+
+    def __init__(self, server: 'TCPServer'):
+        self._server = server
+        self._transport: typing.Optional[asyncio.Transport] = None
+        self._buffer = bytearray()
+        self._eof = False
+        self._writable = True
+        self._reading = True
+        self.closed = False
+        self.pending = 0
+        self.last_activity = time.monotonic()
+        self.addr = ''
+        self.port = 0
+        self.local = UNKNOWN
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self.addr, self.port = transport.get_extra_info('peername')[:2]
+        self.local = self._server.addresses.local_text(transport.get_extra_info('sockname')[0])
+        self._server.opened(self)
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        self.closed = True
+        self._server.lost(self)
+
+    def data_received(self, data: bytes):
+        arrival = time.time_ns()
+        self.last_activity = arrival_monotonic = time.monotonic()
+        buffer = self._buffer
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= LENGTH.size:
+            end = offset + LENGTH.size + LENGTH.unpack_from(buffer, offset)[0]
+            if end > len(buffer):
+                break
+            self._server.handle(self, bytes(buffer[offset + LENGTH.size:end]), arrival, arrival_monotonic)
+            offset = end
+        del buffer[:offset]
+        self._update_reading()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        # Keep the connection open for the answers still due
+        return self.pending > 0
+
+    def pause_writing(self):
+        self._writable = False
+        self._update_reading()
+
+    def resume_writing(self):
+        self._writable = True
+        self._update_reading()
+
+    def _update_reading(self):
+        reading = self._writable and self.pending < MAX_PENDING
+        if reading != self._reading and not self.closed and not self._eof:
+            self._reading = reading
+            if reading:
+                self._transport.resume_reading()
+            else:
+                self._transport.pause_reading()
+
+    def started(self):
+        self.pending += 1
+
+    def finished(self):
+        self.pending -= 1
+        if self._eof and not self.pending:
+            self.close()
+        else:
+            self._update_reading()
+
+    def send(self, answer: bytes) -> bool:
+        if self.closed:
+            return False
+        self._transport.write(LENGTH.pack(len(answer)) + answer)
+        self.last_activity = time.monotonic()
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._transport.close()
+
+
+class TCPServer:
+    """DNS over TCP listener answering with a `DNSEngine`.
+
+    Delayed answers are scheduled like those of the UDP server. Idle
+    connections (no query waiting for its answer for `idle_timeout` seconds)
+    are closed by a periodic sweep instead of a timer per connection; with
+    `max_connections` open, the longest idle one makes room for a new one.
+    Only the local addresses dropped by the `limiter` apply, TCP needs no
+    rate limit as its sources cannot be spoofed.
+    """
+
+    def __init__(self, engine: DNSEngine, sock: socket.socket, limiter: RateLimiter, idle_timeout: float = IDLE_TIMEOUT,
+                 max_connections: int = MAX_CONNECTIONS):
+        self._engine = engine
+        self.addresses = engine.addresses
+        self._limiter = limiter
+        self._loop = engine._loop
+        self._metrics = engine._metrics
+        self._sock = sock
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self._connections: set[DNSConnection] = set()
+        self._server: typing.Optional[asyncio.AbstractServer] = None
+        self._sweep_handle: typing.Optional[asyncio.TimerHandle] = None
+
+    async def start(self):
+        self._server = await self._loop.create_server(lambda: DNSConnection(self), sock=self._sock, backlog=socket.SOMAXCONN)
+        self._sweep_handle = self._loop.call_later(SWEEP_INTERVAL, self._sweep)
+
+    def stop(self):
+        if self._sweep_handle:
+            self._sweep_handle.cancel()
+        if self._server:
+            self._server.close()
+        for connection in list(self._connections):
+            connection.close()
+
+    def opened(self, connection: DNSConnection):
+        metrics = self._metrics
+        metrics.inc(TCP_CONNECTIONS)
+        if len(self._connections) >= self.max_connections:
+            metrics.inc(TCP_CLOSED, 'limit')
+            idle = [c for c in self._connections if not c.pending]
+            if not idle:
+                connection.close()
+                return
+            oldest = min(idle, key=lambda c: c.last_activity)
+            oldest.close()
+            # Its connection_lost only follows with the next loop iteration
+            self._connections.discard(oldest)
+        self._connections.add(connection)
+        metrics.set(TCP_OPEN_CONNECTIONS, len(self._connections))
+
+    def lost(self, connection: DNSConnection):
+        self._connections.discard(connection)
+        self._metrics.set(TCP_OPEN_CONNECTIONS, len(self._connections))
+
+    def _sweep(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for connection in [c for c in self._connections if not c.pending and c.last_activity <= deadline]:
+            self._metrics.inc(TCP_CLOSED, 'idle')
+            connection.close()
+        self._sweep_handle = self._loop.call_later(SWEEP_INTERVAL, self._sweep)
+
+    def handle(self, connection: DNSConnection, packet: bytes, arrival: int, arrival_monotonic: float):
+        if self._limiter.check(packet, connection.addr, connection.local.address) != ACCEPT:
+            return
+        query = self._engine.question(packet, connection.addr, connection.port, connection.local)
+        if query is None:
+            return
+        query.query_info.transport = 'tcp'
+        connection.started()
+
+        request_time = arrival / 1e9
+        if query.delay > 0:
+            self._loop.call_at(arrival_monotonic + query.delay / 1000, self._reply, connection, query, request_time,
+                               (arrival + query.delay * 1_000_000) / 1e9)
+        else:
+            self._reply(connection, query, request_time, request_time)
+
+    def _reply(self, connection: DNSConnection, query: Query, request_time: float, intended_send_time: float):
+        try:
+            if connection.closed:
+                self._metrics.inc(SEND_ERRORS)
+                return
+            answered = self._engine.answer(query)
+            if answered is None:
+                return
+            answer, query_data = answered
+            start = time.perf_counter_ns()
+            if not connection.send(answer):
+                self._metrics.inc(SEND_ERRORS)
+                return
+            send_time = time.time()
+            self._metrics.observe(STAGE_DURATION, (time.perf_counter_ns() - start) / 1e9, 'send')
+            if query.stages:
+                query.stages.mark('send')
+            self._engine.sent(query_data, query.local, request_time, intended_send_time, send_time, query.stages)
+        finally:
+            connection.finished()
+
+
+def serve(
+        sock: socket.socket,
+        resolver: Resolver,
+        log,
+        results,
+        addresses: AddressTable,
+        zonefile: str,
+        load_resolver: typing.Callable[[str], Resolver],
+        metrics: Metrics,
+        limiter: RateLimiter,
+        idle_timeout: float = IDLE_TIMEOUT,
+        max_connections: int = MAX_CONNECTIONS,
+        sampler: typing.Optional[StageSampler] = None
+):
+    """Serve DNS over TCP on `sock` until SIGINT or SIGTERM is received."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+
+    engine = DNSEngine(loop, resolver, log, results, addresses, zonefile, load_resolver, metrics, sampler)
+    server = TCPServer(engine, sock, limiter, idle_timeout, max_connections)
+    engine.start()
+    loop.run_until_complete(server.start())
+    logging.info(f'Serving DNS over TCP (idle timeout {idle_timeout}s, at most {max_connections} connections)')
+    try:
+        loop.run_forever()
+    finally:
+        server.stop()
+        engine.stop()
+        loop.close()
@@ -0,0 +1,286 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import time
+import typing
+
+
+BATCH_SIZE = 64
+BUFFER_SIZE = 4096
+CONTROL_SIZE = 512
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+MSG_WAITFORONE = 0x10000
+# Linux, the control message carries a struct timespec of the realtime clock
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@qq')
+
+# (packet, ancillary data, address info) as returned by socket.recvmsg
+Datagram = tuple[bytes, list, tuple]
+
+
+def create_socket(bind_address: str, bind_port: int, reuse_port: bool = False) -> socket.socket:
+    """Create the dual stack UDP socket which reports the local address of every datagram.
+
+    With `reuse_port` several processes can bind their own socket to the same
+    port and the kernel spreads the incoming datagrams over them.
+    """
+    s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((bind_address, bind_port))
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_PKTINFO, 1)
+    s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except OSError:
+        # The arrival time is then taken when the datagram is read
+        pass
+    return s
+
+
+def local_address(ancdata) -> typing.Optional[bytes]:
+    """Extract the address a datagram was sent to from its ancillary data (packed, 16 or 4 bytes)."""
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.IPPROTO_IPV6 and cmsg_type == socket.IPV6_PKTINFO:
+            return cmsg_data[:16]
+        if cmsg_level == socket.IPPROTO_IP and cmsg_type == socket.IP_PKTINFO:
+            return cmsg_data[4:8]
+    return None
+
+
+def arrival_time(ancdata) -> tuple[int, float]:
+    """Kernel receive time of a datagram as realtime nanoseconds and on the monotonic clock.
+
+    Delays are scheduled on the monotonic clock, the realtime value is what
+    the results record. Without a kernel timestamp the current time is used.
+    """
+    now = time.time_ns()
+    monotonic = time.monotonic()
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == SCM_TIMESTAMPNS and len(cmsg_data) >= TIMESPEC.size:
+            seconds, nanoseconds = TIMESPEC.unpack_from(cmsg_data)
+            arrival = seconds * 1_000_000_000 + nanoseconds
+            return arrival, monotonic - max(now - arrival, 0) / 1e9
+    return now, monotonic
+
+
+def reply_ancdata(ancdata) -> list:
+    """The ancillary data of a received datagram which selects the source address of its reply."""
+    return [cmsg for cmsg in ancdata if cmsg[0] != socket.SOL_SOCKET]
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    for func in (recvmmsg, sendmmsg):
+        func.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    return libc
+
+
+_libc = _load_libc()
+
+SOCKADDR_IN6 = struct.Struct('!HHI16sI')
+CMSG_HEADER = struct.Struct('@Nii')
+CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+
+
+def _cmsg_align(length: int) -> int:
+    return (length + CMSG_ALIGN - 1) & ~(CMSG_ALIGN - 1)
+
+
+def _parse_control(control: bytes) -> list:
+    ancdata = []
+    offset = 0
+    while offset + CMSG_HEADER.size <= len(control):
+        cmsg_len, cmsg_level, cmsg_type = CMSG_HEADER.unpack_from(control, offset)
+        if cmsg_len < CMSG_HEADER.size:
+            break
+        ancdata.append((cmsg_level, cmsg_type, control[offset + CMSG_HEADER.size:offset + cmsg_len]))
+        offset += _cmsg_align(cmsg_len)
+    return ancdata
+
+
+def _pack_control(ancdata) -> bytes:
+    parts = []
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        length = CMSG_HEADER.size + len(cmsg_data)
+        parts.append(CMSG_HEADER.pack(length, cmsg_level, cmsg_type) + bytes(cmsg_data))
+        parts.append(bytes(_cmsg_align(length) - length))
+    return b''.join(parts)
+
+
+def _parse_address(name: bytes) -> tuple:
+    # sin6_family is in host byte order, everything after it in network byte order
+    _, port, flowinfo, addr, _ = SOCKADDR_IN6.unpack(name)
+    scope_id, = struct.unpack_from('@I', name, 24)
+    return socket.inet_ntop(socket.AF_INET6, addr), port, flowinfo, scope_id
+
+
+def _pack_address(addr: str, port: int) -> bytes:
+    packed = SOCKADDR_IN6.pack(0, port, 0, socket.inet_pton(socket.AF_INET6, addr), 0)
+    return struct.pack('@H', socket.AF_INET6) + packed[2:]
+
+
+class BatchSocket:
+    """Receives and sends batches of datagrams with one system call each.
+
+    Uses recvmmsg/sendmmsg from the C library for the dual stack socket of
+    `create_socket`. Where they are unavailable the batch is drained with
+    recvmsg until the socket would block and sent with one sendmsg each.
+    """
+
+    def __init__(self, sock: socket.socket, batch_size: int = BATCH_SIZE):
+        self.sock = sock
+        self.batch_size = batch_size
+        self._native = _libc is not None and sock.family == socket.AF_INET6
+        if not self._native:
+            return
+
+        self._buffers = (ctypes.c_char * (BUFFER_SIZE * batch_size))()
+        self._controls = (ctypes.c_char * (CONTROL_SIZE * batch_size))()
+        self._names = (ctypes.c_char * (SOCKADDR_IN6.size * batch_size))()
+        self._iovecs = (_IOVec * batch_size)()
+        self._messages = (_MMsgHdr * batch_size)()
+        for i in range(batch_size):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers) + i * BUFFER_SIZE
+            self._iovecs[i].iov_len = BUFFER_SIZE
+            hdr = self._messages[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, wait: bool = False) -> list[Datagram]:
+        """Receive up to `batch_size` datagrams.
+
+        With `wait` block until at least one datagram arrived, otherwise
+        return an empty list if there is none.
+        """
+        if not self._native:
+            return self._recv_fallback(wait)
+
+        base = ctypes.addressof(self._buffers)
+        controls = ctypes.addressof(self._controls)
+        names = ctypes.addressof(self._names)
+        for i in range(self.batch_size):
+            hdr = self._messages[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_IN6.size
+            hdr.msg_namelen = SOCKADDR_IN6.size
+            hdr.msg_control = controls + i * CONTROL_SIZE
+            hdr.msg_controllen = CONTROL_SIZE
+            hdr.msg_flags = 0
+
+        flags = MSG_WAITFORONE if wait else MSG_DONTWAIT
+        count = _libc.recvmmsg(self.sock.fileno(), self._messages, self.batch_size, flags, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        datagrams = []
+        for i in range(count):
+            message = self._messages[i]
+            hdr = message.msg_hdr
+            packet = ctypes.string_at(base + i * BUFFER_SIZE, message.msg_len)
+            control = ctypes.string_at(hdr.msg_control, hdr.msg_controllen)
+            name = ctypes.string_at(hdr.msg_name, SOCKADDR_IN6.size)
+            datagrams.append((packet, _parse_control(control), _parse_address(name)))
+        return datagrams
+
+    def _recv_fallback(self, wait: bool) -> list[Datagram]:
+        datagrams = []
+        while len(datagrams) < self.batch_size:
+            flags = 0 if wait and not datagrams else MSG_DONTWAIT
+            try:
+                packet, ancdata, _, addr_info = self.sock.recvmsg(BUFFER_SIZE, BUFFER_SIZE, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            datagrams.append((packet, ancdata, addr_info))
+        return datagrams
+
+    def send(self, datagrams: list[tuple[bytes, list, str, int]]) -> list[typing.Optional[OSError]]:
+        """Send (packet, ancillary data, address, port) datagrams.
+
+        Returns the error of every datagram, None for the ones that were sent.
+        Once the send buffer is full the remaining datagrams fail with
+        BlockingIOError.
+        """
+        if not self._native:
+            return self._send_fallback(datagrams)
+
+        errors: list[typing.Optional[OSError]] = [None] * len(datagrams)
+        for start in range(0, len(datagrams), self.batch_size):
+            chunk = datagrams[start:start + self.batch_size]
+            messages = (_MMsgHdr * len(chunk))()
+            # Keep the buffers referenced by the headers alive until they are sent
+            keep = []
+            for message, (packet, ancdata, addr, port) in zip(messages, chunk):
+                iovec = _IOVec(ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p), len(packet))
+                name = ctypes.create_string_buffer(_pack_address(addr, port), SOCKADDR_IN6.size)
+                control = _pack_control(ancdata)
+                control_buffer = ctypes.create_string_buffer(control, max(len(control), 1))
+                keep.append((packet, iovec, name, control_buffer))
+                hdr = message.msg_hdr
+                hdr.msg_iov = ctypes.pointer(iovec)
+                hdr.msg_iovlen = 1
+                hdr.msg_name = ctypes.addressof(name)
+                hdr.msg_namelen = SOCKADDR_IN6.size
+                hdr.msg_control = ctypes.addressof(control_buffer) if control else None
+                hdr.msg_controllen = len(control)
+
+            sent = 0
+            while sent < len(chunk):
+                count = _libc.sendmmsg(self.sock.fileno(), ctypes.byref(messages[sent]), len(chunk) - sent, 0)
+                if count > 0:
+                    sent += count
+                    continue
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    for i in range(start + sent, len(datagrams)):
+                        errors[i] = BlockingIOError(err, os.strerror(err))
+                    return errors
+                # Only the first datagram of a call can fail, skip it
+                errors[start + sent] = OSError(err, os.strerror(err))
+                sent += 1
+        return errors
+
+    def _send_fallback(self, datagrams: list[tuple[bytes, list, str, int]]) -> list[typing.Optional[OSError]]:
+        errors: list[typing.Optional[OSError]] = []
+        for packet, ancdata, addr, port in datagrams:
+            try:
+                self.sock.sendmsg([packet], ancdata, 0, (addr, port))
+                errors.append(None)
+            except OSError as e:
+                errors.append(e)
+        return errors
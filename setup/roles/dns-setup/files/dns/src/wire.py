@@ -0,0 +1,182 @@
+from dnslib import DNSRecord, QTYPE, CLASS
+from dnslib.label import DNSBuffer
+
+import struct
+import typing
+
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION_TAIL = struct.Struct('!HH')
+RR_TAIL = struct.Struct('!HHIH')
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+OPCODE_MASK = 0x7800
+TYPE_OPT = 41
+
+# First label of the query names whose answers are delayed
+DELAY_LABEL = b'v2delay_'
+
+_qtypes: dict[int, str] = {}
+_qclasses: dict[int, str] = {}
+
+
+def qtype_name(qtype: int) -> str:
+    name = _qtypes.get(qtype)
+    if name is None:
+        name = _qtypes[qtype] = QTYPE[qtype]
+    return name
+
+
+def qclass_name(qclass: int) -> str:
+    name = _qclasses.get(qclass)
+    if name is None:
+        name = _qclasses[qclass] = CLASS[qclass]
+    return name
+
+
+class WireQuery:
+    """The parts of a single-question DNS query the resolver works with."""
+    __slots__ = ('packet', 'id', 'bitmap', 'labels', 'qtype', 'qclass', 'edns', 'question', '_record')
+
+    def __init__(self, packet: bytes, id: int, bitmap: int, labels: tuple[bytes, ...], qtype: int, qclass: int,
+                 edns: bool, question: bytes, record: typing.Optional[DNSRecord] = None):
+        self.packet = packet
+        self.id = id
+        self.bitmap = bitmap
+        # Labels of the question name as sent (case is preserved)
+        self.labels = labels
+        self.qtype = qtype
+        self.qclass = qclass
+        # Whether the query carries an OPT record
+        self.edns = edns
+        # Packed question section (name, type and class) to echo in the response
+        self.question = question
+        self._record = record
+
+    def record(self) -> DNSRecord:
+        """The query parsed by dnslib (only done on demand)."""
+        if self._record is None:
+            self._record = DNSRecord.parse(self.packet)
+        return self._record
+
+
+def parse_query(packet: bytes) -> typing.Optional[WireQuery]:
+    """Parse a plain single-question query without going through dnslib.
+
+    Returns None for everything the fast path does not handle (responses,
+    several questions, compressed or malformed names, unexpected sections).
+    """
+    view = memoryview(packet)
+    if len(view) < HEADER.size:
+        return None
+    id, bitmap, qdcount, ancount, nscount, arcount = HEADER.unpack_from(view)
+    if bitmap & FLAG_QR or qdcount != 1 or ancount or nscount:
+        return None
+
+    labels = []
+    offset = HEADER.size
+    end = len(view)
+    while True:
+        if offset >= end:
+            return None
+        length = view[offset]
+        offset += 1
+        if length == 0:
+            break
+        # Compression pointers and extended label types
+        if length > 63 or offset + length > end:
+            return None
+        labels.append(bytes(view[offset:offset + length]))
+        offset += length
+    if offset + QUESTION_TAIL.size > end:
+        return None
+    qtype, qclass = QUESTION_TAIL.unpack_from(view, offset)
+    offset += QUESTION_TAIL.size
+    question = bytes(view[HEADER.size:offset])
+
+    edns = False
+    for _ in range(arcount):
+        # Only the root name is expected here (OPT)
+        if offset + 1 + RR_TAIL.size > end or view[offset] != 0:
+            return None
+        rtype, _, _, rdlength = RR_TAIL.unpack_from(view, offset + 1)
+        offset += 1 + RR_TAIL.size + rdlength
+        if offset > end:
+            return None
+        edns = edns or rtype == TYPE_OPT
+
+    return WireQuery(packet, id, bitmap, tuple(labels), qtype, qclass, edns, question)
+
+
+def from_record(packet: bytes, record: DNSRecord) -> WireQuery:
+    """Build the query from a packet dnslib has already parsed."""
+    question = record.q
+    buffer = DNSBuffer()
+    question.pack(buffer)
+    edns = any(rr.rtype == TYPE_OPT for rr in record.ar)
+    return WireQuery(packet, record.header.id, record.header.bitmap, tuple(question.qname.label),
+                     question.qtype, question.qclass, edns, bytes(buffer.data), record)
+
+
+def read_query(packet: bytes) -> typing.Optional[WireQuery]:
+    """Parse a query, falling back to dnslib for the unusual ones.
+
+    Returns None for responses, raises dnslib.dns.DNSError for malformed packets.
+    """
+    query = parse_query(packet)
+    if query is not None:
+        return query
+    record = DNSRecord.parse(packet)
+    if record.header.get_qr() != 0 or not record.questions:
+        return None
+    return from_record(packet, record)
+
+
+def delayed_query(packet: bytes) -> bool:
+    """Whether the query name starts with a delay label, checked on the raw packet."""
+    return packet[13:13 + len(DELAY_LABEL)].lower() == DELAY_LABEL
+
+
+def question_key(packet: bytes) -> typing.Optional[bytes]:
+    """The ID and question (name in lower case, type and class) of a plain single-question query.
+
+    Retransmits of a query have the same key. Returns None for packets
+    which are not a plain single-question query.
+    """
+    if len(packet) < HEADER.size:
+        return None
+    _, bitmap, qdcount = struct.unpack_from('!HHH', packet)
+    if bitmap & FLAG_QR or qdcount != 1:
+        return None
+    offset = HEADER.size
+    while offset < len(packet) and packet[offset] != 0:
+        if packet[offset] > 63:
+            return None
+        offset += packet[offset] + 1
+    end = offset + 1 + QUESTION_TAIL.size
+    if end > len(packet):
+        return None
+    return packet[:2] + packet[HEADER.size:offset].lower() + packet[offset:end]
+
+
+def truncated_response(packet: bytes) -> typing.Optional[bytes]:
+    """Empty response with the TC flag set which makes the client retry over TCP.
+
+    Returns None for packets which are not a plain single-question query.
+    """
+    if len(packet) < HEADER.size:
+        return None
+    id, bitmap, qdcount, *_ = HEADER.unpack_from(packet)
+    if bitmap & FLAG_QR or qdcount != 1:
+        return None
+    offset = HEADER.size
+    while offset < len(packet) and packet[offset] != 0:
+        if packet[offset] > 63:
+            return None
+        offset += packet[offset] + 1
+    offset += 1 + QUESTION_TAIL.size
+    if offset > len(packet):
+        return None
+    return HEADER.pack(id, FLAG_QR | FLAG_TC | bitmap & (OPCODE_MASK | FLAG_RD), 1, 0, 0, 0) + packet[HEADER.size:offset]
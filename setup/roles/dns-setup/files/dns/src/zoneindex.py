@@ -0,0 +1,111 @@
+from dnslib import DNSLabel, RR, QTYPE
+
+import collections
+import fnmatch
+import re
+import typing
+
+
+GLOB_CHARS = re.compile(rb'[*?\[]')
+
+
+class _Node:
+    """Trie node for one label of a reversed owner name."""
+    __slots__ = ('children', 'records', 'globs')
+
+    def __init__(self):
+        self.children: dict[bytes, _Node] = {}
+        # Records owned by exactly this name, per QTYPE
+        self.records: dict[str, list[tuple[int, RR]]] = {}
+        # Records whose owner is a glob over the labels left of this node, per QTYPE
+        self.globs: dict[str, list[tuple[typing.Callable, int, RR]]] = {}
+
+
+class ZoneIndex:
+    """Lookup structure for the records of a zone.
+
+    Records are kept in a dict keyed by their literal (name, QTYPE) and in a
+    trie of their reversed owner labels. Glob owners
+    (e.g. `id-*.delay-50.v1.<basedomain>.`) hang off the node of their longest
+    literal suffix, so a lookup only visits as many nodes as the name has labels.
+    """
+
+    def __init__(self, zone: list[RR]):
+        self._exact: dict[tuple[tuple[bytes, ...], str], list[tuple[int, RR]]] = collections.defaultdict(list)
+        self._names: set[tuple[bytes, ...]] = set()
+        self._types: dict[str, list[RR]] = collections.defaultdict(list)
+        self._root = _Node()
+
+        for pos, rr in enumerate(zone):
+            rtype = QTYPE[rr.rtype]
+            labels = self._key(rr.rname)
+            self._types[rtype].append(rr)
+            self._names.add(labels)
+            self._exact[(labels, rtype)].append((pos, rr))
+
+            glob = max((i for i, label in enumerate(labels) if GLOB_CHARS.search(label)), default=None)
+            node = self._root
+            for label in reversed(labels[glob + 1:] if glob is not None else labels):
+                node = node.children.setdefault(label, _Node())
+            if glob is None:
+                node.records.setdefault(rtype, []).append((pos, rr))
+            else:
+                # Globs may span labels (`*` also matches dots), so match all remaining labels at once
+                pattern = re.compile(fnmatch.translate(b'.'.join(labels[:glob + 1]).decode('latin-1'))).match
+                node.globs.setdefault(rtype, []).append((pattern, pos, rr))
+
+        self._exact = dict(self._exact)
+        self._types = dict(self._types)
+
+    @staticmethod
+    def _key(name: DNSLabel) -> tuple[bytes, ...]:
+        return tuple(label.lower() for label in name.label)
+
+    def records(self, rtype: str) -> list[RR]:
+        """All records of a QTYPE in zone order."""
+        return self._types.get(rtype, [])
+
+    def has_name(self, name: DNSLabel) -> bool:
+        """Whether any record is owned by exactly this name."""
+        return self._key(name) in self._names
+
+    def lookup(self, name: DNSLabel, rtype: str) -> list[RR]:
+        """Records of a QTYPE whose owner equals or glob-matches the name, in zone order."""
+        labels = self._key(name)
+        matches = self._exact.get((labels, rtype))
+        matches = list(matches) if matches else []
+        seen = len(matches)
+
+        node = self._root
+        depth = len(labels)
+        while node is not None and depth > 0:
+            globs = node.globs.get(rtype)
+            if globs:
+                prefix = b'.'.join(labels[:depth]).decode('latin-1')
+                for pattern, pos, rr in globs:
+                    if pattern(prefix) and all(pos != p for p, _ in matches):
+                        matches.append((pos, rr))
+            depth -= 1
+            node = node.children.get(labels[depth])
+
+        if len(matches) > seen:
+            matches.sort(key=lambda match: match[0])
+        return [rr for _, rr in matches]
+
+    def enclosing(self, name: DNSLabel, rtype: str) -> typing.Optional[RR]:
+        """Record of a QTYPE (e.g. SOA) owned by the name itself or its closest literal ancestor."""
+        labels = self._key(name)
+        exact = self._exact.get((labels, rtype))
+        if exact:
+            return exact[0][1]
+
+        closest = None
+        node = self._root
+        for label in reversed(labels):
+            node = node.children.get(label)
+            if node is None:
+                break
+            records = node.records.get(rtype)
+            if records:
+                closest = records[0][1]
+        return closest
@@ -0,0 +1,150 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import typing
+
+from metrics import Metrics, ZONE_BYTES, ZONE_RECORDS, ZONE_RELOAD_DURATION, ZONE_RELOAD_FAILURES, ZONE_RELOADS
+
+
+POLL_INTERVAL = 5.0
+# Time to wait for further events before a changed zone is read
+SETTLE_TIME = 0.2
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+IN_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+T = typing.TypeVar('T')
+
+
+def _inotify(directory: str) -> typing.Optional[int]:
+    """inotify descriptor watching a directory, None where inotify is unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+    fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, os.fsencode(directory), IN_WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _event_names(fd: int) -> set[str]:
+    names = set()
+    while True:
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            _, _, _, length = IN_EVENT.unpack_from(data, offset)
+            offset += IN_EVENT.size
+            names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+
+
+class ZoneWatcher(threading.Thread):
+    """Rebuilds the resolver in the background whenever the zone file changes.
+
+    The zone directory is watched with inotify, other systems (or a failing
+    inotify) fall back to checking the file every `POLL_INTERVAL` seconds.
+    `load` parses the zone into a new object which is handed to `swap`, so
+    the serving code only has to replace a reference. The duration of the
+    last reload and the size of the zone are kept (and exported with the
+    `metrics` if given).
+    """
+
+    def __init__(self, zonefile: str, zone: T, load: typing.Callable[[str], T], swap: typing.Callable[[T], None],
+                 size: typing.Callable[[T], int] = lambda zone: 0, metrics: typing.Optional[Metrics] = None,
+                 poll_interval: float = POLL_INTERVAL):
+        super().__init__(name='zone-watcher', daemon=True)
+        self.zonefile = zonefile
+        self._load = load
+        self._swap = swap
+        self._size = size
+        self._metrics = metrics
+        self._poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._signature = self._stat()
+
+        self.reloads = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.zone_bytes = self._signature[2] if self._signature else 0
+        self.zone_records = size(zone)
+        if metrics:
+            metrics.set(ZONE_BYTES, self.zone_bytes)
+            metrics.set(ZONE_RECORDS, self.zone_records)
+
+    def _stat(self) -> typing.Optional[tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.zonefile)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        fd = _inotify(os.path.dirname(os.path.abspath(self.zonefile)))
+        if fd is None:
+            logging.info(f'Polling {self.zonefile} for zone updates every {self._poll_interval}s')
+        name = os.path.basename(self.zonefile)
+        try:
+            while not self._stopped.is_set():
+                if fd is None:
+                    self._stopped.wait(self._poll_interval)
+                else:
+                    ready, _, _ = select.select([fd], [], [], self._poll_interval)
+                    if ready and name in _event_names(fd):
+                        # Let the writer finish before the file is read
+                        time.sleep(SETTLE_TIME)
+                        _event_names(fd)
+                if not self._stopped.is_set():
+                    self.check()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def check(self):
+        """Reload the zone if the file changed since the last load."""
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return
+        self._signature = signature
+
+        logging.info('Reloading zone due to zone updates')
+        start = time.perf_counter()
+        try:
+            zone = self._load(self.zonefile)
+        except Exception as e:
+            self.failures += 1
+            if self._metrics:
+                self._metrics.inc(ZONE_RELOAD_FAILURES)
+            logging.exception(e)
+            return
+        self._swap(zone)
+        self.last_duration = time.perf_counter() - start
+        self.reloads += 1
+        self.zone_bytes = signature[2]
+        self.zone_records = self._size(zone)
+        if self._metrics:
+            self._metrics.inc(ZONE_RELOADS)
+            self._metrics.set(ZONE_RELOAD_DURATION, self.last_duration)
+            self._metrics.set(ZONE_BYTES, self.zone_bytes)
+            self._metrics.set(ZONE_RECORDS, self.zone_records)
+        logging.info(f'Reloaded zone with {self.zone_records} records in {self.last_duration * 1000:.1f}ms')
@@ -0,0 +1,6 @@
+"""Connection Attempt Delay and Resolution Delay estimates from the daily result files.
+
+Run `python -m analysis --help` from the directory of results_archive.py.
+"""
+from .estimate import Clients, UserAgents, estimate_clients, estimate_user_agents
+from .pipeline import Day, find_days, load_cells, reduce_day, update_cache
@@ -0,0 +1,49 @@
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+
+from . import estimate, pipeline
+from results_archive import MIN_AGE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('python -m analysis', description='Estimate the Connection Attempt Delay and '
+                                     'Resolution Delay of the clients and user agents from the daily result files')
+    parser.add_argument('--results-dir', nargs='*', default=[],
+                        help='Directories with the /results uploads (the -o directory of the upload service)')
+    parser.add_argument('--v2-results-dir', nargs='*', default=[],
+                        help='Directories with the /v2results uploads (--v2-output-directory)')
+    parser.add_argument('--dns-results-dir', nargs='*', default=[],
+                        help='Directories with the query records of the DNS servers (-d)')
+    parser.add_argument('--cache-dir', required=True, help='Directory of the reduced days')
+    parser.add_argument('--output-dir', required=True, help='Directory clients.csv and user-agents.csv are written to')
+    parser.add_argument('--start', help='First day (YYYY-MM-DD) of the estimates')
+    parser.add_argument('--end', help='Last day (YYYY-MM-DD) of the estimates')
+    parser.add_argument('--processes', type=int, help='Days reduced at once (default: number of CPUs)')
+    parser.add_argument('--recompute', action='store_true', help='Reduce the cached days again')
+    parser.add_argument('--min-age', type=float, default=MIN_AGE,
+                        help='Seconds since the last write before a day is reduced')
+    parser.add_argument('--bootstrap', type=int, default=estimate.BOOTSTRAP, help='Bootstrap replicates')
+    parser.add_argument('--confidence', type=float, default=estimate.CONFIDENCE, help='Level of the intervals')
+    parser.add_argument('--seed', type=int, help='Seed of the bootstrap')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    days = pipeline.find_days(args.results_dir, args.v2_results_dir, args.dns_results_dir, args.min_age)
+    days = [day for day in days if (not args.start or day.date >= args.start) and (not args.end or day.date <= args.end)]
+    failures = pipeline.update_cache(days, args.cache_dir, args.processes, args.recompute)
+    paths = [pipeline.cache_path(args.cache_dir, day.date) for day in days]
+    cells, sessions, user_agents = pipeline.load_cells([path for path in paths if os.path.exists(path)])
+
+    rng = np.random.default_rng(args.seed)
+    clients = estimate.estimate_clients(cells, args.bootstrap, args.confidence, rng)
+    agents = estimate.estimate_user_agents(clients, args.bootstrap, args.confidence, rng)
+    os.makedirs(args.output_dir, exist_ok=True)
+    estimate.write_clients(os.path.join(args.output_dir, 'clients.csv'), clients, sessions, user_agents)
+    estimate.write_user_agents(os.path.join(args.output_dir, 'user-agents.csv'), agents, user_agents)
+    logging.info(f'Estimated {len(clients.session)} clients and {len(agents.user_agent)} user agents '
+                 f'from {len(days)} days')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,187 @@
+"""Switch-over delays of clients and user agents from the reduced cells.
+
+A client switched to IPv4 at a tested delay when it used IPv6 in less
+than half of its (successful) tests with that delay. Its switch-over
+delay is the smallest such delay, it lies between the largest smaller
+delay at which it still used IPv6 (`lower_ms`) and this one (`switch_ms`).
+
+Confidence intervals are bootstrapped: per client by drawing the IPv6
+count of every tested delay anew (the binomial draw is the resampling of
+the tests of the cell), per user agent by resampling its clients. A client
+whose every delay had one outcome only has no interval (NaN): its
+replicates would all repeat the estimate.
+"""
+import csv
+import typing
+
+import numpy as np
+
+from .pipeline import KINDS
+
+BOOTSTRAP = 1000
+CONFIDENCE = 0.95
+# Share of the tests of a delay below which the client switched to IPv4
+SWITCH_SHARE = 0.5
+# Elements of the replicate matrices computed at once
+BLOCK_ELEMENTS = 4_000_000
+
+# Status of a client estimate: switched between two tested delays, used IPv6 at every
+# tested delay, or already IPv4 at its smallest tested delay (no usable IPv6)
+OK = 'ok'
+NO_SWITCH = 'no-switch'
+IPV4 = 'ipv4'
+
+
+class Clients(typing.NamedTuple):
+    """Estimates per client (kind, session and user agent code), in the order of the cells."""
+    kind: np.ndarray
+    session: np.ndarray
+    user_agent: np.ndarray
+    tests: np.ndarray
+    errors: np.ndarray
+    lower: np.ndarray
+    switch: np.ndarray
+    ci_low: np.ndarray
+    ci_high: np.ndarray
+    # Mean lateness (ms) of the delayed AAAA answers, NaN without them
+    dns_late: np.ndarray
+    status: np.ndarray
+
+
+class UserAgents(typing.NamedTuple):
+    """Median switch-over delay of the clients (status ok) per kind and user agent code."""
+    kind: np.ndarray
+    user_agent: np.ndarray
+    clients: np.ndarray
+    switch: np.ndarray
+    ci_low: np.ndarray
+    ci_high: np.ndarray
+
+
+def client_starts(cells: np.ndarray) -> np.ndarray:
+    """Index of the first cell of every client, cells ordered by kind, client and delay (see reduce_cells)."""
+    if not len(cells):
+        return np.empty(0, np.intp)
+    key = cells[['kind', 'session', 'user_agent']]
+    return np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+
+
+def switch_delays(delay: np.ndarray, n: np.ndarray, v6: np.ndarray, starts: np.ndarray,
+                  group: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Lower bound and switch-over delay of every client (along the last axis for replicates of `v6`).
+
+    The switch-over delay is inf if the client never switched, the lower
+    bound -inf if it switched at its smallest delay.
+    """
+    tested = n > 0
+    ipv4 = tested & (v6 < SWITCH_SHARE * n)
+    switch = np.minimum.reduceat(np.where(ipv4, delay, np.inf), starts, axis=-1)
+    before = tested & ~ipv4 & (delay < switch[..., group])
+    lower = np.maximum.reduceat(np.where(before, delay, -np.inf), starts, axis=-1)
+    return lower, switch
+
+
+def _blocks(starts: np.ndarray, cells: int, replicates: int) -> typing.Iterable[tuple[int, int]]:
+    # Ranges of clients whose replicate matrix holds about BLOCK_ELEMENTS
+    size = max(BLOCK_ELEMENTS // replicates, 1)
+    firsts = np.unique(np.searchsorted(starts, np.arange(0, cells, size)))
+    return zip(firsts, np.append(firsts[1:], len(starts)))
+
+
+def estimate_clients(cells: np.ndarray, replicates: int = BOOTSTRAP, confidence: float = CONFIDENCE,
+                     rng: typing.Optional[np.random.Generator] = None) -> Clients:
+    """Switch-over delay and its bootstrapped confidence interval per client."""
+    rng = rng or np.random.default_rng()
+    starts = client_starts(cells)
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(cells))))
+    delay, n, v6 = cells['delay'], cells['n'].astype(np.int64), cells['v6'].astype(np.int64)
+    lower, switch = switch_delays(delay, n, v6, starts, group)
+
+    ci_low = np.empty(len(starts))
+    ci_high = np.empty(len(starts))
+    share = np.divide(v6, n, out=np.zeros(len(cells)), where=n > 0)
+    alpha = (1 - confidence) / 2
+    for first, last in _blocks(starts, len(cells), replicates):
+        cell_slice = slice(starts[first], starts[last] if last < len(starts) else len(cells))
+        block_starts = starts[first:last] - starts[first]
+        # Only cells with both outcomes change between replicates
+        samples = np.broadcast_to(v6[cell_slice], (replicates, cell_slice.stop - cell_slice.start)).copy()
+        mixed = np.flatnonzero((share[cell_slice] > 0) & (share[cell_slice] < 1))
+        samples[:, mixed] = rng.binomial(n[cell_slice][mixed], share[cell_slice][mixed], size=(replicates, len(mixed)))
+        _, switches = switch_delays(delay[cell_slice], n[cell_slice], samples, block_starts,
+                                    group[cell_slice] - first)
+        # Interval bounds are tested delays (or inf), not interpolated between them
+        ci_low[first:last] = np.quantile(switches, alpha, axis=0, method='lower')
+        ci_high[first:last] = np.quantile(switches, 1 - alpha, axis=0, method='higher')
+    if len(starts):
+        unresampled = ~np.logical_or.reduceat((share > 0) & (share < 1), starts)
+        ci_low[unresampled] = np.nan
+        ci_high[unresampled] = np.nan
+
+    dns_n = np.add.reduceat(cells['dns_n'], starts) if len(starts) else np.empty(0)
+    dns_late = np.add.reduceat(cells['dns_late'], starts) if len(starts) else np.empty(0)
+    status = np.where(np.isinf(switch), NO_SWITCH, np.where(np.isinf(lower), IPV4, OK))
+    return Clients(
+        kind=cells['kind'][starts],
+        session=cells['session'][starts],
+        user_agent=cells['user_agent'][starts],
+        tests=np.add.reduceat(n, starts) if len(starts) else np.empty(0, np.int64),
+        errors=np.add.reduceat(cells['errors'], starts) if len(starts) else np.empty(0, np.int64),
+        lower=lower,
+        switch=switch,
+        ci_low=ci_low,
+        ci_high=ci_high,
+        dns_late=np.divide(dns_late, dns_n, out=np.full(len(starts), np.nan), where=dns_n > 0),
+        status=status,
+    )
+
+
+def estimate_user_agents(clients: Clients, replicates: int = BOOTSTRAP, confidence: float = CONFIDENCE,
+                         rng: typing.Optional[np.random.Generator] = None) -> UserAgents:
+    """Median switch-over delay of the clients of every user agent and its bootstrapped confidence interval."""
+    rng = rng or np.random.default_rng()
+    ok = clients.status == OK
+    kind, user_agent, switch = clients.kind[ok], clients.user_agent[ok], clients.switch[ok]
+    order = np.lexsort((switch, user_agent, kind))
+    kind, user_agent, switch = kind[order], user_agent[order], switch[order]
+    if len(switch):
+        boundaries = np.flatnonzero((kind[1:] != kind[:-1]) | (user_agent[1:] != user_agent[:-1])) + 1
+    else:
+        boundaries = np.empty(0, np.intp)
+    starts = np.concatenate(([0], boundaries)) if len(switch) else boundaries
+    counts = np.diff(np.append(starts, len(switch)))
+
+    medians = np.empty(len(starts))
+    ci_low = np.empty(len(starts))
+    ci_high = np.empty(len(starts))
+    alpha = (1 - confidence) / 2
+    for index, (start, count) in enumerate(zip(starts, counts)):
+        values = switch[start:start + count]
+        medians[index] = np.median(values)
+        resampled = np.median(values[rng.integers(0, count, size=(replicates, count))], axis=1)
+        ci_low[index], ci_high[index] = np.quantile(resampled, [alpha, 1 - alpha])
+    return UserAgents(kind[starts], user_agent[starts], counts, medians, ci_low, ci_high)
+
+
+def _ms(value: float) -> str:
+    return '' if not np.isfinite(value) else f'{value:g}'
+
+
+def write_clients(path: str, clients: Clients, sessions: np.ndarray, user_agents: np.ndarray):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'session', 'user_agent', 'tests', 'errors', 'status', 'lower_ms', 'switch_ms',
+                         'ci_low_ms', 'ci_high_ms', 'dns_late_ms'])
+        for row in zip(*clients):
+            kind, session, user_agent, tests, errors, lower, switch, ci_low, ci_high, dns_late, status = row
+            writer.writerow([KINDS[kind], sessions[session], user_agents[user_agent], tests, errors, status,
+                             _ms(lower), _ms(switch), _ms(ci_low), _ms(ci_high),
+                             '' if np.isnan(dns_late) else f'{dns_late:.3f}'])
+
+
+def write_user_agents(path: str, estimates: UserAgents, user_agents: np.ndarray):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'user_agent', 'clients', 'switch_ms', 'ci_low_ms', 'ci_high_ms'])
+        for kind, user_agent, clients, switch, ci_low, ci_high in zip(*estimates):
+            writer.writerow([KINDS[kind], user_agents[user_agent], clients, _ms(switch), _ms(ci_low), _ms(ci_high)])
@@ -0,0 +1,347 @@
+"""Daily result files into per-day partial aggregates.
+
+The uploads of a day are streamed through generators (lines, documents,
+runs, observations) into chunks of typed NumPy arrays and reduced to one
+cell per kind of estimate, client (session id and user agent) and tested
+delay: how often the client was tested with the delay, used IPv6 or
+failed. Cells of several days add up, so every closed day is reduced
+once (on a process pool) and cached as `<cache dir>/<date>.npz`.
+"""
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import time
+import typing
+
+import numpy as np
+
+from results_archive import ARCHIVE_SUFFIX, MIN_AGE, read_lines
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Cached days of another version are reduced again
+CACHE_VERSION = 2
+CHUNK_ROWS = 65_536
+# Kinds of estimate: Connection Attempt Delay (/results, IPv6 address delayed) and
+# Resolution Delay (/v2results, AAAA answer delayed)
+CAD = 0
+RD = 1
+KINDS = ('cad', 'rd')
+DAY_FILE = re.compile(r'^(\d{4}-\d{2}-\d{2})-(results|v2results|dns-results)\.jsonl(?:\.zst)?$')
+# Name of the v2 AAAA queries (v2delay_aaaa-<runUId>_<delay>), their answer is delayed by the delay of the label
+V2_AAAA = re.compile(r'^v2delay_aaaa-([^.]+)_(\d+)\.')
+# Difference allowed between the clocks of a client and the DNS server when matching queries to the time of a run
+CLOCK_SLACK = 60.0
+
+# Time of the run (DNS server clock, s) with CLOCK_SLACK, unbounded without its timestamps
+OBSERVATION = np.dtype([('session', np.int32), ('user_agent', np.int32), ('run_uid', np.int32),
+                        ('delay', np.float64), ('v6', np.bool_), ('error', np.bool_),
+                        ('start', np.float64), ('end', np.float64)])
+# Lateness (ms) of a delayed AAAA answer of the DNS server: sent minus arrival minus delay
+QUERY = np.dtype([('run_uid', np.int32), ('delay', np.float64), ('time', np.float64), ('late', np.float64)])
+CELL = np.dtype([('kind', np.uint8), ('session', np.int32), ('user_agent', np.int32), ('delay', np.float64),
+                 ('n', np.int32), ('v6', np.int32), ('errors', np.int32), ('dns_n', np.int32),
+                 ('dns_late', np.float64)])
+KEY_FIELDS = ['kind', 'session', 'user_agent', 'delay']
+SUM_FIELDS = ['n', 'v6', 'errors', 'dns_n', 'dns_late']
+
+
+class Day(typing.NamedTuple):
+    """Daily files of a date (JSONL paths, compacted days by the path of their original file)."""
+    date: str
+    results: list[str]
+    v2results: list[str]
+    dns: list[str]
+
+
+class Labels:
+    """Integer codes of strings (session ids, user agents) in order of their first appearance."""
+
+    def __init__(self):
+        self._codes: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def code(self, label: str) -> int:
+        code = self._codes.get(label)
+        if code is None:
+            code = self._codes[label] = len(self._codes)
+        return code
+
+    def array(self) -> np.ndarray:
+        return np.array(list(self._codes), dtype=np.str_)
+
+
+def find_days(results_dirs: list[str], v2_dirs: list[str], dns_dirs: list[str],
+              min_age: float = MIN_AGE) -> list[Day]:
+    """Closed days of the result directories: before today and not written to for `min_age` seconds."""
+    today = datetime.date.today().isoformat()
+    now = time.time()
+    files: dict[str, dict[str, set[str]]] = {}
+    for field, directories, kind in (('results', results_dirs, 'results'), ('v2results', v2_dirs, 'v2results'),
+                                     ('dns', dns_dirs, 'dns-results')):
+        for directory in directories:
+            for root, _, names in os.walk(directory):
+                for name in names:
+                    match = DAY_FILE.match(name)
+                    if not match or match.group(2) != kind or match.group(1) >= today:
+                        continue
+                    path = os.path.join(root, name)
+                    # Archives are closed days, a JSONL file might still get late uploads
+                    if not name.endswith(ARCHIVE_SUFFIX) and now - os.path.getmtime(path) < min_age:
+                        continue
+                    day = files.setdefault(match.group(1), {'results': set(), 'v2results': set(), 'dns': set()})
+                    day[field].add(path.removesuffix(ARCHIVE_SUFFIX))
+    return [Day(date, *(sorted(day[field]) for field in ('results', 'v2results', 'dns')))
+            for date, day in sorted(files.items())]
+
+
+def documents(paths: list[str]) -> typing.Iterator:
+    """Parsed lines of daily files, torn or broken lines are skipped."""
+    loads = orjson.loads if orjson is not None else json.loads
+    for path in paths:
+        broken = 0
+        for line in read_lines(path):
+            try:
+                yield loads(line)
+            except ValueError:
+                broken += 1
+        if broken:
+            logging.warning(f'Skipped {broken} broken lines of {path}')
+
+
+def upload_runs(uploads: typing.Iterable) -> typing.Iterator[dict]:
+    """Runs of uploads (an upload is the list of runs a browser transmitted at once)."""
+    for upload in uploads:
+        for run in upload if isinstance(upload, list) else [upload]:
+            if isinstance(run, dict) and run.get('id') is not None:
+                yield run
+
+
+def _number(value) -> typing.Optional[float]:
+    # Delays of the tests are the lines of delays.csv, uploaded as strings
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _window(run: dict) -> tuple[float, float]:
+    # Run timestamps are ms of the client clock
+    start, end = _number(run.get('timestampStart')), _number(run.get('timestampEnd'))
+    if start is None or end is None:
+        return -np.inf, np.inf
+    return start / 1000 - CLOCK_SLACK, end / 1000 + CLOCK_SLACK
+
+
+def observations(runs: typing.Iterable[dict], kind: int, sessions: Labels, user_agents: Labels,
+                 run_uids: Labels) -> typing.Iterator[tuple]:
+    """One row (of OBSERVATION) per tested delay of a run.
+
+    Results of the Resolution Delay are those with the AAAA answer
+    delayed, with the A answer delayed the client is expected to use IPv6.
+    """
+    for run in runs:
+        results = run.get('delayResults')
+        if not isinstance(results, list):
+            continue
+        session = sessions.code(str(run['id']))
+        user_agent = user_agents.code(str(run.get('userAgent') or ''))
+        start, end = _window(run)
+        for result in results:
+            if not isinstance(result, dict) or (kind == RD and result.get('delayType') != 'aaaa'):
+                continue
+            delay = _number(result.get('delay'))
+            if delay is None:
+                continue
+            error = bool(result.get('error'))
+            yield (session, user_agent, run_uids.code(str(result.get('runUId'))), delay,
+                   not error and result.get('isV6') is True, error, start, end)
+
+
+def delayed_answers(records: typing.Iterable, run_uids: Labels) -> typing.Iterator[tuple]:
+    """One row (of QUERY) per delayed v2 AAAA answer of the DNS server, run uid and delay of its name."""
+    for record in records:
+        if not isinstance(record, dict) or record.get('rr_type') != 'AAAA':
+            continue
+        name = V2_AAAA.match(str(record.get('rr_name', '')).lower())
+        if name is None:
+            continue
+        delay, request_time, send_time = float(name.group(2)), record.get('request_time'), record.get('send_time')
+        if not isinstance(request_time, (int, float)) or not isinstance(send_time, (int, float)):
+            continue
+        yield run_uids.code(name.group(1)), delay, request_time, (send_time - request_time) * 1000 - delay
+
+
+def chunks(rows: typing.Iterator[tuple], dtype: np.dtype, size: int = CHUNK_ROWS) -> typing.Iterator[np.ndarray]:
+    """Rows as typed arrays of up to `size` rows."""
+    while True:
+        chunk = np.fromiter(itertools.islice(rows, size), dtype=dtype)
+        if not len(chunk):
+            return
+        yield chunk
+
+
+def concatenate(arrays: typing.Iterable[np.ndarray], dtype: np.dtype) -> np.ndarray:
+    arrays = list(arrays)
+    return np.concatenate(arrays) if arrays else np.empty(0, dtype)
+
+
+def reduce_cells(cells: np.ndarray) -> np.ndarray:
+    """Cells with the same kind, client and delay added up, ordered by them."""
+    if not len(cells):
+        return cells
+    cells = cells[np.lexsort([cells[field] for field in reversed(KEY_FIELDS)])]
+    changed = np.zeros(len(cells), np.bool_)
+    changed[0] = True
+    for field in KEY_FIELDS:
+        changed[1:] |= cells[field][1:] != cells[field][:-1]
+    starts = np.flatnonzero(changed)
+    reduced = np.zeros(len(starts), CELL)
+    for field in KEY_FIELDS:
+        reduced[field] = cells[field][starts]
+    for field in SUM_FIELDS:
+        reduced[field] = np.add.reduceat(cells[field], starts)
+    return reduced
+
+
+def _delay_keys(run_uid: np.ndarray, delay: np.ndarray) -> np.ndarray:
+    # Run uid and delay (in µs) as one sortable integer
+    return (run_uid.astype(np.int64) << 40) | np.round(delay * 1000).astype(np.int64)
+
+
+def answer_lateness(observed: np.ndarray, queries: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Number and summed lateness of the delayed AAAA answers of every observation.
+
+    Answers match by run uid and delay and have to be asked for during the
+    run: run uids are random and repeat over a day.
+    """
+    count = np.zeros(len(observed), np.int32)
+    late = np.zeros(len(observed))
+    if not len(queries) or not len(observed):
+        return count, late
+    keys, inverse = np.unique(_delay_keys(queries['run_uid'], queries['delay']), return_inverse=True)
+    # Query times ordered by key, then by time, made increasing over all keys by
+    # moving the times of every key to a span of its own
+    first, span = queries['time'].min(), np.ptp(queries['time']) + 1.0
+    shifted = queries['time'] - first + inverse * span
+    order = np.argsort(shifted)
+    shifted = shifted[order]
+    summed = np.concatenate(([0.0], np.cumsum(queries['late'][order])))
+
+    wanted = _delay_keys(observed['run_uid'], observed['delay'])
+    index = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    found = (keys[index] == wanted) & ~observed['error']
+    # Clipped to half a second around the span of the key, which holds no query
+    offset = index[found] * span
+    start = np.clip(observed['start'][found] - first, -0.5, span - 0.5) + offset
+    end = np.clip(observed['end'][found] - first, -0.5, span - 0.5) + offset
+    low = np.searchsorted(shifted, start, side='left')
+    high = np.maximum(np.searchsorted(shifted, end, side='right'), low)
+    count[found] = high - low
+    late[found] = summed[high] - summed[low]
+    return count, late
+
+
+def reduce_day(day: Day) -> dict[str, np.ndarray]:
+    """Cells of the runs of a day and the labels of their session and user agent codes."""
+    sessions, user_agents, run_uids = Labels(), Labels(), Labels()
+    queries = concatenate(chunks(delayed_answers(documents(day.dns), run_uids), QUERY), QUERY)
+    parts = []
+    for kind, paths in ((CAD, day.results), (RD, day.v2results)):
+        rows = observations(upload_runs(documents(paths)), kind, sessions, user_agents, run_uids)
+        for observed in chunks(rows, OBSERVATION):
+            cells = np.zeros(len(observed), CELL)
+            cells['kind'] = kind
+            for field in ('session', 'user_agent', 'delay'):
+                cells[field] = observed[field]
+            cells['n'] = ~observed['error']
+            cells['v6'] = observed['v6']
+            cells['errors'] = observed['error']
+            if kind == RD:
+                cells['dns_n'], cells['dns_late'] = answer_lateness(observed, queries)
+            # Reduced per chunk, so a day never holds more than a chunk of rows
+            parts.append(reduce_cells(cells))
+    return {
+        'version': np.array(CACHE_VERSION),
+        'cells': reduce_cells(concatenate(parts, CELL)),
+        'sessions': sessions.array(),
+        'user_agents': user_agents.array(),
+    }
+
+
+def cache_path(cache_dir: str, date: str) -> str:
+    return os.path.join(cache_dir, f'{date}.npz')
+
+
+def cached(cache_dir: str, date: str) -> bool:
+    path = cache_path(cache_dir, date)
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as data:
+        return int(data['version']) == CACHE_VERSION
+
+
+def cache_day(day: Day, cache_dir: str) -> str:
+    """Reduce a day and write its cells to the cache, returns the path."""
+    path = cache_path(cache_dir, day.date)
+    data = reduce_day(day)
+    # Written to a temporary file first, so an interrupted run leaves no partial day
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **data)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def update_cache(days: list[Day], cache_dir: str, processes: typing.Optional[int] = None,
+                 recompute: bool = False) -> int:
+    """Reduce the days not cached yet on a process pool, returns the number of failures."""
+    os.makedirs(cache_dir, exist_ok=True)
+    pending = [day for day in days if recompute or not cached(cache_dir, day.date)]
+    if not pending:
+        return 0
+    logging.info(f'Reducing {len(pending)} of {len(days)} days')
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(cache_day, day, cache_dir): day for day in pending}
+        for future in concurrent.futures.as_completed(futures):
+            day = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                logging.error(f'Reducing {day.date} failed: {e}')
+                continue
+            logging.info(f'Reduced {day.date}')
+    return failures
+
+
+def load_cells(paths: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cells of cached days added up, with the codes of all days mapped to common session and user agent labels."""
+    cells, sessions, user_agents = [], [], []
+    session_offset = user_agent_offset = 0
+    for path in paths:
+        with np.load(path) as data:
+            day = data['cells'].copy()
+            day['session'] += session_offset
+            day['user_agent'] += user_agent_offset
+            cells.append(day)
+            sessions.append(data['sessions'])
+            user_agents.append(data['user_agents'])
+            session_offset += len(data['sessions'])
+            user_agent_offset += len(data['user_agents'])
+    cells = concatenate(cells, CELL)
+    session_labels, session_codes = np.unique(concatenate(sessions, np.str_), return_inverse=True)
+    user_agent_labels, user_agent_codes = np.unique(concatenate(user_agents, np.str_), return_inverse=True)
+    cells['session'] = session_codes[cells['session']]
+    cells['user_agent'] = user_agent_codes[cells['user_agent']]
+    return reduce_cells(cells), session_labels, user_agent_labels
@@ -0,0 +1,343 @@
+"""Compaction of the daily JSONL result files into indexed zstd archives.
+
+A closed day `YYYY/MM/<date>-<kind>.jsonl` becomes `<date>-<kind>.jsonl.zst`,
+a sequence of independently compressed zstd frames (blocks) of whole lines
+which `zstd -d` turns back into the original file, and the sidecar index
+`<date>-<kind>.jsonl.zst.idx` with the offset, line numbers and time range
+of every block and the blocks holding each session id.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+import typing
+
+import zstandard
+
+BLOCK_SIZE = 1024 * 1024
+LEVEL = 9
+# Days are only compacted once their file was not written to for this long
+MIN_AGE = 3600
+INDEX_VERSION = 1
+ARCHIVE_SUFFIX = '.zst'
+INDEX_SUFFIX = '.zst.idx'
+DAY_FILE = re.compile(r'^(\d{4}-\d{2}-\d{2})-.+\.jsonl$')
+# Lists of an upload whose entries name the session id of their DNS queries as runUId
+RESULT_LISTS = ('delayResults', 'resolutionInfos')
+
+
+def record_ids(record) -> set[str]:
+    """Session ids of a line: the id of a DNS query record, the run ids and runUIds of an upload."""
+    ids = set()
+    for run in record if isinstance(record, list) else [record]:
+        if not isinstance(run, dict):
+            continue
+        if run.get('id') is not None:
+            ids.add(str(run['id']))
+        for key in RESULT_LISTS:
+            results = run.get(key)
+            if isinstance(results, list):
+                ids.update(str(result['runUId']) for result in results
+                           if isinstance(result, dict) and result.get('runUId') is not None)
+    return ids
+
+
+def record_times(record) -> list[float]:
+    """Times (in seconds) of a line: the request time of a DNS query record, start and end of an upload."""
+    times = []
+    for run in record if isinstance(record, list) else [record]:
+        if not isinstance(run, dict):
+            continue
+        for key, scale in (('request_time', 1), ('timestampStart', 1e-3), ('timestampEnd', 1e-3)):
+            value = run.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                times.append(value * scale)
+    return times
+
+
+def _parse(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _blocks(source: typing.BinaryIO, block_size: int) -> typing.Iterator[list[bytes]]:
+    lines = []
+    size = 0
+    for line in source:
+        lines.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield lines
+            lines = []
+            size = 0
+    if lines:
+        yield lines
+
+
+def compact(path: str, level: int = LEVEL, block_size: int = BLOCK_SIZE, keep: bool = False) -> str:
+    """Compact a day file, returns the path of its archive.
+
+    The archive is read back and compared with the original before the
+    original is removed (unless `keep` is set). An existing archive is only
+    accepted in place of a new one if it holds the same data (SHA-256).
+    """
+    archive = path + ARCHIVE_SUFFIX
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(archive) or os.path.exists(index_path):
+        _check_existing(path, index_path)
+        if keep:
+            # Up to date again for closed_days
+            os.utime(archive)
+            os.utime(index_path)
+        else:
+            os.remove(path)
+        return archive
+    compressor = zstandard.ZstdCompressor(level=level, write_checksum=True)
+    digest = hashlib.sha256()
+    blocks = []
+    ids: dict[str, list[int]] = {}
+    line_number = 0
+
+    with open(path, 'rb') as source, open(archive + '.tmp', 'wb') as target:
+        for lines in _blocks(source, block_size):
+            data = b''.join(lines)
+            digest.update(data)
+            number = len(blocks)
+            start = end = None
+            for line in lines:
+                record = _parse(line)
+                for id in record_ids(record):
+                    numbers = ids.setdefault(id, [])
+                    if not numbers or numbers[-1] != number:
+                        numbers.append(number)
+                for timestamp in record_times(record):
+                    start = timestamp if start is None else min(start, timestamp)
+                    end = timestamp if end is None else max(end, timestamp)
+            frame = compressor.compress(data)
+            blocks.append({'offset': target.tell(), 'length': len(frame), 'line': line_number, 'lines': len(lines),
+                           'size': len(data), 'start': start, 'end': end})
+            target.write(frame)
+            line_number += len(lines)
+        target.flush()
+        os.fsync(target.fileno())
+
+    index = {
+        'version': INDEX_VERSION,
+        'source': os.path.basename(path),
+        'size': sum(block['size'] for block in blocks),
+        'lines': line_number,
+        'sha256': digest.hexdigest(),
+        'blocks': blocks,
+        'ids': ids,
+    }
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+
+    restored = hashlib.sha256()
+    for data in Archive(archive + '.tmp', index).blocks():
+        restored.update(data)
+    if restored.hexdigest() != index['sha256']:
+        os.remove(archive + '.tmp')
+        os.remove(index_path + '.tmp')
+        raise ValueError(f'Archive of {path} does not restore the original')
+
+    os.rename(archive + '.tmp', archive)
+    os.rename(index_path + '.tmp', index_path)
+    if not keep:
+        os.remove(path)
+    return archive
+
+
+def _check_existing(path: str, index_path: str):
+    # Raises unless the archive of a day file already holds its data
+    try:
+        with open(index_path) as f:
+            expected = json.load(f)['sha256']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise ValueError(f'An archive of {path} exists without a usable index ({e}), not overwriting it')
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(BLOCK_SIZE):
+            digest.update(data)
+    if digest.hexdigest() != expected:
+        raise ValueError(f'An archive of {path} with other data exists, not overwriting it')
+
+
+class Archive:
+    """Reads a compacted day, decompressing only the blocks a query needs.
+
+    Lines are returned as the original bytes (including their newline).
+    """
+
+    def __init__(self, path: str, index: typing.Optional[dict] = None):
+        if index is None:
+            if not path.endswith(ARCHIVE_SUFFIX):
+                path += ARCHIVE_SUFFIX
+            with open(path[:-len(ARCHIVE_SUFFIX)] + INDEX_SUFFIX) as f:
+                index = json.load(f)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError(f'Unsupported archive index version {index.get("version")} of {path}')
+        self.path = path
+        self.index = index
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def block(self, number: int) -> bytes:
+        return next(self.blocks([number]))
+
+    def blocks(self, numbers: typing.Optional[typing.Iterable[int]] = None) -> typing.Iterator[bytes]:
+        """The decompressed blocks (all of them in order by default)."""
+        numbers = range(len(self.index['blocks'])) if numbers is None else numbers
+        with open(self.path, 'rb') as f:
+            for number in numbers:
+                block = self.index['blocks'][number]
+                f.seek(block['offset'])
+                yield self._decompressor.decompress(f.read(block['length']), max_output_size=block['size'])
+
+    def lines(self, numbers: typing.Optional[typing.Iterable[int]] = None) -> typing.Iterator[bytes]:
+        for data in self.blocks(numbers):
+            start = 0
+            while start < len(data):
+                end = data.find(b'\n', start) + 1 or len(data)
+                yield data[start:end]
+                start = end
+
+    def session(self, id) -> typing.Iterator[bytes]:
+        """Lines naming a session id (a run id or runUId)."""
+        id = str(id)
+        for line in self.lines(self.index['ids'].get(id, [])):
+            if id in record_ids(_parse(line)):
+                yield line
+
+    def window(self, start: float, end: float) -> typing.Iterator[bytes]:
+        """Lines with a time between `start` and `end` (in seconds since the epoch)."""
+        numbers = [number for number, block in enumerate(self.index['blocks'])
+                   if block['start'] is not None and block['start'] <= end and block['end'] >= start]
+        for line in self.lines(numbers):
+            if any(start <= timestamp <= end for timestamp in record_times(_parse(line))):
+                yield line
+
+    def restore(self, target: typing.BinaryIO):
+        """Write the original day file."""
+        for data in self.blocks():
+            target.write(data)
+
+
+def read_lines(path: str) -> typing.Iterator[bytes]:
+    """Lines of a day, from its JSONL file or its archive."""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            yield from f
+    else:
+        yield from Archive(path).lines()
+
+
+def _archived(path: str) -> bool:
+    # Archive and index written after the last change of the day file (kept with --keep)
+    try:
+        mtime = os.path.getmtime(path)
+        return all(os.path.getmtime(path + suffix) >= mtime for suffix in (ARCHIVE_SUFFIX, INDEX_SUFFIX))
+    except OSError:
+        return False
+
+
+def closed_days(directory: str, min_age: float = MIN_AGE, archived: bool = True) -> list[str]:
+    """Day files of a results directory which are no longer written to.
+
+    Without `archived`, days kept next to an up to date archive are left out.
+    """
+    today = datetime.date.today().isoformat()
+    now = time.time()
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            match = DAY_FILE.match(name)
+            if not match or match.group(1) >= today:
+                continue
+            path = os.path.join(root, name)
+            if now - os.path.getmtime(path) >= min_age and (archived or not _archived(path)):
+                paths.append(path)
+    return sorted(paths)
+
+
+def compact_directories(directories: list[str], level: int = LEVEL, block_size: int = BLOCK_SIZE,
+                        keep: bool = False, min_age: float = MIN_AGE) -> int:
+    """Compact the closed days of all directories, returns the number of failures."""
+    failures = 0
+    for directory in directories:
+        # Kept days are archived already, others are removed once their archive is checked
+        for path in closed_days(directory, min_age, archived=not keep):
+            start = time.perf_counter()
+            try:
+                archive = compact(path, level, block_size, keep)
+            except Exception as e:
+                failures += 1
+                logging.error(f'Compacting {path} failed: {e}')
+                continue
+            logging.info(f'Compacted {path} ({os.path.getsize(archive) / 1024 / 1024:.1f} MiB) '
+                         f'in {time.perf_counter() - start:.1f}s')
+    return failures
+
+
+def next_run(at: str) -> float:
+    """Seconds until the next local time `at` (HH:MM)."""
+    hour, minute = map(int, at.split(':'))
+    now = datetime.datetime.now()
+    run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run <= now:
+        run += datetime.timedelta(days=1)
+    return (run - now).total_seconds()
+
+
+def parse_time(value: str) -> float:
+    """Seconds since the epoch or an ISO 8601 date and time (local time unless it carries an offset)."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Results Archive')
+    commands = parser.add_subparsers(dest='command', required=True)
+    compact_parser = commands.add_parser('compact', help='Compact the closed days of results directories')
+    compact_parser.add_argument('directories', nargs='+', help='Results directories (with YYYY/MM subdirectories)')
+    compact_parser.add_argument('--level', type=int, default=LEVEL, help='zstd compression level')
+    compact_parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, help='Uncompressed bytes per block')
+    compact_parser.add_argument('--min-age', type=float, default=MIN_AGE,
+                                help='Seconds since the last write before a day is compacted')
+    compact_parser.add_argument('--keep', action='store_true', help='Keep the JSONL files')
+    compact_parser.add_argument('--schedule', metavar='HH:MM', help='Keep running and compact every day at this time')
+    cat_parser = commands.add_parser('cat', help='Write the original JSONL file of an archive')
+    cat_parser.add_argument('archive')
+    session_parser = commands.add_parser('session', help='Lines of an archive naming a run id or runUId')
+    session_parser.add_argument('archive')
+    session_parser.add_argument('id')
+    window_parser = commands.add_parser('window', help='Lines of an archive within a time window')
+    window_parser.add_argument('archive')
+    window_parser.add_argument('start', type=parse_time, help='Seconds since the epoch or ISO 8601 time')
+    window_parser.add_argument('end', type=parse_time, help='Seconds since the epoch or ISO 8601 time')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'compact':
+        while True:
+            if args.schedule:
+                time.sleep(next_run(args.schedule))
+            failures = compact_directories(args.directories, args.level, args.block_size, args.keep, args.min_age)
+            if not args.schedule:
+                sys.exit(1 if failures else 0)
+    elif args.command == 'cat':
+        Archive(args.archive).restore(sys.stdout.buffer)
+    elif args.command == 'session':
+        sys.stdout.buffer.writelines(Archive(args.archive).session(args.id))
+    elif args.command == 'window':
+        sys.stdout.buffer.writelines(Archive(args.archive).window(args.start, args.end))
@@ -0,0 +1,374 @@
+"""Load and durability benchmark of the results-upload service.
+
+Simulates browser sessions: every session posts the DNS query records of
+its test to /dns-query and then its runs, shaped like main.js uploads
+them, to /results, /v2results or /dnsresults. Reports the throughput,
+latency percentiles and errors per route, then reads the daily files and
+checks them for torn or interleaved lines and for accepted uploads which
+are missing or were written twice.
+
+Either drives a running service (--url and its output directories) or
+starts results-upload.py itself (--spawn) once per --fsync mode, so the
+cost of every durability mode is measured with the same load.
+"""
+import argparse
+import datetime
+import gzip
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.parse
+import uuid
+
+RESULT_ROUTES = ('/results', '/v2results', '/dnsresults')
+ROUTES = RESULT_ROUTES + ('/dns-query',)
+# Output directory (option) and daily file suffix of every route
+ROUTE_FILES = {
+    '/results': ('output_directory', '-results.jsonl'),
+    '/v2results': ('v2_output_directory', '-v2results.jsonl'),
+    '/dnsresults': ('output_directory', '-dns-user-info.jsonl'),
+    '/dns-query': ('dns_output_directory', '-dns-results.jsonl'),
+}
+DELAYS = (0, 10, 25, 50, 75, 100, 150, 200, 250, 300, 400, 500, 750, 1000, 2000)
+# Entries of the result list of a run: delays times repetitions (times A/AAAA for v2)
+REPORT_SIZES = (15, 45, 150)
+PERCENTILES = (50, 90, 99, 99.9)
+# Key naming the upload in every run and DNS query record
+MARKER = 'benchId'
+PORT = 40_000
+USER_AGENTS = (
+    'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36',
+)
+
+
+def result_entry(route: str, rng: random.Random, delay: int, run_uid: int, timestamp: int, repetition: int) -> dict:
+    response_time = f'{delay + rng.uniform(5, 80):.2f}'
+    if route == '/dnsresults':
+        return {'delay': delay, 'runUId': run_uid, 'timestamp': timestamp, 'repetition': repetition,
+                'result': f'2001:db8::4e:{delay}', 'responseTime': response_time}
+    entry = {'delay': delay, 'runUId': run_uid, 'isV6': rng.random() < 0.7, 'timestamp': timestamp,
+             'repetition': repetition, 'error': False, 'responseTime': response_time}
+    if route == '/v2results':
+        entry['delayType'] = rng.choice(('a', 'aaaa'))
+    return entry
+
+
+def run_info(route: str, rng: random.Random, marker: str, run_count: int, size: int) -> dict:
+    """A run as main.js collects it, with `size` entries in its result list."""
+    start = int(time.time() * 1000)
+    repetitions = max(size // len(DELAYS), 1)
+    run = {
+        'id': rng.getrandbits(32),
+        'runCount': run_count,
+        'timestampStart': start,
+        'userAgent': rng.choice(USER_AGENTS),
+        'platform': 'Linux x86_64',
+        'vendor': '',
+        'domainRandomization': rng.random() < 0.5,
+        'repetitions': repetitions,
+        'userInfo': 'load test',
+        MARKER: marker,
+    }
+    if route == '/v2results':
+        run['resolverInfo'] = ''
+    key = 'resolutionInfos' if route == '/dnsresults' else 'delayResults'
+    run[key] = [result_entry(route, rng, DELAYS[n % len(DELAYS)], rng.randint(0, 100_000), start + n * 50,
+                             n // len(DELAYS)) for n in range(size)]
+    run['timestampEnd'] = start + size * 50
+    return run
+
+
+def dns_query(rng: random.Random, marker: str, delay: int) -> dict:
+    """A query record as the DNS server posts it."""
+    run_uid = rng.randint(0, 100_000)
+    name = f'id-{run_uid}.delay-{delay}.v1.he-test.example.com.'
+    return {
+        'ns_ip': '2001:db8::53', 'remote_ip': f'2001:db8:1::{rng.randint(1, 0xffff):x}',
+        'remote_port': rng.randint(1024, 65535), 'dns_query_id': rng.randint(0, 65535), 'rr_name': name,
+        'rr_class': 'IN', 'rr_type': 'AAAA',
+        'answers': [{'rname': name, 'rtype': 'AAAA', 'rvalue': f'2001:db8::4e:{delay}'}],
+        'id': str(run_uid), 'delegation': False, 'request_time': time.time(), 'delay_ms': delay, MARKER: marker,
+    }
+
+
+class Stats:
+    """Responses of one route."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.statuses: dict[int, int] = {}
+        self.bytes = 0
+        self.accepted: list[str] = []
+
+    def add(self, status: int, latency: float, size: int, marker: str):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+        if status == 200:
+            self.accepted.append(marker)
+
+    def merge(self, other: 'Stats'):
+        self.latencies += other.latencies
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.bytes += other.bytes
+        self.accepted += other.accepted
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Session(threading.Thread):
+    """Posts the uploads of one browser after the other over a kept alive connection."""
+
+    def __init__(self, number: int, args: argparse.Namespace, token: str, deadline: float, seed: int):
+        super().__init__(name=f'session-{number}', daemon=True)
+        self.number = number
+        self.args = args
+        self.token = token
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.stats = {route: Stats() for route in ROUTES}
+        self._url = urllib.parse.urlsplit(args.url)
+        self._connection: typing.Optional[http.client.HTTPConnection] = None
+        self._sequence = 0
+
+    def _marker(self) -> str:
+        self._sequence += 1
+        return f'{self.token}-{self.number}-{self._sequence}'
+
+    def _post(self, route: str, body: bytes, headers: dict, marker: str):
+        start = time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self._url.hostname, self._url.port or 80,
+                                                              timeout=self.args.timeout)
+            self._connection.request('POST', self._url.path.rstrip('/') + route, body, headers)
+            response = self._connection.getresponse()
+            response.read()
+            status = response.status
+            if response.will_close:
+                self._connection.close()
+                self._connection = None
+        except (OSError, http.client.HTTPException):
+            status = 0
+            if self._connection:
+                self._connection.close()
+            self._connection = None
+        self.stats[route].add(status, time.perf_counter() - start, len(body), marker)
+
+    def run(self):
+        args = self.args
+        rng = self.rng
+        result_routes = [route for route in args.routes if route in RESULT_ROUTES]
+        runs = 0
+        while time.monotonic() < self.deadline:
+            size = rng.choice(args.report_sizes)
+            if '/dns-query' in args.routes:
+                for n in range(size):
+                    marker = self._marker()
+                    body = json.dumps(dns_query(rng, marker, DELAYS[n % len(DELAYS)])).encode()
+                    self._post('/dns-query', body, {'Content-Type': 'application/json'}, marker)
+            if result_routes:
+                route = rng.choice(result_routes)
+                marker = self._marker()
+                data = []
+                for _ in range(rng.randint(1, args.runs_per_upload)):
+                    runs += 1
+                    data.append(run_info(route, rng, marker, runs, size))
+                body = json.dumps(data).encode()
+                headers = {'Content-Type': 'application/json'}
+                if rng.random() < args.gzip:
+                    body = gzip.compress(body)
+                    headers['Content-Encoding'] = 'gzip'
+                self._post(route, body, headers, marker)
+        if self._connection:
+            self._connection.close()
+
+
+def run_load(args: argparse.Namespace, token: str) -> tuple[dict[str, Stats], float]:
+    deadline = time.monotonic() + args.duration
+    sessions = [Session(n, args, token, deadline, args.seed * 1_000_003 + n) for n in range(args.sessions)]
+    start = time.perf_counter()
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+    elapsed = time.perf_counter() - start
+    stats = {route: Stats() for route in ROUTES}
+    for session in sessions:
+        for route, route_stats in session.stats.items():
+            stats[route].merge(route_stats)
+    return stats, elapsed
+
+
+def markers(record) -> list[str]:
+    runs = record if isinstance(record, list) else [record]
+    return [run[MARKER] for run in runs if isinstance(run, dict) and isinstance(run.get(MARKER), str)]
+
+
+def verify(paths: list[str], accepted: list[str], token: str) -> dict:
+    """Check the daily files of a route against its accepted uploads."""
+    found: dict[str, int] = {}
+    lines = torn = invalid = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                lines += 1
+                if not line.endswith(b'\n'):
+                    torn += 1
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Interleaved lines leave invalid JSON (or two documents on one line)
+                    invalid += 1
+                    continue
+                for marker in markers(record):
+                    if marker.startswith(token + '-'):
+                        found[marker] = found.get(marker, 0) + 1
+    accepted_set = set(accepted)
+    return {
+        'lines': lines,
+        'torn': torn,
+        'invalid': invalid,
+        'missing': len(accepted_set - found.keys()),
+        'duplicated': sum(1 for count in found.values() if count > 1),
+        # Written although the request failed (e.g. answered after the client timed out)
+        'unacknowledged': len(found.keys() - accepted_set),
+    }
+
+
+def route_paths(args: argparse.Namespace, route: str) -> list[str]:
+    option, suffix = ROUTE_FILES[route]
+    directory = getattr(args, option)
+    if not directory:
+        return []
+    paths = []
+    for day in {datetime.date.today(), datetime.date.today() - datetime.timedelta(days=1)}:
+        path = os.path.join(directory, day.strftime('%Y/%m'), f'{day.isoformat()}{suffix}')
+        if os.path.exists(path):
+            paths.append(path)
+    return paths
+
+
+def report(args: argparse.Namespace, label: str, stats: dict[str, Stats], elapsed: float, token: str) -> dict:
+    result = {'label': label, 'duration': elapsed, 'sessions': args.sessions, 'routes': {}}
+    print(f'== {label}: {args.sessions} sessions, {elapsed:.1f}s')
+    print(f'{"route":<12}{"requests":>10}{"req/s":>10}{"MB/s":>8}{"errors":>8}' +
+          ''.join(f'{"p" + format(p, "g"):>9}' for p in PERCENTILES) + f'{"max":>9}  (ms)')
+    for route in args.routes:
+        route_stats = stats[route]
+        count = len(route_stats.latencies)
+        if not count:
+            continue
+        errors = count - route_stats.statuses.get(200, 0)
+        latencies = {f'p{p:g}': percentile(route_stats.latencies, p) for p in PERCENTILES}
+        latencies['max'] = max(route_stats.latencies)
+        print(f'{route:<12}{count:>10}{count / elapsed:>10.0f}{route_stats.bytes / elapsed / 1e6:>8.2f}{errors:>8}' +
+              ''.join(f'{value * 1000:>9.1f}' for value in latencies.values()))
+        entry = {'requests': count, 'throughput': count / elapsed, 'bytes': route_stats.bytes, 'errors': errors,
+                 'error_rate': errors / count, 'statuses': route_stats.statuses, 'latency': latencies}
+        paths = route_paths(args, route)
+        if paths:
+            entry['files'] = verify(paths, route_stats.accepted, token)
+        result['routes'][route] = entry
+    for route, entry in result['routes'].items():
+        if 'files' in entry:
+            files = entry['files']
+            statuses = ', '.join(f'{status or "conn"}: {count}' for status, count in sorted(entry['statuses'].items()))
+            print(f'{route:<12}statuses {statuses}; files: {files["lines"]} lines, {files["torn"]} torn, '
+                  f'{files["invalid"]} invalid, {files["missing"]} missing, {files["duplicated"]} duplicated, '
+                  f'{files["unacknowledged"]} unacknowledged')
+    return result
+
+
+def spawn(args: argparse.Namespace, fsync: str, directory: str) -> subprocess.Popen:
+    """Start results-upload.py with empty output directories below `directory`."""
+    for option, name in (('output_directory', 'results'), ('v2_output_directory', 'v2results'),
+                         ('dns_output_directory', 'dns')):
+        path = os.path.join(directory, name)
+        os.makedirs(path)
+        setattr(args, option, path)
+    command = [sys.executable, args.spawn, '-o', args.output_directory, '--v2-output-directory',
+               args.v2_output_directory, '-d', args.dns_output_directory, '--server', args.server, '--fsync', fsync]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=open(os.path.join(directory, 'server.log'), 'w'))
+    url = urllib.parse.urlsplit(args.url)
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection(url.hostname, url.port or 80, timeout=1).connect()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError(f'results-upload.py exited with {server.returncode}, see {directory}/server.log')
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('results-upload.py did not start listening')
+
+
+def main():
+    parser = argparse.ArgumentParser('Results Upload Benchmark')
+    parser.add_argument('--url', default=f'http://127.0.0.1:{PORT}', help='Base URL of the results-upload service')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES), help='Routes to load')
+    parser.add_argument('--sessions', type=int, default=32, help='Concurrent browser sessions')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load per run')
+    parser.add_argument('--report-sizes', type=int, nargs='+', default=list(REPORT_SIZES),
+                        help='Entries of the result list of a run (picked at random per session)')
+    parser.add_argument('--runs-per-upload', type=int, default=1, help='Most runs in one upload')
+    parser.add_argument('--gzip', type=float, default=1.0, help='Share of the result uploads sent gzip compressed')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output-directory', help='Results directory of the running service (to verify)')
+    parser.add_argument('--v2-output-directory', help='v2 results directory of the running service (to verify)')
+    parser.add_argument('-d', '--dns-output-directory', help='DNS results directory of the running service (to verify)')
+    parser.add_argument('--spawn', metavar='RESULTS_UPLOAD_PY',
+                        help='Start this (rendered) results-upload.py for every --fsync mode instead of using a running one')
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='asgi', help='Server of the spawned service')
+    parser.add_argument('--fsync', nargs='+', default=['none', 'interval', 'batch'],
+                        help='Durability modes of the spawned service to compare')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    if args.spawn:
+        for fsync in args.fsync:
+            directory = tempfile.mkdtemp(prefix=f'upload-bench-{fsync}-')
+            server = spawn(args, fsync, directory)
+            try:
+                token = uuid.uuid4().hex[:12]
+                stats, elapsed = run_load(args, token)
+            finally:
+                server.terminate()
+                server.wait()
+            # Verified once the server wrote everything and exited
+            results.append(report(args, f'{args.server}, fsync {fsync}', stats, elapsed, token))
+            shutil.rmtree(directory)
+    else:
+        token = uuid.uuid4().hex[:12]
+        stats, elapsed = run_load(args, token)
+        results.append(report(args, args.url, stats, elapsed, token))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = any(files['torn'] or files['invalid'] or files['missing'] or files['duplicated']
+                 for result in results for entry in result['routes'].values() if (files := entry.get('files')))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
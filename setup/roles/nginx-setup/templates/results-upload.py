@@ -1,10 +1,23 @@
 import argparse
+import asyncio
+import collections
 import datetime
-from flask import Flask, request, jsonify
+import hmac
+from flask import Flask, request, jsonify, g
 from werkzeug.middleware.proxy_fix import ProxyFix
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 import logging
 import json
 import os
+import re
+import time
+import typing
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
@@ -12,20 +25,134 @@ DATA_FILE = '{date}-results.jsonl'
 V2DATA_FILE = '{date}-v2results.jsonl'
 DNSURSERDATA_FILE = '{date}-dns-user-info.jsonl'
 DNSDATA_FILE = '{date}-dns-results.jsonl'
+SESSIONS_FILE = '{date}-sessions.jsonl'
 OUTPUT_DIR = '{{ upload_dir }}'
 V2OUTPUT_DIR = '{{ v2_upload_dir }}'
 DNSOUTPUT_DIR = '{{ dns_upload_dir }}'
 
+# Largest upload body after decompression
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024
+READ_SIZE = 64 * 1024
+# Prefix of an upload checked while it arrives (see results_start), larger first runs are checked with the whole body
+START_SCAN_SIZE = 64 * 1024
+# zlib window bits of the accepted content encodings
+CONTENT_ENCODINGS = {'identity': None, 'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# When appended uploads are synced to disk: left to the kernel (none), at most every FSYNC_INTERVAL seconds
+# (interval) or before every upload is answered (batch)
+FSYNC_MODES = ('none', 'interval', 'batch')
+FSYNC_MODE = 'none'
+FSYNC_INTERVAL = 1.0
+
+# Bearer token DNS servers send their batches of query records with (/dns-queries), None accepts any
+COLLECTOR_TOKEN = None
+# Ids of written batches kept to drop batches sent again
+BATCH_ID_LIMIT = 100_000
+
+# Uploads waiting for their writer before requests are rejected (ASGI server only)
+WRITE_QUEUE_SIZE = 10_000
+RETRY_AFTER = 5
+
+# Sessions are forgotten this long after their last DNS query or upload (ASGI server only)
+SESSION_TTL = 15 * 60
+SESSION_LIMIT = 200_000
+# DNS query records and joined uploads kept per session
+SESSION_RECORD_LIMIT = 1_000
+# Uploads are joined after the DNS server wrote its last records (it flushes every second)
+JOIN_DELAY = 3.0
+FOLLOW_INTERVAL = 0.25
+JOIN_ROUTES = ('/v2results', '/dnsresults')
+# Lists of an upload whose entries name the session id of their DNS queries as runUId
+RESULT_LISTS = ('delayResults', 'resolutionInfos')
+# Delay type (v2delay_<type>-<runUId>_<delay>) or delay (id-<runUId>.delay-<delay>, .dns-delay-<delay>) of a query name
+QNAME_DELAY = re.compile(r'(?:^|\.)(?:v2delay_(a|aaaa)-[^._]+_(\d+)|id-[^.]+\.(?:dns-)?delay-(\d+))\.')
+# Difference allowed between the clocks of a client and the DNS server when matching queries to the time of a run
+JOIN_CLOCK_SLACK = 60.0
+
+ROUTES = ('/results', '/v2results', '/dnsresults', '/dns-query', '/dns-queries', '/sessions')
+REQUESTS = Counter('upload_requests_total', 'Upload requests by route and response status', ['route', 'status'])
+REQUEST_DURATION = Histogram('upload_request_duration_seconds', 'Time to answer an upload request', ['route'])
+WRITE_DURATION = Histogram('upload_write_duration_seconds', 'Duration of a batched write of a route (asgi server)',
+                           ['route'], buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1))
+WRITE_BATCH = Histogram('upload_write_batch_uploads', 'Uploads written with one write (asgi server)', ['route'],
+                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+FSYNC_DURATION = Histogram('upload_fsync_duration_seconds', 'Duration of syncing a daily file to disk (--fsync)', ['route'],
+                           buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1))
+WRITE_QUEUE = Gauge('upload_write_queue_depth', 'Uploads waiting for the writer of a route (asgi server)', ['route'])
+SESSIONS = Gauge('upload_sessions', 'Sessions held for joining DNS queries and uploads (asgi server)')
+SESSION_QUERIES = Counter('upload_session_queries_total', 'DNS query records read from the DNS results (asgi server)')
+SESSIONS_JOINED = Counter('upload_sessions_joined_total', 'Uploaded runs joined with their DNS queries (asgi server)')
+SESSIONS_EVICTED = Counter('upload_sessions_evicted_total', 'Sessions removed as expired or over the limit (asgi server)')
+BULK_RECORDS = Counter('upload_dns_bulk_records_total', 'DNS query records of /dns-queries batches by result', ['result'])
+BULK_DUPLICATES = Counter('upload_dns_bulk_duplicate_batches_total', '/dns-queries batches which were already written')
+
+
+def route_label(path: str) -> str:
+    if path.startswith('/sessions/'):
+        return '/sessions'
+    return path if path in ROUTES else 'other'
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def count_request(response):
+    route = route_label(request.path)
+    REQUESTS.labels(route, response.status_code).inc()
+    REQUEST_DURATION.labels(route).observe(time.perf_counter() - g.start)
+    return response
+
+_synced: dict[str, float] = {}
+
+
+def append_file(path: str, data: bytes, route: str):
+    """Append to a daily file of the Flask server, syncing it according to --fsync.
+
+    In interval mode a file is synced with the first write after the
+    interval passed.
+    """
+    with open(path, 'ab') as f:
+        f.write(data)
+        if FSYNC_MODE == 'batch' or (FSYNC_MODE == 'interval'
+                                     and time.monotonic() >= _synced.get(path, 0.0) + FSYNC_INTERVAL):
+            f.flush()
+            start = time.perf_counter()
+            os.fsync(f.fileno())
+            FSYNC_DURATION.labels(route).observe(time.perf_counter() - start)
+            _synced[path] = time.monotonic()
+
+
+def read_upload(check: typing.Callable[[typing.Any], typing.Optional[int]], error_status: int,
+                start: typing.Optional[typing.Callable[[bytes], typing.Optional[bool]]] = None) -> bytes:
+    """Read and check an upload of the Flask server, returns its line (as the ASGI server writes it)."""
+    body = UploadBody(request.headers.get('Content-Encoding'), MAX_UPLOAD_SIZE, error_status, start)
+    while True:
+        chunk = request.stream.read(READ_SIZE)
+        if not chunk:
+            break
+        body.feed(chunk)
+    raw = body.finish()
+    try:
+        data = parse_json(raw)
+    except ValueError:
+        raise UploadError(error_status)
+    status = check(data)
+    if status:
+        raise UploadError(status)
+    return upload_line(raw, data)
+
+
+def read_results_upload() -> bytes:
+    return read_upload(check_results, 500, results_start)
+
+
 @app.route('/results', methods=['POST'])
 def upload_data():
-    # Get JSON data from request
     try:
-        data = request.get_json()
-
-        if not isinstance(data, list):
-            return 'FAILURE', 500
-        if 'runCount' not in data[0] or 'id' not in data[0]:
-            return 'FAILURE', 500
+        line = read_results_upload()
 
         date = datetime.datetime.now()
         date_str = date.strftime('%Y-%m-%d')
@@ -34,25 +161,20 @@ def upload_data():
 
         os.makedirs(os.path.join(OUTPUT_DIR, month_dir), exist_ok=True)
 
-        with open(data_filepath, 'a') as f:
-            json.dump(data, f)
-            f.write('\n')
+        append_file(data_filepath, line, request.path)
 
         return jsonify({"message": "Data uploaded successfully"}), 200
-    except Exception:
+    except UploadError as e:
+        return 'FAILURE', e.status
+    except Exception as e:
+        logging.error(e)
         return 'FAILURE', 500
 
 
 @app.route('/v2results', methods=['POST'])
 def upload_v2data():
-    # Get JSON data from request
     try:
-        data = request.get_json()
-
-        if not isinstance(data, list):
-            return 'FAILURE', 500
-        if 'runCount' not in data[0] or 'id' not in data[0]:
-            return 'FAILURE', 500
+        line = read_results_upload()
 
         date = datetime.datetime.now()
         date_str = date.strftime('%Y-%m-%d')
@@ -61,25 +183,20 @@ def upload_v2data():
 
         os.makedirs(os.path.join(V2OUTPUT_DIR, month_dir), exist_ok=True)
 
-        with open(data_filepath, 'a') as f:
-            json.dump(data, f)
-            f.write('\n')
+        append_file(data_filepath, line, request.path)
 
         return jsonify({"message": "Data uploaded successfully"}), 200
-    except Exception:
+    except UploadError as e:
+        return 'FAILURE', e.status
+    except Exception as e:
+        logging.error(e)
         return 'FAILURE', 500
 
 
 @app.route('/dnsresults', methods=['POST'])
 def upload_dnsdata():
-    # Get JSON data from request
     try:
-        data = request.get_json()
-
-        if not isinstance(data, list):
-            return 'FAILURE', 500
-        if 'runCount' not in data[0] or 'id' not in data[0]:
-            return 'FAILURE', 500
+        line = read_results_upload()
 
         date = datetime.datetime.now()
         date_str = date.strftime('%Y-%m-%d')
@@ -88,25 +205,56 @@ def upload_dnsdata():
 
         os.makedirs(os.path.join(OUTPUT_DIR, month_dir), exist_ok=True)
 
-        with open(data_filepath, 'a') as f:
-            json.dump(data, f)
-            f.write('\n')
+        append_file(data_filepath, line, request.path)
 
         return jsonify({"message": "Data uploaded successfully"}), 200
-    except Exception:
+    except UploadError as e:
+        return 'FAILURE', e.status
+    except Exception as e:
+        logging.error(e)
+        return 'FAILURE', 500
+
+
+@app.route('/dns-queries', methods=['POST'])
+def log_dns_queries():
+    try:
+        if not collector_authorized(request.headers.get('Authorization')):
+            return 'FAILURE', 401
+        batch_id = request.headers.get('X-Batch-Id')
+        if batch_id and batch_id in RECENT_BATCHES:
+            BULK_DUPLICATES.inc()
+            return jsonify({"accepted": 0, "rejected": 0, "duplicate": True}), 200
+
+        body = UploadBody(request.headers.get('Content-Encoding'), MAX_UPLOAD_SIZE, 400)
+        while True:
+            chunk = request.stream.read(READ_SIZE)
+            if not chunk:
+                break
+            body.feed(chunk)
+        lines, rejected = bulk_lines(body.finish())
+
+        date = datetime.datetime.now()
+        month_dir = date.strftime('%Y/%m')
+        data_filepath = os.path.join(DNSOUTPUT_DIR, month_dir, DNSDATA_FILE.format(date=date.strftime('%Y-%m-%d')))
+        os.makedirs(os.path.join(DNSOUTPUT_DIR, month_dir), exist_ok=True)
+        append_file(data_filepath, b''.join(lines), '/dns-queries')
+
+        if batch_id:
+            RECENT_BATCHES.add(batch_id)
+        BULK_RECORDS.labels('accepted').inc(len(lines))
+        BULK_RECORDS.labels('rejected').inc(rejected)
+        return jsonify({"accepted": len(lines), "rejected": rejected}), 200
+    except UploadError as e:
+        return 'FAILURE', e.status
+    except Exception as e:
+        logging.error(e)
         return 'FAILURE', 500
 
 
 @app.route('/dns-query', methods=['POST'])
 def log_dns_query():
-    # Get JSON data from request
     try:
-        data = request.get_json()
-
-        if not isinstance(data, dict):
-            return 'FAILURE', 501
-        if 'ns_ip' not in data:
-            return 'FAILURE', 502
+        line = read_upload(check_dns_query, 503)
 
         date = datetime.datetime.now()
         date_str = date.strftime('%Y-%m-%d')
@@ -115,25 +263,717 @@ def log_dns_query():
 
         os.makedirs(os.path.join(DNSOUTPUT_DIR, month_dir), exist_ok=True)
 
-        with open(data_filepath, 'a') as f:
-            json.dump(data, f)
-            f.write('\n')
+        append_file(data_filepath, line, '/dns-query')
 
         return jsonify({"message": "Data uploaded successfully"}), 200
+    except UploadError as e:
+        return 'FAILURE', e.status
     except Exception as e:
         logging.error(e)
         return 'FAILURE', 503
 
 
+# ASGI server: the routes above for uvicorn, see --server
+
+
+def parse_json(body: bytes):
+    if orjson is not None:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # orjson rejects some documents json accepts (NaN, integers beyond 64 bit)
+            pass
+    return json.loads(body)
+
+
+def check_results(data) -> typing.Optional[int]:
+    if not isinstance(data, list):
+        return 500
+    if 'runCount' not in data[0] or 'id' not in data[0]:
+        return 500
+    return None
+
+
+def check_dns_query(data) -> typing.Optional[int]:
+    if not isinstance(data, dict):
+        return 501
+    if 'ns_ip' not in data:
+        return 502
+    return None
+
+
+class UploadError(Exception):
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+def results_start(data: bytes) -> typing.Optional[bool]:
+    """Whether an upload starts like a list of runs whose first one has a runCount and an id.
+
+    None while the first run is not complete yet.
+    """
+    text = data.lstrip()
+    if not text:
+        return None
+    if text[:1] != b'[':
+        return False
+    text = text[1:].lstrip()
+    if not text:
+        return None
+    if text[:1] != b'{':
+        return False
+    try:
+        first, _ = json.JSONDecoder().raw_decode(text.decode('utf-8', 'ignore'))
+    except ValueError:
+        # Incomplete, a malformed body fails when it is parsed as a whole
+        return None
+    return 'runCount' in first and 'id' in first
+
+
+class UploadBody:
+    """Collects an upload body, decompressing it according to its Content-Encoding.
+
+    Raises an UploadError with 415 for other encodings and 413 once the
+    body exceeds `max_size` after decompression. A `start` check (like
+    `results_start`) rejects the upload as soon as enough of it arrived,
+    it only sees the first START_SCAN_SIZE bytes while the body arrives.
+    """
+
+    def __init__(self, encoding: typing.Optional[str], max_size: int, error_status: int,
+                 start: typing.Optional[typing.Callable[[bytes], typing.Optional[bool]]] = None):
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding not in CONTENT_ENCODINGS:
+            raise UploadError(415)
+        wbits = CONTENT_ENCODINGS[encoding]
+        self._decompressor = zlib.decompressobj(wbits) if wbits else None
+        self._max_size = max_size
+        self._error_status = error_status
+        self._start = start
+        self._data = bytearray()
+
+    def feed(self, chunk: bytes):
+        if self._decompressor is None:
+            self._append(chunk)
+        else:
+            try:
+                while chunk:
+                    # Never inflate more than the size limit allows
+                    self._append(self._decompressor.decompress(chunk, self._max_size - len(self._data) + 1))
+                    chunk = self._decompressor.unconsumed_tail
+            except zlib.error:
+                raise UploadError(self._error_status)
+        if self._start is not None:
+            # Bounded, so a large upload is not decoded again with every chunk
+            verdict = self._start(self._data[:START_SCAN_SIZE])
+            if verdict is False:
+                raise UploadError(self._error_status)
+            if verdict or len(self._data) >= START_SCAN_SIZE:
+                self._start = None
+
+    def _append(self, data: bytes):
+        self._data += data
+        if len(self._data) > self._max_size:
+            raise UploadError(413)
+
+    def finish(self) -> bytes:
+        if self._decompressor is not None:
+            try:
+                self._append(self._decompressor.flush())
+            except zlib.error:
+                raise UploadError(self._error_status)
+            if not self._decompressor.eof:
+                raise UploadError(self._error_status)
+        if self._start is not None and self._start(self._data) is not True:
+            raise UploadError(self._error_status)
+        return bytes(self._data)
+
+
+def upload_line(body: bytes, data) -> bytes:
+    """The line of the daily file: the uploaded JSON as it is, unless it spans several lines."""
+    body = body.strip()
+    if b'\n' in body or b'\r' in body:
+        return json.dumps(data).encode() + b'\n'
+    return body + b'\n'
+
+
+def bulk_lines(body: bytes) -> tuple[list[bytes], int]:
+    """Lines of a batch of DNS query records (NDJSON) to write and the number of invalid ones."""
+    lines = []
+    rejected = 0
+    for line in body.split(b'\n'):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = parse_json(line)
+        except ValueError:
+            rejected += 1
+            continue
+        if check_dns_query(data):
+            rejected += 1
+            continue
+        lines.append(line + b'\n')
+    return lines, rejected
+
+
+def collector_authorized(authorization: typing.Optional[str]) -> bool:
+    if COLLECTOR_TOKEN is None:
+        return True
+    return hmac.compare_digest((authorization or '').encode(), f'Bearer {COLLECTOR_TOKEN}'.encode())
+
+
+class BatchIds:
+    """Ids of the last written batches.
+
+    A DNS server sends a batch again if it did not get the response, its
+    id tells that it was written already.
+    """
+
+    def __init__(self, limit: int = BATCH_ID_LIMIT):
+        self.limit = limit
+        self._ids: collections.OrderedDict[str, None] = collections.OrderedDict()
+
+    def __contains__(self, batch_id: str) -> bool:
+        return batch_id in self._ids
+
+    def add(self, batch_id: str):
+        self._ids[batch_id] = None
+        if len(self._ids) > self.limit:
+            self._ids.popitem(last=False)
+
+
+RECENT_BATCHES = BatchIds()
+
+
+class RouteWriter:
+    """Appends the uploads of one route to its daily file.
+
+    The file stays open until the date changes. Uploads are queued and
+    written in batches, each upload is answered once its batch is written
+    (and, with the `fsync` mode 'batch', synced to disk). In 'interval'
+    mode written data is synced at most `fsync_interval` seconds later.
+    """
+
+    def __init__(self, route: str, output_dir: str, file_pattern: str, queue_size: int, fsync: str = FSYNC_MODE,
+                 fsync_interval: float = FSYNC_INTERVAL):
+        self.route = route
+        self.output_dir = output_dir
+        self.file_pattern = file_pattern
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._file = None
+        self._path = None
+        # Written data which is not synced yet and when the file was synced last
+        self._dirty = False
+        self._synced = 0.0
+        WRITE_QUEUE.labels(route).set_function(self.queue.qsize)
+
+    async def run(self):
+        while True:
+            timeout = None
+            if self.fsync == 'interval' and self._dirty:
+                timeout = max(self._synced + self.fsync_interval - time.monotonic(), 0)
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), timeout)]
+            except asyncio.TimeoutError:
+                try:
+                    await asyncio.to_thread(self._sync)
+                except OSError as e:
+                    logging.error(e)
+                    self._synced = time.monotonic()
+                continue
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            uploads = [upload for upload in batch if upload is not None]
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, uploads)
+                written = True
+            except Exception as e:
+                logging.error(e)
+                written = False
+            WRITE_DURATION.labels(self.route).observe(time.perf_counter() - start)
+            WRITE_BATCH.labels(self.route).observe(len(uploads))
+            for *_, done in uploads:
+                if not done.done():
+                    done.set_result(written)
+            if len(uploads) < len(batch):
+                self._close()
+                return
+
+    def _write(self, uploads: list):
+        lines = []
+        for date, line, _ in uploads:
+            month_dir = date.strftime('%Y/%m')
+            path = os.path.join(self.output_dir, month_dir, self.file_pattern.format(date=date.strftime('%Y-%m-%d')))
+            if path != self._path:
+                self._flush(lines)
+                self._close()
+                os.makedirs(os.path.join(self.output_dir, month_dir), exist_ok=True)
+                self._file = open(path, 'ab')
+                self._path = path
+            lines.append(line)
+        self._flush(lines)
+        if self.fsync == 'batch' or (self.fsync == 'interval'
+                                     and time.monotonic() >= self._synced + self.fsync_interval):
+            self._sync()
+
+    def _flush(self, lines: list):
+        if lines:
+            self._file.write(b''.join(lines))
+            self._file.flush()
+            self._dirty = True
+            lines.clear()
+
+    def _sync(self):
+        if self._file and self._dirty:
+            start = time.perf_counter()
+            os.fsync(self._file.fileno())
+            FSYNC_DURATION.labels(self.route).observe(time.perf_counter() - start)
+            self._dirty = False
+        self._synced = time.monotonic()
+
+    def _close(self):
+        if self._file and self.fsync != 'none':
+            # The file of the previous day is complete on disk before it is closed
+            self._sync()
+        if self._file:
+            self._file.close()
+        self._file = None
+        self._path = None
+
+
+class Session:
+    __slots__ = ('queries', 'records', 'updated')
+
+    def __init__(self):
+        self.queries: list[dict] = []
+        self.records: list[dict] = []
+        self.updated = 0.0
+
+
+class SessionIndex:
+    """DNS query records and joined uploads by session id.
+
+    A session is kept for `ttl` seconds after its last update. Sessions are
+    ordered by their last update, so expired ones (and the oldest ones once
+    there are more than `limit`) are removed from the front.
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL, limit: int = SESSION_LIMIT, record_limit: int = SESSION_RECORD_LIMIT):
+        self.ttl = ttl
+        self.limit = limit
+        self.record_limit = record_limit
+        self._sessions: collections.OrderedDict[str, Session] = collections.OrderedDict()
+        SESSIONS.set_function(lambda: len(self._sessions))
+
+    def _touch(self, id: str) -> Session:
+        now = time.monotonic()
+        session = self._sessions.get(id)
+        if session is None:
+            session = self._sessions[id] = Session()
+        else:
+            self._sessions.move_to_end(id)
+        session.updated = now
+        self._expire(now)
+        return session
+
+    def _expire(self, now: float):
+        sessions = self._sessions
+        while sessions:
+            session = next(iter(sessions.values()))
+            if len(sessions) <= self.limit and now - session.updated < self.ttl:
+                return
+            sessions.popitem(last=False)
+            SESSIONS_EVICTED.inc()
+
+    def get(self, id: str) -> typing.Optional[Session]:
+        session = self._sessions.get(id)
+        if session is None or time.monotonic() - session.updated >= self.ttl:
+            return None
+        return session
+
+    def add_query(self, record: dict):
+        """Index a query_info record of the DNS server by the id of its query name."""
+        if record.get('id') is None:
+            return
+        SESSION_QUERIES.inc()
+        session = self._touch(str(record['id']))
+        if len(session.queries) < self.record_limit:
+            session.queries.append(record)
+
+    def join(self, route: str, data: list) -> list[dict]:
+        """Combined records of the uploaded runs.
+
+        Each entry of the result lists gets the DNS queries of its runUId
+        attached, as far as their names carry its delay (and delayType) and
+        they were made during the run: runUIds are random, may collide and
+        are shared by the entries of several delays (or both types of v2).
+        The records are also indexed by the run id and the runUIds.
+        """
+        records = []
+        for run in data:
+            if not isinstance(run, dict) or run.get('id') is None:
+                continue
+            record = dict(run, route=route, join_time=time.time())
+            ids = {str(run['id'])}
+            window = run_window(run)
+            for key in RESULT_LISTS:
+                if isinstance(run.get(key), list):
+                    record[key] = [self._join_result(result, ids, window) for result in run[key]]
+            for id in ids:
+                session = self._touch(id)
+                if len(session.records) < self.record_limit:
+                    session.records.append(record)
+            SESSIONS_JOINED.inc()
+            records.append(record)
+        return records
+
+    def _join_result(self, result, ids: set, window: typing.Optional[tuple[float, float]]):
+        if not isinstance(result, dict) or result.get('runUId') is None:
+            return result
+        id = str(result['runUId'])
+        ids.add(id)
+        session = self.get(id)
+        queries = [query for query in session.queries if query_of(query, result, window)] if session else []
+        return dict(result, queries=queries)
+
+
+def run_window(run: dict) -> typing.Optional[tuple[float, float]]:
+    """Time (DNS server clock, s) during which the queries of a run were made, None without its timestamps."""
+    start, end = run.get('timestampStart'), run.get('timestampEnd')
+    if not isinstance(start, (int, float)) or not isinstance(end, (int, float)):
+        return None
+    return start / 1000 - JOIN_CLOCK_SLACK, end / 1000 + JOIN_CLOCK_SLACK
+
+
+def query_of(query: dict, result: dict, window: typing.Optional[tuple[float, float]]) -> bool:
+    """Whether a DNS query record with the runUId of a result entry was made for this entry."""
+    match = QNAME_DELAY.search(str(query.get('rr_name', '')).lower())
+    if match is None:
+        return False
+    delay_type, v2_delay, v1_delay = match.groups()
+    try:
+        delay = int(result['delay'])
+    except (KeyError, TypeError, ValueError):
+        delay = None
+    if delay is not None and delay != int(v2_delay or v1_delay):
+        return False
+    if result.get('delayType') is not None and str(result['delayType']).lower() != delay_type:
+        return False
+    request_time = query.get('request_time')
+    if window is not None and isinstance(request_time, (int, float)):
+        return window[0] <= request_time <= window[1]
+    return True
+
+
+class DNSResultsFollower:
+    """Feeds the records appended to the daily DNS results file into a `SessionIndex`.
+
+    The DNS server writes its query_info records to this file (as does the
+    /dns-query route). Only records written after the start are read, the
+    file of a new day is read from its beginning.
+    """
+
+    def __init__(self, output_dir: str, sessions: SessionIndex, interval: float = FOLLOW_INTERVAL):
+        self.output_dir = output_dir
+        self.sessions = sessions
+        self.interval = interval
+        self._file = None
+        self._path = None
+        self._partial = b''
+        self._started = False
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    lines = await asyncio.to_thread(self._read)
+                except Exception as e:
+                    logging.error(e)
+                    lines = []
+                for line in lines:
+                    try:
+                        record = parse_json(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict):
+                        self.sessions.add_query(record)
+                await asyncio.sleep(self.interval)
+        finally:
+            if self._file:
+                self._file.close()
+
+    def _read(self) -> list[bytes]:
+        date = datetime.datetime.now()
+        path = os.path.join(self.output_dir, date.strftime('%Y/%m'), DNSDATA_FILE.format(date=date.strftime('%Y-%m-%d')))
+        lines = []
+        if path != self._path:
+            if self._file:
+                # Rest of the previous day
+                lines += self._lines(self._file.read())
+                self._file.close()
+                self._file = None
+                self._partial = b''
+            try:
+                self._file = open(path, 'rb')
+            except FileNotFoundError:
+                self._started = True
+                return lines
+            self._path = path
+            if not self._started:
+                self._file.seek(0, os.SEEK_END)
+                self._started = True
+        elif os.fstat(self._file.fileno()).st_size < self._file.tell():
+            # Truncated or replaced
+            self._file.seek(0)
+            self._partial = b''
+        return lines + self._lines(self._file.read())
+
+    def _lines(self, data: bytes) -> list[bytes]:
+        *lines, self._partial = (self._partial + data).split(b'\n')
+        return [line for line in lines if line]
+
+
+class UploadApp:
+    """ASGI application accepting the uploads of all routes.
+
+    Requests are answered with 503 and Retry-After while the queue of their
+    route is full. Uploads of the `JOIN_ROUTES` are joined with the DNS
+    queries of their sessions and written to the daily sessions file,
+    GET /sessions/<id> returns what is known of a run id or runUId.
+    """
+
+    def __init__(self, queue_size: int = WRITE_QUEUE_SIZE, session_ttl: float = SESSION_TTL,
+                 session_limit: int = SESSION_LIMIT, max_upload_size: int = MAX_UPLOAD_SIZE, fsync: str = FSYNC_MODE,
+                 fsync_interval: float = FSYNC_INTERVAL):
+        # Path: writer, check of the start of the body, check of the data, status of other errors
+        self.routes = dict(
+            (path, (RouteWriter(path, output_dir, file_pattern, queue_size, fsync, fsync_interval), start, check,
+                    error_status))
+            for path, output_dir, file_pattern, start, check, error_status in [
+                ('/results', OUTPUT_DIR, DATA_FILE, results_start, check_results, 500),
+                ('/v2results', V2OUTPUT_DIR, V2DATA_FILE, results_start, check_results, 500),
+                ('/dnsresults', OUTPUT_DIR, DNSURSERDATA_FILE, results_start, check_results, 500),
+                ('/dns-query', DNSOUTPUT_DIR, DNSDATA_FILE, None, check_dns_query, 503),
+            ]
+        )
+        self.max_upload_size = max_upload_size
+        self.sessions = SessionIndex(session_ttl, session_limit)
+        self.follower = DNSResultsFollower(DNSOUTPUT_DIR, self.sessions)
+        self.sessions_writer = RouteWriter('/sessions', OUTPUT_DIR, SESSIONS_FILE, queue_size, fsync, fsync_interval)
+        self._tasks = []
+        self._joins: dict[asyncio.TimerHandle, tuple[str, list]] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            start = time.perf_counter()
+            route = route_label(scope['path'])
+            if route == '/sessions':
+                status = await self.lookup(scope, send)
+            elif route == '/dns-queries':
+                status = await self.bulk(scope, receive, send)
+            else:
+                status = await self.upload(scope, receive, send)
+            REQUESTS.labels(route, status).inc()
+            REQUEST_DURATION.labels(route).observe(time.perf_counter() - start)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                writers = [writer for writer, *_ in self.routes.values()] + [self.sessions_writer]
+                self._tasks = [asyncio.create_task(writer.run()) for writer in writers]
+                self._follower = asyncio.create_task(self.follower.run())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._follower.cancel()
+                for handle, (path, data) in list(self._joins.items()):
+                    handle.cancel()
+                    self.join(handle, path, data)
+                for writer, *_ in self.routes.values():
+                    await writer.queue.put(None)
+                await self.sessions_writer.queue.put(None)
+                await asyncio.gather(*self._tasks)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def upload(self, scope, receive, send) -> int:
+        """Answer an upload request, returns the response status."""
+        route = self.routes.get(scope['path'])
+        if route is None:
+            return await respond(send, 404, 'Not Found')
+        if scope['method'] != 'POST':
+            return await respond(send, 405, 'Method Not Allowed')
+        writer, start, check, error_status = route
+
+        try:
+            body = UploadBody(header(scope, b'content-encoding'), self.max_upload_size, error_status, start)
+            await read_body(receive, body)
+            raw = body.finish()
+            data = parse_json(raw)
+            status = check(data)
+            if status:
+                return await respond(send, status, 'FAILURE')
+            line = upload_line(raw, data)
+        except UploadError as e:
+            return await respond(send, e.status, 'FAILURE')
+        except Exception as e:
+            logging.debug(e)
+            return await respond(send, error_status, 'FAILURE')
+
+        done = asyncio.get_running_loop().create_future()
+        try:
+            writer.queue.put_nowait((datetime.datetime.now(), line, done))
+        except asyncio.QueueFull:
+            return await respond(send, 503, 'FAILURE', [(b'retry-after', str(RETRY_AFTER).encode())])
+        if not await done:
+            return await respond(send, error_status, 'FAILURE')
+        if scope['path'] in JOIN_ROUTES:
+            loop = asyncio.get_running_loop()
+            handle = loop.call_later(JOIN_DELAY, lambda: self.join(handle, scope['path'], data))
+            self._joins[handle] = (scope['path'], data)
+        return await respond(send, 200, '{"message":"Data uploaded successfully"}\n', content_type=b'application/json')
+
+    async def bulk(self, scope, receive, send) -> int:
+        """Answer a batch of DNS query records (NDJSON) sent by a DNS server.
+
+        The valid records are appended to the daily DNS results file like
+        those of /dns-query (and are read into the sessions from there).
+        """
+        if scope['method'] != 'POST':
+            return await respond(send, 405, 'Method Not Allowed')
+        if not collector_authorized(header(scope, b'authorization')):
+            return await respond(send, 401, 'Unauthorized')
+        batch_id = header(scope, b'x-batch-id')
+        if batch_id and batch_id in RECENT_BATCHES:
+            BULK_DUPLICATES.inc()
+            return await respond(send, 200, json.dumps({'accepted': 0, 'rejected': 0, 'duplicate': True}) + '\n',
+                                 content_type=b'application/json')
+
+        try:
+            body = UploadBody(header(scope, b'content-encoding'), self.max_upload_size, 400)
+            await read_body(receive, body)
+            lines, rejected = bulk_lines(body.finish())
+        except UploadError as e:
+            return await respond(send, e.status, 'FAILURE')
+        except Exception as e:
+            logging.debug(e)
+            return await respond(send, 400, 'FAILURE')
+
+        if lines:
+            writer = self.routes['/dns-query'][0]
+            done = asyncio.get_running_loop().create_future()
+            try:
+                writer.queue.put_nowait((datetime.datetime.now(), b''.join(lines), done))
+            except asyncio.QueueFull:
+                return await respond(send, 503, 'FAILURE', [(b'retry-after', str(RETRY_AFTER).encode())])
+            if not await done:
+                return await respond(send, 500, 'FAILURE')
+        if batch_id:
+            RECENT_BATCHES.add(batch_id)
+        BULK_RECORDS.labels('accepted').inc(len(lines))
+        BULK_RECORDS.labels('rejected').inc(rejected)
+        return await respond(send, 200, json.dumps({'accepted': len(lines), 'rejected': rejected}) + '\n',
+                             content_type=b'application/json')
+
+    def join(self, handle: asyncio.TimerHandle, path: str, data: list):
+        """Write the combined records of an upload to the sessions file."""
+        self._joins.pop(handle, None)
+        loop = asyncio.get_running_loop()
+        for record in self.sessions.join(path, data):
+            try:
+                line = json.dumps(record).encode() + b'\n'
+                self.sessions_writer.queue.put_nowait((datetime.datetime.now(), line, loop.create_future()))
+            except asyncio.QueueFull:
+                logging.warning(f'Sessions queue full, dropping the joined record of run {record["id"]}')
+
+    async def lookup(self, scope, send) -> int:
+        if scope['method'] != 'GET':
+            return await respond(send, 405, 'Method Not Allowed')
+        id = scope['path'][len('/sessions/'):]
+        session = self.sessions.get(id)
+        if session is None:
+            return await respond(send, 404, 'Not Found')
+        body = json.dumps({'id': id, 'queries': session.queries, 'records': session.records}) + '\n'
+        return await respond(send, 200, body, content_type=b'application/json')
+
+
+def header(scope, name: bytes) -> typing.Optional[str]:
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def read_body(receive, body: UploadBody):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('Client disconnected during upload')
+        body.feed(message.get('body', b''))
+        if not message.get('more_body', False):
+            return
+
+
+async def respond(send, status: int, body: str, headers: typing.Optional[list] = None,
+                  content_type: bytes = b'text/html; charset=utf-8') -> int:
+    body = body.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] + (headers or []),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Results Upload Handler')
     parser.add_argument('-o', '--output-directory', required=True, type=str, help='Directory where results are stored')
     parser.add_argument('--v2-output-directory', required=True, type=str, help='Directory where v2 results are stored')
     parser.add_argument('-d', '--dns-output-directory', required=True, type=str, help='Directory where DNS results are stored')
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='flask',
+                        help='Flask development server or the asynchronous uvicorn server')
+    parser.add_argument('--queue-size', type=int, default=WRITE_QUEUE_SIZE,
+                        help='Uploads per route waiting to be written before requests are rejected (asgi server)')
+    parser.add_argument('--session-ttl', type=float, default=SESSION_TTL,
+                        help='Seconds sessions are kept for joining DNS queries and uploads (asgi server)')
+    parser.add_argument('--session-limit', type=int, default=SESSION_LIMIT,
+                        help='Sessions kept for joining DNS queries and uploads (asgi server)')
+    parser.add_argument('--max-upload-size', type=int, default=MAX_UPLOAD_SIZE,
+                        help='Largest accepted upload in bytes (after decompression)')
+    parser.add_argument('--fsync', choices=FSYNC_MODES, default=FSYNC_MODE,
+                        help='Sync the daily files to disk never (left to the kernel), every --fsync-interval seconds or '
+                             'before an upload is answered')
+    parser.add_argument('--fsync-interval', type=float, default=FSYNC_INTERVAL,
+                        help='Seconds written uploads may wait for their sync (--fsync interval)')
+    parser.add_argument('--collector-token-file',
+                        help='File with the token DNS servers have to send their query records with (/dns-queries), '
+                             'kept out of the command line')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port')
     args = parser.parse_args()
+    MAX_UPLOAD_SIZE = args.max_upload_size
+    if args.collector_token_file:
+        with open(args.collector_token_file) as f:
+            COLLECTOR_TOKEN = f.read().strip()
+    FSYNC_MODE = args.fsync
+    FSYNC_INTERVAL = args.fsync_interval
     OUTPUT_DIR = args.output_directory
     V2OUTPUT_DIR = args.v2_output_directory
     DNSOUTPUT_DIR = args.dns_output_directory
 
+    if args.metrics_port:
+        start_http_server(args.metrics_port, addr='127.0.0.1')
 
-    app.run(host='127.0.0.1', port=40_000)
+    if args.server == 'asgi':
+        import uvicorn
+        uvicorn.run(UploadApp(args.queue_size, args.session_ttl, args.session_limit, args.max_upload_size, args.fsync,
+                              args.fsync_interval),
+                    host='127.0.0.1', port=40_000, access_log=False)
+    else:
+        app.run(host='127.0.0.1', port=40_000)
@@ -392,6 +392,25 @@ async function executeTestRun(runInfo, delayElements, runUIdMapping, randomizeDo
     runInfo["timestampEnd"] = endDate.getTime();
 }
 
+// Results are gzip compressed where the browser supports CompressionStream
+async function encodeResults(json) {
+    const headers = {
+        "Content-Type": "application/json"
+    };
+    if (typeof CompressionStream === "undefined") {
+        return { headers: headers, body: json };
+    }
+    try {
+        const stream = new Blob([json]).stream().pipeThrough(new CompressionStream("gzip"));
+        const body = await new Response(stream).blob();
+        headers["Content-Encoding"] = "gzip";
+        return { headers: headers, body: body };
+    } catch (error) {
+        console.error('Could not compress the results:', error.message);
+        return { headers: headers, body: json };
+    }
+}
+
 export async function transmitResults() {
     document.getElementById("startTestBtn").setAttribute('disabled', true);
     document.getElementById("transmitResultsBtn").setAttribute('disabled', true);
@@ -404,12 +423,11 @@ export async function transmitResults() {
         dataToPush.push(testRunData[runID]);
     }
 
+    const { headers, body } = await encodeResults(JSON.stringify(dataToPush));
     fetch(resultsPath, {
         method: "POST",
-        headers: {
-            "Content-Type": "application/json"
-        },
-        body: JSON.stringify(dataToPush)
+        headers: headers,
+        body: body
     }).then((response) => {
         if (!response.ok) {
             alert(`Could not transmit the results ${response.status}. Check JS Console for more Info`);